@@ -0,0 +1,553 @@
+#!/usr/bin/python
+#
+# Copyright 2006 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""Benchmark for the repository administrator commands
+
+The benchmark.py script generates a synthetic repository (a pool of
+tiny but valid .deb and .dsc files with configurable numbers of
+packages, versions, architectures, installed files, and dependencies,
+plus a set of signed uploads for incoming processing) and then times
+the debmarshal commands end to end on it: index_pool.py,
+enter_incoming.py, make_release.py (snapshot, commit, diff, verify),
+and handle_alias.py.  The results go to a JSON file so that runs can
+be compared mechanically.
+"""
+
+__author__ = 'cklin@google.com (Chuan-Kai Lin)'
+
+import cStringIO
+import gzip
+import optparse
+import os
+import random
+import shutil
+import subprocess as sp
+import sys
+import tarfile
+import tempfile
+import time
+
+_SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        os.pardir, 'src')
+sys.path.insert(0, os.path.normpath(_SRC_DIR))
+
+import crypto_utils as cu
+
+
+_TRACK = 'bench'
+
+_MAINTAINER = 'Debmarshal Benchmark <bench@localhost>'
+
+
+def _MakeTarGz(members):
+  """Build a gzipped tarball from a list of (name, data) pairs
+  """
+
+  sio = cStringIO.StringIO()
+  tar = tarfile.open(name='data.tar.gz', mode='w:gz', fileobj=sio)
+  for name, data in members:
+    info = tarfile.TarInfo(name)
+    info.mtime = 0
+    if data is None:
+      info.type = tarfile.DIRTYPE
+      info.mode = 0755
+      tar.addfile(info)
+    else:
+      info.size = len(data)
+      info.mode = 0644
+      tar.addfile(info, cStringIO.StringIO(data))
+  tar.close()
+  return sio.getvalue()
+
+
+def _MakeGzip(data):
+  """Compress a string with gzip
+  """
+
+  sio = cStringIO.StringIO()
+  output = gzip.GzipFile('', 'wb', 9, sio)
+  output.write(data)
+  output.close()
+  return sio.getvalue()
+
+
+def _WriteFile(name, data):
+  """Write a string into a file (creating its directory)
+  """
+
+  path = os.path.dirname(name)
+  if path and not os.path.isdir(path):
+    os.makedirs(path, 0755)
+  f = open(name, 'wb')
+  f.write(data)
+  f.close()
+
+
+def _MakeDeb(name, control, paths):
+  """Write a binary package with the given control text and files
+
+  The package is an ar archive with the debian-binary, control.tar.gz,
+  and data.tar.gz members, just like what dpkg-deb builds.
+  """
+
+  dirs = {}
+  data = []
+  for path in paths:
+    parent = os.path.dirname(path)
+    while parent not in dirs and parent != '/':
+      dirs[parent] = None
+      parent = os.path.dirname(parent)
+    data.append(('.' + path, path + '\n'))
+  members = [('./', None)]
+  members.extend([('.' + d, None) for d in sorted(dirs.keys())])
+  members.extend(data)
+
+  sio = cStringIO.StringIO()
+  sio.write('!<arch>\n')
+  for member, content in [('debian-binary', '2.0\n'),
+                          ('control.tar.gz',
+                           _MakeTarGz([('control', control)])),
+                          ('data.tar.gz', _MakeTarGz(members))]:
+    sio.write('%-16s%-12d%-6d%-6d%-8s%-10d`\n' %
+              (member, 0, 0, 0, '100644', len(content)))
+    sio.write(content)
+    if len(content) % 2:
+      sio.write('\n')
+  _WriteFile(name, sio.getvalue())
+
+
+def _FileSpec(name, data):
+  """Return the (md5, size, name) triple of a file to be listed
+  """
+
+  size, digests = cu.HashString(data, ['md5'])
+  return digests['md5'], str(size), os.path.basename(name)
+
+
+class _Package(object):
+  """Description of a synthetic source package and its binaries"""
+
+  def __init__(self, name, version, archs, depends, paths):
+    self.name = name
+    self.version = version
+    self.archs = archs
+    self.depends = depends
+    self.paths = paths
+
+  def Initial(self):
+    if self.name.startswith('lib'):
+      return self.name[:4]
+    return self.name[0]
+
+  def ControlText(self, arch):
+    lines = ['Package: ' + self.name,
+             'Version: ' + self.version,
+             'Section: utils',
+             'Priority: optional',
+             'Architecture: ' + arch,
+             'Maintainer: ' + _MAINTAINER,
+             'Installed-Size: ' + str(len(self.paths))]
+    if self.depends:
+      lines.append('Depends: ' + ', '.join(self.depends))
+    lines.append('Description: synthetic package ' + self.name)
+    lines.append(' Generated by the debmarshal benchmark.')
+    return '\n'.join(lines) + '\n'
+
+  def WriteFiles(self, path):
+    """Write the source and binary package files into a directory
+
+    The function returns the list of (md5, size, name) triples of the
+    files written, with the .dsc file first.
+    """
+
+    base = self.name + '_' + self.version
+    upstream = self.name + '_' + self.version.split('-')[0]
+    orig = _MakeTarGz([(upstream + '/README', self.name + '\n')])
+    diff = _MakeGzip('--- a/README\n+++ b/README\n')
+    specs = [_FileSpec(upstream + '.orig.tar.gz', orig),
+             _FileSpec(base + '.diff.gz', diff)]
+    _WriteFile(os.path.join(path, upstream + '.orig.tar.gz'), orig)
+    _WriteFile(os.path.join(path, base + '.diff.gz'), diff)
+
+    dsc = '\n'.join(['Format: 1.0',
+                     'Source: ' + self.name,
+                     'Binary: ' + self.name,
+                     'Architecture: any',
+                     'Version: ' + self.version,
+                     'Maintainer: ' + _MAINTAINER,
+                     'Standards-Version: 3.7.2',
+                     'Files:'] +
+                    [' ' + ' '.join(spec) for spec in specs]) + '\n'
+    dsc_name = os.path.join(path, base + '.dsc')
+    _WriteFile(dsc_name, dsc)
+    specs.insert(0, _FileSpec(dsc_name, dsc))
+
+    for arch in self.archs:
+      deb_name = os.path.join(path, base + '_' + arch + '.deb')
+      _MakeDeb(deb_name, self.ControlText(arch), self.paths)
+      specs.append(_FileSpec(deb_name, open(deb_name, 'rb').read()))
+    return specs
+
+
+def _GeneratePackages(options, rand):
+  """Generate the descriptions of all synthetic packages
+  """
+
+  archs = options.archs.split(',')
+  names = ['pkg%05d' % index for index in range(options.packages)]
+  packages = []
+  for index in range(options.packages):
+    name = names[index]
+    pkg_archs = archs
+    if index % 5 == 4:
+      pkg_archs = ['all']
+    for version in range(options.versions):
+      count = int(options.density)
+      if rand.random() < options.density - count:
+        count = count+1
+      depends = []
+      for target in rand.sample(names, min(count, len(names))):
+        if target == name:  continue
+        if rand.random() < 0.5:
+          depends.append(target + ' (>= 0.0-1)')
+        else:
+          depends.append(target)
+      paths = ['/usr/bin/' + name]
+      for number in range(options.files):
+        paths.append('/usr/share/%s/file%04d' % (name, number))
+      packages.append(_Package(name, '%d.0-1' % (version+1),
+                               pkg_archs, depends, paths))
+  return packages
+
+
+def _WriteConfig(repo_dir, mode, archs):
+  """Write the config/repository file of a synthetic repository
+  """
+
+  _WriteFile(os.path.join(repo_dir, 'config', 'repository'),
+             '\n'.join(['Mode: ' + mode,
+                        'Component: main',
+                        'Architectures: ' + ', '.join(archs),
+                        '',
+                        '[' + _TRACK + ']',
+                        'Origin: Debmarshal',
+                        'Label: Benchmark',
+                        'Description: Synthetic benchmark track',
+                        'PDiffs: 2']) + '\n')
+  for name in ['dbs', 'dists']:
+    os.makedirs(os.path.join(repo_dir, name))
+
+
+def _GeneratePool(repo_dir, packages, archs):
+  """Generate a tracking-mode repository with a populated pool
+  """
+
+  _WriteConfig(repo_dir, 'tracking', archs)
+  for package in packages:
+    path = os.path.join(repo_dir, 'pool', 'main', package.Initial(),
+                        package.name)
+    package.WriteFiles(path)
+
+
+def _SetupGnuPG(gnupg_dir):
+  """Create a throwaway signing key for uploads and releases
+
+  The key is trusted for gpgv verification through trustedkeys.gpg.
+  The function returns False if gpg is not available.
+  """
+
+  os.makedirs(gnupg_dir, 0700)
+  params = os.path.join(gnupg_dir, 'params')
+  _WriteFile(params, '\n'.join(['%no-protection',
+                                'Key-Type: RSA',
+                                'Key-Length: 2048',
+                                'Name-Real: Debmarshal Benchmark',
+                                'Name-Email: bench@localhost',
+                                'Expire-Date: 0',
+                                '%commit']) + '\n')
+  env = dict(os.environ)
+  env['GNUPGHOME'] = gnupg_dir
+  try:
+    if sp.call(['gpg', '--batch', '--gen-key', params], env=env,
+               stdout=sp.PIPE, stderr=sp.STDOUT):
+      return False
+    export = sp.Popen(['gpg', '--batch', '--export'], env=env,
+                      stdout=sp.PIPE).communicate()[0]
+    child = sp.Popen(['gpg', '--batch', '--no-default-keyring',
+                      '--keyring', os.path.join(gnupg_dir,
+                                                'trustedkeys.gpg'),
+                      '--import'], env=env, stdin=sp.PIPE,
+                     stdout=sp.PIPE, stderr=sp.STDOUT)
+    child.communicate(export)
+    return child.returncode == 0
+  except OSError:
+    return False
+
+
+def _GenerateUploads(repo_dir, packages, archs, gnupg_dir):
+  """Generate a supervised-mode repository with signed uploads
+  """
+
+  _WriteConfig(repo_dir, 'supervised', archs)
+  incoming_dir = os.path.join(repo_dir, 'incoming')
+  os.makedirs(incoming_dir)
+  env = dict(os.environ)
+  env['GNUPGHOME'] = gnupg_dir
+  past = time.time() - 60
+
+  for package in packages:
+    specs = package.WriteFiles(incoming_dir)
+    changes = '\n'.join(
+      ['Format: 1.7',
+       'Date: ' + time.strftime('%a, %d %b %Y %H:%M:%S +0000',
+                                time.gmtime()),
+       'Source: ' + package.name,
+       'Binary: ' + package.name,
+       'Architecture: source ' + ' '.join(package.archs),
+       'Version: ' + package.version,
+       'Distribution: unstable',
+       'Urgency: low',
+       'Maintainer: ' + _MAINTAINER,
+       'Description:',
+       ' ' + package.name + ' - synthetic package',
+       'Changes:',
+       ' Generated by the debmarshal benchmark.',
+       'Files:'] +
+      [' %s %s utils optional %s' % spec for spec in specs]) + '\n'
+    name = os.path.join(incoming_dir, package.name + '_' +
+                        package.version + '_source.changes')
+    _WriteFile(name + '.unsigned', changes)
+    sp.call(['gpg', '--batch', '--yes', '--clearsign', '-o', name,
+             name + '.unsigned'], env=env, stdout=sp.PIPE,
+            stderr=sp.STDOUT)
+    os.remove(name + '.unsigned')
+    os.utime(name, (past, past))
+
+
+def _TimeCommand(name, args, repo_dir, env):
+  """Run a debmarshal command and measure its resource usage
+  """
+
+  before = os.times()
+  start = time.time()
+  log = open(os.path.join(repo_dir, name.replace(' ', '_') + '.log'), 'w')
+  try:
+    status = sp.call(args, cwd=repo_dir, env=env, stdout=log, stderr=log)
+  finally:
+    log.close()
+  elapsed = time.time() - start
+  after = os.times()
+  print '%-28s %10.3f s  (exit %d)' % (name, elapsed, status)
+  return { 'name': name,
+           'seconds': round(elapsed, 4),
+           'user': round(after[2]-before[2], 4),
+           'system': round(after[3]-before[3], 4),
+           'status': status }
+
+
+def _CheckAliasLog(repo_dir, count):
+  """Check the alias history printed by the handle_alias log step
+
+  The history should list one record per update of the alias, in the
+  order of the updates.
+  """
+
+  try:
+    log = open(os.path.join(repo_dir, 'handle_alias_log.log'))
+  except IOError:
+    print 'handle_alias log did not leave a log file'
+    return False
+  try:
+    lines = [line for line in log if line.find('\t') >= 0]
+  finally:
+    log.close()
+  times = [time.mktime(time.strptime(line.split('\t')[1].strip()))
+           for line in lines]
+  if len(times) != count or times != sorted(times):
+    print 'handle_alias log shows %d records, expected %d in order' % (
+      len(times), count)
+    return False
+  return True
+
+
+def _GetTreeSize(path):
+  """Compute the total size of the files under a directory
+  """
+
+  total = [0]
+
+  def DoSum(_arg, dir, names):
+    for name in names:
+      pathname = os.path.join(dir, name)
+      if os.path.isfile(pathname) and not os.path.islink(pathname):
+        total[0] = total[0] + os.path.getsize(pathname)
+
+  os.path.walk(path, DoSum, None)
+  return total[0]
+
+
+def _FormatJSON(value, indent=''):
+  """Format a value made of dicts, lists, strings, and numbers as JSON
+  """
+
+  inner = indent + '  '
+  if isinstance(value, dict):
+    items = [inner + _FormatJSON(str(key)) + ': ' +
+             _FormatJSON(value[key], inner) for key in sorted(value.keys())]
+    return '{\n' + ',\n'.join(items) + '\n' + indent + '}'
+  if isinstance(value, list):
+    items = [inner + _FormatJSON(item, inner) for item in value]
+    return '[\n' + ',\n'.join(items) + '\n' + indent + ']'
+  if isinstance(value, bool):
+    return value and 'true' or 'false'
+  if isinstance(value, (int, long, float)):
+    return repr(value)
+  if value is None:
+    return 'null'
+  escaped = str(value).replace('\\', '\\\\').replace('"', '\\"')
+  return '"' + escaped.replace('\n', '\\n') + '"'
+
+
+def _ParseCommandLine():
+  """Parse command line options and arguments
+  """
+
+  usage = 'usage: %prog [options]'
+  version = 'Debmarshall 0.0'
+  parser = optparse.OptionParser(usage=usage, version=version)
+
+  parser.add_option('-n', '--packages', dest='packages', type='int',
+                    default=200, help='number of source packages')
+  parser.add_option('-v', '--versions', dest='versions', type='int',
+                    default=2, help='versions of each package in the pool')
+  parser.add_option('-a', '--archs', dest='archs', default='i386,amd64',
+                    help='comma-separated list of architectures')
+  parser.add_option('-f', '--files', dest='files', type='int',
+                    default=20, help='installed files per package')
+  parser.add_option('-d', '--density', dest='density', type='float',
+                    default=2.0, help='average dependencies per package')
+  parser.add_option('-u', '--uploads', dest='uploads', type='int',
+                    default=20, help='uploads for incoming processing')
+  parser.add_option('-s', '--seed', dest='seed', type='int', default=0,
+                    help='random seed for package generation')
+  parser.add_option('-w', '--workdir', dest='workdir', metavar='PATH',
+                    help='generate repositories in PATH (kept afterwards)')
+  parser.add_option('-o', '--output', dest='output', metavar='FILE',
+                    default='benchmark-results.json',
+                    help='write JSON results to FILE')
+  parser.add_option('--src', dest='src', metavar='PATH',
+                    default=os.path.normpath(_SRC_DIR),
+                    help='debmarshal source directory')
+
+  options, proper = parser.parse_args()
+  if proper:
+    parser.error('no arguments expected')
+  return options
+
+
+def main():
+  options = _ParseCommandLine()
+  rand = random.Random(options.seed)
+  archs = options.archs.split(',')
+  work_dir = options.workdir
+  if work_dir is None:
+    work_dir = tempfile.mkdtemp(prefix='debmarshal-bench.')
+  else:
+    work_dir = os.path.abspath(work_dir)
+    os.makedirs(work_dir)
+
+  try:
+    tracking_dir = os.path.join(work_dir, 'tracking')
+    supervised_dir = os.path.join(work_dir, 'supervised')
+    gnupg_dir = os.path.join(work_dir, 'gnupg')
+
+    start = time.time()
+    packages = _GeneratePackages(options, rand)
+    _GeneratePool(tracking_dir, packages, archs)
+    has_gpg = _SetupGnuPG(gnupg_dir)
+    if has_gpg:
+      uploads = _GeneratePackages(options, random.Random(options.seed+1))
+      uploads = [pkg for pkg in uploads if pkg.version == '1.0-1']
+      _GenerateUploads(supervised_dir, uploads[:options.uploads],
+                       archs, gnupg_dir)
+    generation = time.time() - start
+    print 'Generated synthetic repositories in %.3f s' % generation
+
+    env = dict(os.environ)
+    env['GNUPGHOME'] = gnupg_dir
+
+    def Command(script, *args):
+      return [sys.executable, os.path.join(options.src, script)] + list(args)
+
+    release = _TRACK + '/0'
+    steps = [
+      ('index_pool', tracking_dir, Command('index_pool.py')),
+      ('index_pool rescan', tracking_dir, Command('index_pool.py')),
+      ('make_release snapshot', tracking_dir,
+       Command('make_release.py', '-s')),
+      ('make_release commit', tracking_dir,
+       Command('make_release.py', '-s', '-t', _TRACK, 'commit')),
+      ('make_release diff', tracking_dir,
+       Command('make_release.py', '-s', 'diff', release)),
+      ('make_release verify', tracking_dir,
+       Command('make_release.py', '-s', '-t', _TRACK, 'verify')),
+      ('handle_alias update', tracking_dir,
+       Command('handle_alias.py', 'update', _TRACK + '/stable', '0')),
+      ('handle_alias update again', tracking_dir,
+       Command('handle_alias.py', 'update', _TRACK + '/stable',
+               'latest')),
+      ('handle_alias log', tracking_dir,
+       Command('handle_alias.py', 'log', _TRACK + '/stable')),
+      ('handle_alias refresh', tracking_dir,
+       Command('handle_alias.py', 'refresh'))]
+    if has_gpg:
+      steps.append(('enter_incoming', supervised_dir,
+                    Command('enter_incoming.py', supervised_dir)))
+    else:
+      print 'gpg is not available, skipping enter_incoming'
+
+    results = []
+    for name, repo_dir, args in steps:
+      results.append(_TimeCommand(name, args, repo_dir, env))
+    alias_log_ok = _CheckAliasLog(tracking_dir, 2)
+
+    report = { 'parameters': { 'packages': options.packages,
+                               'versions': options.versions,
+                               'archs': archs,
+                               'files': options.files,
+                               'density': options.density,
+                               'uploads': has_gpg and options.uploads or 0,
+                               'seed': options.seed },
+               'python': sys.version.split()[0],
+               'timestamp': int(time.time()),
+               'generation_seconds': round(generation, 4),
+               'pool_bytes': _GetTreeSize(os.path.join(tracking_dir, 'pool')),
+               'dbs_bytes': _GetTreeSize(os.path.join(tracking_dir, 'dbs')),
+               'alias_log_ok': alias_log_ok,
+               'results': results }
+    output = open(options.output, 'w')
+    output.write(_FormatJSON(report) + '\n')
+    output.close()
+    print 'Results written to ' + options.output
+  finally:
+    if options.workdir is None:
+      shutil.rmtree(work_dir, True)
+
+
+if __name__ == '__main__':
+  main()
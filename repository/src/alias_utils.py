@@ -1,4 +1,4 @@
-#!/usr/bin/python2.4
+#!/usr/bin/python
 #
 # Copyright 2006 Google Inc.
 #
@@ -54,45 +54,76 @@ def _ValidateAlias(alias):
   sys.exit()
 
 
-def UpdateAlias(alias_db, release_db, alias, release):
+def _MigrateHistory(alias_db, log_db, alias):
+  """Move the legacy history of an alias into the alias_log table
+
+  Older repositories kept the whole history of an alias as a list of
+  timestamp_release records in the aliases table.  This function
+  copies such a history into the alias_log table (unless the alias
+  already has a history there) and keeps only the last record in the
+  aliases table.
+  """
+
+  if alias not in alias_db or alias in log_db:
+    return
+  entries = alias_db[alias].split(', ')
+  for entry in entries:
+    bu.AppendDuplicate(log_db, alias, entry)
+  alias_db[alias] = entries[-1]
+
+
+def UpdateAlias(alias_db, log_db, release_db, alias, release):
   """Update an alias to point to the given release
 
-  This function appends an entry in the aliases Berkeley DB table to
-  record that the specified alias is changed to point to the given
-  release at this time.  The release can be specified as an alias.  It
-  does not actually change the symlinks -- for that you need to use
-  the RefreshAlias() function.
+  This function records in the aliases Berkeley DB table that the
+  specified alias now points to the given release, and it appends the
+  same timestamp_release record to the history of the alias in the
+  alias_log table.  The release can be specified as an alias.  It does
+  not actually change the symlinks -- for that you need to use the
+  RefreshAlias() function.
   """
 
   _ValidateAlias(alias)
   track = alias.split('/')[0]
   release = LookupAlias(alias_db, release_db, track + '/' + release)
-  ts = str(time.time())
-  bu.AppendEntry(alias_db, alias, ts+'_'+release)
+  _MigrateHistory(alias_db, log_db, alias)
+  entry = str(time.time()) + '_' + release
+  bu.AppendDuplicate(log_db, alias, entry)
+  alias_db[alias] = entry
 
 
 def RefreshAlias(alias_db):
   """Refresh all the release alias symlinks in dists/
 
-  This function removes all symlinks at the top-level directory of
-  each maintenance track and re-create the alias symlinks from the
-  records in the aliases Berkeley DB table.
+  This function brings the alias symlinks in line with the records in
+  the aliases Berkeley DB table and then removes any other symlink at
+  the top-level directory of each maintenance track.  Only symlinks
+  whose target differs from the record (as reported by readlink) are
+  touched, and each of them is replaced atomically, so an alias never
+  disappears during a refresh.
   """
 
+  links = {}
+  for alias, entry in bu.IterateTable(alias_db):
+    name = os.path.join('dists', alias)
+    release = entry.split('_')[-1]
+    links[name] = None
+    try:
+      if os.readlink(name) == release:
+        continue
+    except OSError:
+      pass
+    ou.ReplaceSymlink(release, name)
+
   for track in su.ListTracks():
     track_dir = os.path.join('dists', track)
     if not os.path.isdir(track_dir):  continue
     files = os.listdir(track_dir)
     for name in files:
       name = os.path.join(track_dir, name)
-      if os.path.islink(name):
+      if os.path.islink(name) and name not in links:
         ou.IgnoreOSError(os.remove, name)
 
-  for alias in alias_db:
-    name = os.path.join('dists', alias)
-    release = alias_db[alias].split('_')[-1]
-    os.symlink(release, name)
-
 
 def LookupAlias(alias_db, release_db, alias):
   """Convert an 'track/alias' string to a release number
@@ -100,14 +131,34 @@ def LookupAlias(alias_db, release_db, alias):
 
   [track, release] = alias.split('/')
   if alias in alias_db:
-    release = alias_db[alias].split(', ')[-1].split('_')[-1]
+    release = alias_db[alias].split('_')[-1]
   if (track + '/' + release) not in release_db:
     lg.error(alias + ' does not refer to a release')
     sys.exit()
   return release
 
 
-def ShowAliasHistory(alias_db, alias):
+def _IterateHistory(log_db, alias):
+  """Iterate over the history records of an alias in alias_log
+
+  The alias_log table keeps one duplicate key per record, in the order
+  in which they were appended, so this function walks through them
+  with the table cursor.
+  """
+
+  try:
+    record = log_db.set_location(alias)
+  except KeyError:
+    return
+  while record is not None and record[0] == alias:
+    yield record[1]
+    try:
+      record = log_db.next()
+    except KeyError:
+      return
+
+
+def ShowAliasHistory(alias_db, log_db, alias):
   """Display the change history of the given alias
   """
 
@@ -115,7 +166,11 @@ def ShowAliasHistory(alias_db, alias):
   if alias not in alias_db:
     lg.error('There is no such an alias called ' + alias)
     sys.exit()
+  if alias in log_db:
+    history = _IterateHistory(log_db, alias)
+  else:
+    history = alias_db[alias].split(', ')
   print 'History for alias', alias
-  for line in alias_db[alias].split(', '):
+  for line in history:
     [ts, release] = line.split('_', 1)
     print release + '\t' + time.asctime(time.localtime(float(ts)))
@@ -1,4 +1,4 @@
-#!/usr/bin/python2.4
+#!/usr/bin/python
 #
 # Copyright 2006 Google Inc.
 #
@@ -33,6 +33,7 @@ import sys
 import time
 import urllib2
 import alias_utils as au
+import crypto_utils as cu
 import logging_utils as lu
 import os_utils as ou
 
@@ -43,10 +44,21 @@ _CACHE_SIZE = 33554432
 _DB_NAMES = { 'pkg_info': 'dbs/pkg_info.db',
               'src_info': 'dbs/src_info.db',
               'pkg_deps': 'dbs/pkg_deps.db',
+              'pkg_latest': 'dbs/pkg_latest.db',
               'file_pkg': 'dbs/file_pkg.db',
               'pool_pkg': 'dbs/pool_pkg.db',
+              'pool_scan': 'dbs/pool_scan.db',
               'releases': 'dbs/releases.db',
-              'aliases':  'dbs/aliases.db' }
+              'aliases':  'dbs/aliases.db',
+              'alias_log': 'dbs/alias_log.db',
+              'imports':  'dbs/imports.db',
+              'verdicts': 'dbs/verdicts.db',
+              'plans':    'dbs/plans.db' }
+
+# Tables whose keys can have duplicate records (kept in the order in
+# which they are added); all other tables map each key to one value.
+
+_DB_FLAGS = { 'alias_log': bsddb.db.DB_DUP }
 
 
 def RunWithDB(names, func, arg=None):
@@ -61,6 +73,7 @@ def RunWithDB(names, func, arg=None):
   """
 
   dbs = {}
+  span = 'RunWithDB(' + ', '.join(sorted(names or ['all'])) + ')'
   if names is None:
     names = _DB_NAMES.keys()
   for name in names:
@@ -68,13 +81,21 @@ def RunWithDB(names, func, arg=None):
       lg.error('The ' + name + ' database does not exist')
       sys.exit()
     dbs[name] = bsddb.btopen(
-      _DB_NAMES[name], 'c', cachesize=_CACHE_SIZE)
+      _DB_NAMES[name], 'c', btflags=_DB_FLAGS.get(name, 0),
+      cachesize=_CACHE_SIZE)
   try:
-    return func(arg, dbs)
+    return lu.RunWithSpan(span, func, arg, dbs)
   finally:
     for db in dbs:  dbs[db].close()
 
 
+def GetTableFiles():
+  """Return a dictionary that maps table names to their file names
+  """
+
+  return dict(_DB_NAMES)
+
+
 def AppendEntry(db, key, value):
   """Append a value in a dictionary with ', '-separated values
 
@@ -98,6 +119,37 @@ def AppendEntry(db, key, value):
     db[key] = value
 
 
+def AppendDuplicate(db, key, value):
+  """Add a record under a key in a table with duplicate keys
+
+  Assigning db[key] in a table opened with DB_DUP replaces all records
+  under the key, so this function puts the record through the
+  underlying DB object, which adds it after the existing duplicates.
+  """
+
+  db.db.put(key, value)
+
+
+def IterateTable(db):
+  """Iterate over (key, value) pairs of a table in key order
+
+  This function walks through a BTree table with its cursor, which
+  retrieves each key and value together and avoids the separate lookup
+  that db[key] would do for each key in a plain for loop.
+  """
+
+  try:
+    record = db.first()
+  except KeyError:
+    return
+  while record is not None:
+    yield record
+    try:
+      record = db.next()
+    except KeyError:
+      return
+
+
 def FindKeyStartingWith(string, db):
   """Test if there is a key with a certain initial
 
@@ -116,32 +168,237 @@ def FindKeyStartingWith(string, db):
     return False
 
 
-def _FetchRemoteTable(base_url, db_keys):
-  """Fetch Berkeley DB tables from a remote repository
+# Tables fetched from underlying repositories are kept in a persistent
+# cache, in one subdirectory (named by the SHA1 hash value of the base
+# URL) per underlying repository.  Each cached table has a .meta file
+# with the HTTP validators it was fetched with.
+
+_REMOTE_CACHE_DIR = 'cache/underlying'
+
+_CHUNK_SIZE = 1048576
+
+
+def _ReadMeta(name):
+  """Read the attributes in a cache metadata file
+  """
+
+  meta = {}
+  if os.path.exists(name):
+    for line in open(name):
+      if ': ' in line:
+        key, value = line.rstrip('\n').split(': ', 1)
+        meta[key] = value
+  return meta
+
+
+def _WriteMeta(name, meta):
+  """Atomically write the attributes in a cache metadata file
+  """
 
-  This function fetches the specified Berkeley DB tables from the
-  underlying releases through an URL and save them in the dbs/
-  directory.  If something goes wrong, it raises EnvironmentError.
+  temp = name + '.' + str(os.getpid())
+  output = open(temp, 'w')
+  for key in sorted(meta.keys()):
+    output.write(key + ': ' + meta[key] + '\n')
+  output.close()
+  os.rename(temp, name)
+
+
+def _GetValidators(response):
+  """Extract the ETag and Last-Modified headers of a response
+  """
+
+  meta = {}
+  for header in ['ETag', 'Last-Modified']:
+    value = response.info().getheader(header)
+    if value is not None:
+      meta[header] = value
+  return meta
+
+
+def _DownloadTable(url, name, meta):
+  """Download a table into the cache (revalidating the cached copy)
+
+  This function fetches url into the cache file name, whose metadata
+  is given in meta, with a conditional request.  It returns True if
+  the cached copy is up to date and False if it downloaded a new one.
+  The download is streamed into name.part in chunks, and an
+  interrupted download is resumed with a range request as long as the
+  remote file has not changed in the meantime.
   """
 
-  if not os.path.isdir('dbs'):
-    os.mkdir('dbs')
+  request = urllib2.Request(url)
+  if os.path.exists(name):
+    if 'ETag' in meta:
+      request.add_header('If-None-Match', meta['ETag'])
+    if 'Last-Modified' in meta:
+      request.add_header('If-Modified-Since', meta['Last-Modified'])
+
+  part = name + '.part'
+  part_meta = _ReadMeta(part + '.meta')
+  offset = 0
+  if os.path.exists(part) and 'ETag' in part_meta:
+    offset = os.path.getsize(part)
+    request.add_header('Range', 'bytes=' + str(offset) + '-')
+    request.add_header('If-Range', part_meta['ETag'])
+
+  try:
+    response = urllib2.urlopen(request)
+  except urllib2.HTTPError, error:
+    if error.code == 304:
+      return True
+    if error.code != 416:
+      raise
+    # The partial download is complete or invalid; start over.
+    ou.IgnoreOSError(os.remove, part)
+    return _DownloadTable(url, name, meta)
+
+  try:
+    validators = _GetValidators(response)
+    content_range = response.info().getheader('Content-Range')
+    if (getattr(response, 'code', 200) == 206 and content_range and
+        content_range.startswith('bytes ' + str(offset) + '-')):
+      output = open(part, 'ab')
+    else:
+      output = open(part, 'wb')
+      if 'ETag' in validators:
+        _WriteMeta(part + '.meta', validators)
+      else:
+        ou.IgnoreOSError(os.remove, part + '.meta')
+    try:
+      while True:
+        chunk = response.read(_CHUNK_SIZE)
+        if not chunk:  break
+        output.write(chunk)
+    finally:
+      output.close()
+  finally:
+    response.close()
+
+  os.rename(part, name)
+  ou.IgnoreOSError(os.remove, part + '.meta')
+  meta.clear()
+  meta.update(validators)
+  return False
+
+
+def _FetchRemoteTable(base_url, db_keys):
+  """Fetch Berkeley DB tables from a remote repository into the cache
+
+  This function brings the cached copies of the specified Berkeley DB
+  tables of an underlying repository up to date, and it returns the
+  cache directory, in which the tables are in their dbs/ locations.
+  Every table is revalidated with its own conditional request (tables
+  such as aliases change without a new release), so repeated use of an
+  unchanged underlying repository costs one 304 response per table.
+  If something goes wrong, it raises EnvironmentError.
+  """
 
   for key in db_keys:
     if key not in _DB_NAMES:
       lg.error('Unknown database table ' + key)
       raise EnvironmentError
 
+  digest = cu.HashString(base_url, ['sha1'])[1]['sha1']
+  cache_dir = os.path.join(_REMOTE_CACHE_DIR, digest)
+  ou.MakeDirs(os.path.join(cache_dir, 'dbs'))
+
   for key in db_keys:
+    name = os.path.join(cache_dir, _DB_NAMES[key])
+    meta = _ReadMeta(name + '.meta')
     try:
-      db = urllib2.urlopen(os.path.join(base_url, _DB_NAMES[key]))
-    except urllib2.URLError, mesg:
-      lg.error('Cannot fetch releases.db due to ' + str(mesg))
+      _DownloadTable(os.path.join(base_url, _DB_NAMES[key]), name, meta)
+    except (urllib2.URLError, IOError), mesg:
+      lg.error('Cannot fetch ' + _DB_NAMES[key] + ' due to ' + str(mesg))
       raise EnvironmentError
-    output = file(_DB_NAMES[key], 'wb')
-    output.write(db.read())
-    output.close()
-    db.close()
+    _WriteMeta(name + '.meta', meta)
+  return cache_dir
+
+
+def _GetRemoteMark(cache_dir, db_keys):
+  """Get the high-water mark of cached underlying repository tables
+
+  The mark consists of the HTTP validators of the cached tables, so it
+  changes whenever any of the tables changes.  The return value is None
+  if some table has no validator (e.g., it came from a file: URL).
+  """
+
+  mark = []
+  for key in db_keys:
+    meta = _ReadMeta(os.path.join(cache_dir, _DB_NAMES[key]) + '.meta')
+    validator = meta.get('ETag', meta.get('Last-Modified'))
+    if validator is None:
+      return None
+    mark.append(key + ' ' + validator)
+  return '\n'.join(mark)
+
+
+def _StepCursor(cursor, first=False):
+  """Move a raw Berkeley DB cursor and return the record (or None)
+  """
+
+  try:
+    if first:
+      return cursor.first()
+    return cursor.next()
+  except KeyError:
+    return None
+
+
+def _MergeTable(local, remote, merge):
+  """Merge a remote table into a local table in one sorted pass
+
+  This function walks the local and the remote BTree tables in key
+  order with a cursor each, like a merge join.  For each remote record
+  it calls merge(local_value, remote_value), where local_value is None
+  if the key is not in the local table, and it writes the return value
+  into the local table unless it is None (which means no change).  The
+  function returns the number of records written.
+  """
+
+  local_cursor = local.db.cursor()
+  remote_cursor = remote.db.cursor()
+  written = 0
+  try:
+    local_record = _StepCursor(local_cursor, True)
+    remote_record = _StepCursor(remote_cursor, True)
+    while remote_record is not None:
+      key, value = remote_record
+      while local_record is not None and local_record[0] < key:
+        local_record = _StepCursor(local_cursor)
+      existing = None
+      if local_record is not None and local_record[0] == key:
+        existing = local_record[1]
+      merged = merge(existing, value)
+      if merged is not None:
+        local.db.put(key, merged)
+        written = written+1
+      remote_record = _StepCursor(remote_cursor)
+  finally:
+    remote_cursor.close()
+    local_cursor.close()
+  return written
+
+
+def _MergeNewKey(existing, value):
+  """Merge function that only adds keys missing from the local table
+  """
+
+  if existing is None:
+    return value
+  return None
+
+
+def _MergeValueList(existing, value):
+  """Merge function that unions ', '-separated value lists
+  """
+
+  if existing is None:
+    return value
+  known = dict.fromkeys(existing.split(', '))
+  added = [item for item in value.split(', ') if item not in known]
+  if not added:
+    return None
+  return existing + ', ' + ', '.join(added)
 
 
 def FetchUnderlyingRelease(base_url, release):
@@ -154,8 +411,6 @@ def FetchUnderlyingRelease(base_url, release):
   """
 
   def DoFetch():
-    db_keys = ['releases', 'aliases']
-    _FetchRemoteTable(base_url, db_keys)
     return RunWithDB(db_keys, DoExtract)
 
   def DoExtract(_arg, dbs):
@@ -165,7 +420,8 @@ def FetchUnderlyingRelease(base_url, release):
     release_key = au.LookupAlias(alias_db, release_db, release)
     return release_db[track + '/' + release_key].split(', ')
 
-  return ou.RunInTempDir(DoFetch)
+  db_keys = ['releases', 'aliases']
+  return ou.RunInDir(_FetchRemoteTable(base_url, db_keys), DoFetch)
 
 
 def ImportUnderlyingTables(base_url, underlying):
@@ -174,7 +430,9 @@ def ImportUnderlyingTables(base_url, underlying):
   This function fetches the pkg_deps and the file_pkg Berkeley DB
   tables of the underlying repository and incorporates it into the
   corresponding table in this repository.  This data import allows us
-  to perform cross-repository dependency checking.
+  to perform cross-repository dependency checking.  The imports table
+  records the high-water mark of the last import from each underlying
+  repository, so that unchanged tables are not merged again.
   """
 
   def DoTestMissing(_arg, dbs):
@@ -186,25 +444,28 @@ def ImportUnderlyingTables(base_url, underlying):
 
   def DoImportWithDB(_arg, dbs):
     def DoImport():
-      _FetchRemoteTable(base_url, dbs_to_import)
       return RunWithDB(dbs_to_import, DoExtract, dbs)
-    ou.RunInTempDir(DoImport)
+    cache_dir = _FetchRemoteTable(base_url, dbs_to_import)
+    mark = _GetRemoteMark(cache_dir, dbs_to_import)
+    imports = dbs['imports']
+    if mark is not None and imports.get(base_url) == mark:
+      lg.info('Dependency data from ' + base_url + ' already imported')
+      return
+    ou.RunInDir(cache_dir, DoImport)
+    if mark is not None:
+      imports[base_url] = mark
 
   def DoExtract(dbs, remote_dbs):
-    deps = dbs['pkg_deps']
-    files = dbs['file_pkg']
-    remote_deps = remote_dbs['pkg_deps']
-    remote_files = remote_dbs['file_pkg']
-    for nva in remote_deps:
-      if nva in deps:  continue
-      deps[nva] = remote_deps[nva]
-    for nva in remote_files:
-      AppendEntry(files, nva, remote_files[nva])
+    written = _MergeTable(dbs['pkg_deps'], remote_dbs['pkg_deps'],
+                          _MergeNewKey)
+    written = written + _MergeTable(dbs['file_pkg'], remote_dbs['file_pkg'],
+                                    _MergeValueList)
+    lg.info('Imported ' + str(written) + ' records from ' + base_url)
 
   dbs_to_import = ['pkg_deps', 'file_pkg']
   if RunWithDB(['pkg_deps'], DoTestMissing):
     lg.info('Importing dependency data from ' + base_url)
-    RunWithDB(dbs_to_import, DoImportWithDB)
+    RunWithDB(dbs_to_import + ['imports'], DoImportWithDB)
 
 
 def main(name):
@@ -218,7 +479,7 @@ def main(name):
   lu.SetLogConsole()
   try:
     db = bsddb.btopen(name, 'r', cachesize=_CACHE_SIZE)
-    for key in db:  print key + ':\n' + db[key] + '\n'
+    for key, value in IterateTable(db):  print key + ':\n' + value + '\n'
     db.close()
   except bsddb.db.DBNoSuchFileError:
     lg.error('Berkeley DB file ' + name + ' does not exist')
@@ -0,0 +1,274 @@
+#!/usr/bin/python
+#
+# Copyright 2006 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""Contents index generation functions
+
+The contents_utils module contains utility functions for generating
+the Contents-<arch>.gz files (used by apt-file) of a release from the
+file_pkg Berkeley DB table.  Generated files are cached by package set
+so that later releases can reuse or incrementally update them, and the
+cache is pruned to the package sets that the latest releases use.
+"""
+
+__author__ = 'cklin@google.com (Chuan-Kai Lin)'
+
+import gzip
+import logging as lg
+import os
+import bsddb_utils as bu
+import crypto_utils as cu
+import deb_utils as du
+import os_utils as ou
+import publish_utils as pb
+
+
+_CACHE_DIR = 'cache/contents'
+
+
+# A Contents file is updated from the one of the previous release only
+# if no more than this many packages were added; otherwise it is cheaper
+# to regenerate it in one pass over file_pkg.
+
+_MERGE_LIMIT = 200
+
+
+def _GetCacheName(nvas):
+  """Return the cache file name for the Contents of a package set
+  """
+
+  digest = cu.HashString('\n'.join(sorted(nvas)), ['sha1'])[1]['sha1']
+  return os.path.join(_CACHE_DIR, digest + '.gz')
+
+
+def _GetLocation(nva, pkg_info):
+  """Return the section/name location of a package in Contents
+  """
+
+  section = 'unknown'
+  for line in pkg_info[nva].splitlines():
+    if line.startswith('Section: '):
+      section = line.split(' ', 1)[1]
+      break
+  return section + '/' + nva.split('_')[0]
+
+
+def _GetFileName(nva, pkg_info):
+  """Return the pool pathname of a binary package
+  """
+
+  for line in pkg_info[nva].splitlines():
+    if line.startswith('Filename: '):
+      return line.split(' ', 1)[1]
+  return None
+
+
+def _FormatLine(path, locations):
+  """Format one line of a Contents file
+  """
+
+  return path.ljust(59) + ' ' + ','.join(locations) + '\n'
+
+
+def _ParseLine(line):
+  """Split a Contents file line into pathname and locations
+  """
+
+  path, locations = line.rstrip('\n').rsplit(None, 1)
+  return path, locations.split(',')
+
+
+def _OpenCacheFile(name):
+  """Open a temporary file that will become the named cache file
+
+  The file is written with ou.GzipWriter, whose header carries neither
+  a file name nor a timestamp, so the same contents always compress to
+  the same bytes (and the same by-hash names).
+  """
+
+  if not os.path.isdir(_CACHE_DIR):
+    os.makedirs(_CACHE_DIR, 0755)
+  return ou.GzipWriter(name + '.new')
+
+
+def _CloseCacheFile(name, output):
+  """Close and move a completed cache file into place
+  """
+
+  output.close()
+  os.rename(name + '.new', name)
+
+
+def _ScanContents(scan, targets, pkg_info, file_pkg):
+  """Generate Contents files in one streaming pass over file_pkg
+
+  This function generates the Contents files for the (component,
+  architecture) keys in the scan dictionary, which maps each key to
+  its cache file name.  The file_pkg table is iterated in key order,
+  so the lines come out sorted by pathname and only the owner index of
+  the release packages is held in memory.
+  """
+
+  owners = {}
+  outputs = {}
+  for key in scan:
+    outputs[key] = _OpenCacheFile(scan[key])
+    for nva in targets[key]:
+      if nva not in owners:
+        owners[nva] = _GetLocation(nva, pkg_info), []
+      owners[nva][1].append(key)
+
+  for path, value in bu.IterateTable(file_pkg):
+    if path == '.':  continue
+    found = {}
+    for nva in value.split(', '):
+      if nva not in owners:  continue
+      location, keys = owners[nva]
+      for key in keys:
+        found.setdefault(key, []).append(location)
+    for key in found:
+      outputs[key].write(_FormatLine(path, sorted(found[key])))
+
+  for key in scan:
+    _CloseCacheFile(scan[key], outputs[key])
+
+
+def _MergeContents(name, nvas, old_nvas, pkg_info):
+  """Generate a Contents file from the one of a previous release
+
+  This function derives the Contents file of a package set from the
+  cached Contents file of a previous package set.  It drops the
+  locations of removed packages, reads the file lists of the added
+  packages from their package files, and merges the sorted additions
+  into the old file line by line.  It returns False (and generates
+  nothing) if the old file is not available or if too many packages
+  were added for the merge to pay off.
+  """
+
+  if old_nvas is None:
+    return False
+  old_name = _GetCacheName(old_nvas)
+  if not os.path.exists(old_name):
+    return False
+
+  new_dict = dict.fromkeys(nvas)
+  old_dict = dict.fromkeys(old_nvas)
+  added = [nva for nva in nvas if nva not in old_dict]
+  if len(added) > _MERGE_LIMIT:
+    return False
+
+  removed = {}
+  for nva in old_nvas:
+    if nva not in new_dict:
+      removed[_GetLocation(nva, pkg_info)] = None
+  for nva in nvas:
+    if nva in old_dict:
+      removed.pop(_GetLocation(nva, pkg_info), None)
+
+  additions = []
+  for nva in added:
+    filename = _GetFileName(nva, pkg_info)
+    if filename is None:
+      return False
+    try:
+      contents = du.ParseDebInfo(os.path.abspath(filename))[0]
+    except EnvironmentError:
+      return False
+    location = _GetLocation(nva, pkg_info)
+    for path in contents:
+      if path != '.':
+        additions.append((path, location))
+  additions.sort()
+  additions.append((None, None))
+
+  def WriteAdditions(path, locations):
+    while additions[index[0]][0] == path:
+      locations.append(additions[index[0]][1])
+      index[0] = index[0]+1
+    if locations:
+      output.write(_FormatLine(path, sorted(locations)))
+
+  index = [0]
+  output = _OpenCacheFile(name)
+  old = gzip.GzipFile(old_name, 'rb')
+  try:
+    for line in old:
+      path, locations = _ParseLine(line)
+      while (additions[index[0]][0] is not None and
+             additions[index[0]][0] < path):
+        WriteAdditions(additions[index[0]][0], [])
+      kept = [loc for loc in locations if loc not in removed]
+      WriteAdditions(path, kept)
+    while additions[index[0]][0] is not None:
+      WriteAdditions(additions[index[0]][0], [])
+  finally:
+    old.close()
+  _CloseCacheFile(name, output)
+  return True
+
+
+def PruneCache(package_lists):
+  """Remove the cached Contents files of all other package sets
+
+  This function keeps the cache files of the given package lists and
+  removes every other completed file in the cache directory.
+  """
+
+  if not os.path.isdir(_CACHE_DIR):
+    return
+  keep = {}
+  for nvas in package_lists:
+    keep[_GetCacheName(nvas)] = None
+  for name in os.listdir(_CACHE_DIR):
+    name = os.path.join(_CACHE_DIR, name)
+    if name.endswith('.gz') and name not in keep:
+      ou.IgnoreOSError(os.remove, name)
+
+
+def WriteContentsFiles(release_dir, targets, previous, pkg_info, file_pkg):
+  """Write the Contents-<arch>.gz files of a release
+
+  The targets argument maps each (component, architecture) pair of
+  the release to its list of binary packages, and previous does the
+  same for the previous release of the track (or is empty).  For each
+  pair, this function reuses the cached Contents file if the package
+  set has been seen before, updates the previous release's file if
+  only a few packages changed, and otherwise generates the file from
+  file_pkg.  The results go to release_dir/comp/Contents-arch.gz, and
+  the return value is the list of pb.PublishFile() reports for them.
+  """
+
+  cached = {}
+  scan = {}
+  for key in targets:
+    cached[key] = _GetCacheName(targets[key])
+    if os.path.exists(cached[key]):
+      continue
+    if not _MergeContents(cached[key], targets[key],
+                          previous.get(key), pkg_info):
+      scan[key] = cached[key]
+
+  if scan:
+    lg.info('Scanning file_pkg for ' + str(len(scan)) +
+            ' Contents files')
+    _ScanContents(scan, targets, pkg_info, file_pkg)
+
+  reports = []
+  for comp, arch in targets:
+    output = os.path.join(release_dir, comp, 'Contents-' + arch + '.gz')
+    reports.append(pb.PublishFile(output, cached[(comp, arch)]))
+  return reports
@@ -1,4 +1,4 @@
-#!/usr/bin/python2.4
+#!/usr/bin/python
 #
 # Copyright 2006 Google Inc.
 #
@@ -25,75 +25,224 @@ verification and release publishing procedures.
 
 __author__ = 'cklin@google.com (Chuan-Kai Lin)'
 
+import hashlib
 import logging as lg
 import os
-import subprocess as sp
+import logging_utils as lu
 import os_utils as ou
 
 
-def VerifyMD5Hash(md5_dict):
-  """Verify the MD5 hash value of a list of files
+_CHUNK_SIZE = 1048576
 
-  This function accepts a dictionary that maps file names to their MD5
-  hash values (as hexadecimal strings) and verifies that those files
-  have the expected MD5 hash values.  It does so by writing the MD5
-  information to a temporary file and invoking the md5sum program.
+
+# These are the .changes fields that list uploaded files along with
+# their sizes and hash values, indexed by hash algorithm.
+
+_CHECKSUM_FIELDS = { 'md5':    'Files',
+                     'sha1':   'Checksums-Sha1',
+                     'sha256': 'Checksums-Sha256' }
+
+
+def NewHash(algo):
+  """Create a hash object for the given algorithm name
   """
 
-  def DoVerify(md5_file, fobj):
-    for name in md5_dict:
-      fobj.write(md5_dict[name]+'  '+name+'\n')
-    fobj.close()
-    if ou.SpawnProgram(['/usr/bin/md5sum', '-c', md5_file]):
-      lg.error('MD5 hash validation failed')
-      raise EnvironmentError
+  return hashlib.new(algo)
+
+
+def HashStream(fin, algos, fout=None):
+  """Compute the size and hash values of a file object in one pass
+
+  This function reads the input file object in fixed-size chunks and
+  feeds each chunk to one hash object per requested algorithm, and it
+  also copies the chunk to fout if it is given.  The return value is
+  the number of bytes read and a dictionary that maps each algorithm
+  name to the hexadecimal hash value.
+  """
+
+  hashes = {}
+  for algo in algos:
+    hashes[algo] = NewHash(algo)
+
+  size = 0
+  while True:
+    chunk = fin.read(_CHUNK_SIZE)
+    if not chunk:  break
+    size = size + len(chunk)
+    for algo in algos:
+      hashes[algo].update(chunk)
+    if fout is not None:
+      fout.write(chunk)
+
+  digests = {}
+  for algo in algos:
+    digests[algo] = hashes[algo].hexdigest()
+  lu.CountEvent('bytes hashed', size)
+  return size, digests
+
+
+def HashFile(name, algos):
+  """Compute the size and hash values of a file (see HashStream)
+  """
+
+  f = open(name, 'rb')
+  try:
+    return HashStream(f, algos)
+  finally:
+    f.close()
+
+
+def HashString(string, algos):
+  """Compute the size and hash values of a string (see HashStream)
+  """
 
-  ou.RunWithTempFile(DoVerify)
+  digests = {}
+  for algo in algos:
+    h = NewHash(algo)
+    h.update(string)
+    digests[algo] = h.hexdigest()
+  lu.CountEvent('bytes hashed', len(string))
+  return len(string), digests
 
 
 def GetMD5Hash(name):
   """Compute the MD5 hash value of a file as a hex string
   """
 
-  args = ['/usr/bin/md5sum', name]
-  child = sp.Popen(args, stdout=sp.PIPE, stderr=sp.PIPE)
-  child.wait()
-  line = child.stdout.readline()
-  if not line:
-    lg.error(child.stderr.readline())
-    raise ValueError
-  return line.split()[0]
+  return HashFile(name, ['md5'])[1]['md5']
 
 
 def GetSHA1Hash(name):
   """Compute the SHA1 hash value of a file as a hex string
   """
 
-  args = ['/usr/bin/sha1sum', name]
-  child = sp.Popen(args, stdout=sp.PIPE, stderr=sp.PIPE)
-  child.wait()
-  line = child.stdout.readline()
-  if not line:
-    lg.error(child.stderr.readline())
-    raise ValueError
-  return line.split()[0]
+  return HashFile(name, ['sha1'])[1]['sha1']
 
 
-def VerifySignature(name):
-  """Verify embedded signature in a file with gpgv
+def ParseChecksums(changes_dict):
+  """Collect the sizes and hash values of files in an upload
+
+  This function reads the Files, Checksums-Sha1, and Checksums-Sha256
+  fields of a parsed .changes file and returns a dictionary that maps
+  each uploaded file name to a (size, digests) pair, where digests
+  maps hash algorithm names to hexadecimal hash values.  It raises
+  ValueError if the fields disagree on the size of a file.
+  """
+
+  checksums = {}
+  for algo in _CHECKSUM_FIELDS:
+    for spec_string in changes_dict.get(_CHECKSUM_FIELDS[algo], []):
+      spec = spec_string.split()
+      if not spec:  continue
+
+      # Files lines carry section and priority before the file name;
+      # the Checksums-* lines have only the hash, size, and name.
+
+      digest, size, name = spec[0], spec[1], spec[-1]
+      if name not in checksums:
+        checksums[name] = size, {}
+      if checksums[name][0] != size:
+        lg.error('Upload lists conflicting sizes for ' + name)
+        raise ValueError
+      checksums[name][1][algo] = digest.lower()
+  return checksums
+
+
+def MoveVerifyFiles(dir_from, dir_to, checksums):
+  """Move uploaded files and verify their sizes and hash values
+
+  This function moves the files listed in the checksums dictionary
+  (see ParseChecksums) with ou.CopyDeleteFiles() and computes the
+  size and all listed hash values of each file as it is being copied,
+  so that each file is read exactly once.  It raises EnvironmentError
+  if any file does not match the sizes and hash values given.
   """
 
-  if ou.SpawnProgram(['/usr/bin/gpgv', name]):
-    lg.error('Cannot verify signature in file ' + name)
+  def DoCopy(fin, fout):
+    return HashStream(fin, algos, fout)
+
+  algos = {}
+  for name in checksums:
+    for algo in checksums[name][1]:
+      algos[algo] = None
+  algos = algos.keys()
+
+  results = ou.CopyDeleteFiles(dir_from, dir_to, checksums, DoCopy)
+  good = True
+  for name in sorted(checksums):
+    size, digests = results[name]
+    if str(size) != checksums[name][0]:
+      lg.error('Size of ' + name + ' does not match upload')
+      good = False
+      continue
+    for algo in digests:
+      if algo not in checksums[name][1]:  continue
+      if digests[algo] != checksums[name][1][algo]:
+        lg.error(algo.upper() + ' hash of ' + name +
+                 ' does not match upload')
+        good = False
+  if not good:
+    lg.error('Upload checksum validation failed')
     raise EnvironmentError
 
 
-def MakeReleaseSignature(name):
-  """Make a detached signature file with .gpg extension
+# Signature verification runs unattended (e.g., from cron), so a gpg
+# process that hangs is killed after this many seconds.
+
+_VERIFY_TIMEOUT = 600
+
+# At most this many gpgv processes run at the same time, so that a long
+# incoming queue does not run out of file descriptors.
+
+_VERIFY_JOBS = 16
+
+
+def VerifySignatures(names):
+  """Verify embedded signatures in a batch of files
+
+  This function verifies each of the given files (.changes or .dsc)
+  with its own gpgv process, running up to _VERIFY_JOBS processes in
+  parallel, so that every verdict belongs to a specific file.  It
+  returns the list of files that verified; if gpgv cannot be run at
+  all, no file verifies.
   """
 
-  ou.SpawnProgram(['/usr/bin/gpg', '--use-agent', '-a', '-b', name])
+  names = list(names)
+  verified = []
+  arg_lists = [['/usr/bin/gpgv', name] for name in names]
   try:
-    os.rename(name + '.asc', name + '.gpg')
-  except OSError:
-    lg.error('Fail to complete release signing operation')
+    results = ou.SpawnPrograms(arg_lists, _VERIFY_TIMEOUT,
+                               limit=_VERIFY_JOBS)
+  except EnvironmentError, mesg:
+    lg.error('Cannot run gpgv: ' + str(mesg))
+    return verified
+  for name, retval in zip(names, results):
+    if retval:
+      lg.error('Cannot verify signature in file ' + name)
+    else:
+      verified.append(name)
+  return verified
+
+
+def MakeReleaseSignature(name):
+  """Sign a Release file with both detached and inline signatures
+
+  This function writes the detached signature of the given file to
+  name.gpg and a clear-signed copy of it to name.inline.  Both
+  signatures are made back to back through the same gpg agent.  The
+  caller renames the outputs into place (as Release.gpg and InRelease)
+  after the Release file itself.  The function returns True if both
+  outputs were written; otherwise it removes them and returns False.
+  """
+
+  outputs = [(['-a', '-b'], name + '.gpg'),
+             (['--clearsign'], name + '.inline')]
+
+  for flags, output in outputs:
+    args = ['/usr/bin/gpg', '--use-agent', '--yes', '-o', output]
+    if ou.SpawnProgram(args + flags + [name]):
+      for _flags, partial in outputs:
+        ou.IgnoreOSError(os.remove, partial)
+      lg.error('Fail to complete release signing operation')
+      return False
+  return True
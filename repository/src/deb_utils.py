@@ -1,4 +1,4 @@
-#!/usr/bin/python2.4
+#!/usr/bin/python
 #
 # Copyright 2006 Google Inc.
 #
@@ -33,6 +33,7 @@ import sys
 import tarfile
 import bsddb_utils as bu
 import crypto_utils as cu
+import logging_utils as lu
 import os_utils as ou
 import package_utils as pu
 
@@ -147,10 +148,14 @@ def ParseDependencyTable(dep_table):
   """Parse the pkg_deps Berkeley DB table to a dictionary
   """
 
-  dep_dict = {}
-  for nva in dep_table:
-    dep_dict[nva] = _ParseDependencyString(dep_table[nva])
-  return dep_dict
+  def DoParse():
+    dep_dict = {}
+    for nva in dep_table:
+      dep_dict[nva] = _ParseDependencyString(dep_table[nva])
+    lu.CountEvent('packages parsed', len(dep_dict))
+    return dep_dict
+
+  return lu.RunWithSpan('ParseDependencyTable', DoParse)
 
 
 def BuildDebInfoText(name, attr_dict):
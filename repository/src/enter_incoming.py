@@ -1,4 +1,4 @@
-#!/usr/bin/python2.4
+#!/usr/bin/python
 #
 # Copyright 2006 Google Inc.
 #
@@ -36,29 +36,19 @@ import bsddb_utils as bu
 import crypto_utils as cu
 import index_pool as ip
 import logging_utils as lu
+import metrics_utils as mu
 import os_utils as ou
 import package_utils as pu
 import release_utils as ru
 import setting_utils as su
 
 
-def _GetUploadedFiles(changes_dict):
-  """Get the list of uploaded files from the .changes file
-
-  This function returns a dictionary that maps each file in the upload
-  to the hexadecimal string of its MD5 hash value.  The input is a
-  parsed attribute string of the .changes file.
-  """
-
-  md5sum = {}
-  for spec_string in changes_dict['Files']:
-    spec = spec_string.split()
-    md5sum[spec[4]] = spec[0]
-  return md5sum
-
-
-def _ProcessChangesFile(changes, repo_dir, lists, dbs):
+def _ProcessChangesFile(changes, repo_dir, lists, dbs, verified):
   """Process a .changes file which represents an upload
+
+  The .changes file should have been moved out of the incoming
+  directory by the caller, and verified is the dictionary of .changes
+  files whose signatures have been checked with cu.VerifySignatures().
   """
 
   src_names, pkg_names = lists
@@ -66,17 +56,18 @@ def _ProcessChangesFile(changes, repo_dir, lists, dbs):
   src_info = dbs['src_info']
   pool_pkg = dbs['pool_pkg']
 
-  # Remove the .changes file from the incoming directory and check its
-  # signature (raise EnvironmentError if not properly signed).
+  # Reject the upload (raise EnvironmentError) if the .changes file
+  # is not properly signed.
 
-  ou.CopyDeleteFiles(incoming_dir, '.', [changes])
-  cu.VerifySignature(changes)
+  if changes not in verified:
+    lg.error('Cannot verify signature in file ' + changes)
+    raise EnvironmentError
 
   # Parse the .changes file into a Python dictionary.
 
-  lines = ou.RunWithFileInput(pu.StripSignature, changes)
+  lines = ou.RunWithFileBuffer(pu.StripSignature, changes)
   changes_dict = pu.ParseAttributes(lines)
-  md5_dict = _GetUploadedFiles(changes_dict)
+  checksums = cu.ParseChecksums(changes_dict)
   version = changes_dict['Version'][0]
   source_pkg = changes_dict['Source'][0]
 
@@ -106,7 +97,7 @@ def _ProcessChangesFile(changes, repo_dir, lists, dbs):
   has_tar = False
   has_orig_tar = False
 
-  for name in md5_dict:
+  for name in checksums:
     if name in pool_pkg:
       lg.error('File ' + name + ' is already in the pool')
       raise EnvironmentError
@@ -163,17 +154,16 @@ def _ProcessChangesFile(changes, repo_dir, lists, dbs):
         raise EnvironmentError
 
   # Move rest of the uploaded files from incoming to the current
-  # (temp) directory and check their MD5 hash value (raise
-  # EnvironmentError if the hash values disagree).
+  # (temp) directory and check their sizes and hash values while they
+  # are being copied (raise EnvironmentError if they disagree).
 
-  ou.CopyDeleteFiles(incoming_dir, '.', md5_dict)
-  cu.VerifyMD5Hash(md5_dict)
+  cu.MoveVerifyFiles(incoming_dir, '.', checksums)
 
   # Move uploaded files (along with .changes) into the pool.
 
   pool_loc = pu.GetPathInPool(source_pkg)
   pool_dir = os.path.join(repo_dir, pool_loc)
-  ou.CopyDeleteFiles('.', pool_dir, md5_dict)
+  ou.CopyDeleteFiles('.', pool_dir, checksums)
   ou.CopyDeleteFiles('.', pool_dir, [changes])
 
   # Compile the list of source package files (src_names) and binary
@@ -181,7 +171,7 @@ def _ProcessChangesFile(changes, repo_dir, lists, dbs):
   # There is no need to return these lists because they are passed in
   # by reference.
 
-  for name in md5_dict:
+  for name in checksums:
     if name.endswith('.dsc'):
       src_names.append(os.path.join(pool_loc, name))
     elif name.endswith('.deb') or name.endswith('.udeb'):
@@ -189,6 +179,7 @@ def _ProcessChangesFile(changes, repo_dir, lists, dbs):
 
 
 def main(repo_dir):
+  start = time.time()
 
   def DoProcessWithDB(_arg, dbs):
     """Incoming processing operations with Berkeley DB tables
@@ -199,8 +190,9 @@ def main(repo_dir):
       """
 
       processed = False
-      files = os.listdir(os.path.join(repo_dir, 'incoming'))
-      for name in files:
+      incoming_dir = os.path.join(repo_dir, 'incoming')
+      uploads = []
+      for name in os.listdir(incoming_dir):
 
         # Ignore all files that does not have the .changes extension
         # and all files whose mtime is less than 5 seconds ago (to
@@ -208,17 +200,36 @@ def main(repo_dir):
 
         if not name.endswith('.changes'):
           continue
-        changes_pathname = os.path.join(repo_dir, 'incoming', name)
+        changes_pathname = os.path.join(incoming_dir, name)
         if time.time()-os.path.getmtime(changes_pathname) <= 5:
           continue
 
-        # Process an upload and map exceptions to error messages.
+        # Remove the .changes file from the incoming directory so that
+        # the uploader can no longer modify it.
 
         processed = True
+        try:
+          ou.CopyDeleteFiles(incoming_dir, '.', [name])
+          uploads.append(name)
+        except IOError:
+          lg.error('Failed to process ' + name + ' due to I/O error.')
+
+      # Check the signatures of all .changes files in parallel.
+
+      verified = dict.fromkeys(cu.VerifySignatures(uploads))
+      results = {'accepted': 0, 'rejected': 0}
+
+      for name in uploads:
+
+        # Process an upload and map exceptions to error messages.
+
         lg.info('Start processing ' + name + ' upload...')
+        upload_start = time.time()
+        result = 'rejected'
         try:
-          _ProcessChangesFile(name, repo_dir, new_files, dbs)
+          _ProcessChangesFile(name, repo_dir, new_files, dbs, verified)
           lg.info('Processing of ' + name + ' succeeded.')
+          result = 'accepted'
         except EnvironmentError:
           lg.error('Failed to process ' + name)
         except ValueError:
@@ -227,13 +238,22 @@ def main(repo_dir):
           lg.error('Failed to process ' + name + ' due to I/O error.')
         except OSError:
           lg.error('Failed to process ' + name + ' due to OS error.')
+        results[result] = results[result] + 1
+        mu.ObserveMetric('upload_duration_seconds',
+                         time.time()-upload_start)
         lg.info('---- End of upload processing ----')
+
+      for result in results:
+        mu.SetMetric('uploads', results[result], {'result': result})
+      backlog = [name for name in os.listdir(incoming_dir)
+                 if name.endswith('.changes')]
+      mu.SetMetric('incoming_backlog', len(backlog))
       return processed
 
     return ou.RunInTempDir(DoProcessInTempDir)
 
   def DoSnapshot(_arg, dbs):
-    return ru.SelectLatestPackages(dbs['pkg_info'])
+    return ru.ListLatestPackages(dbs['pkg_latest'], dbs['pkg_info'])
 
   os.chdir(repo_dir)
 
@@ -260,15 +280,16 @@ def main(repo_dir):
   if processed:
     if new_files[0] or new_files[1]:
       bu.RunWithDB(None, ip.IndexPool, new_files)
-      latest = bu.RunWithDB(['pkg_info'], DoSnapshot)
+      latest = bu.RunWithDB(['pkg_info', 'pkg_latest'], DoSnapshot)
       ru.GenerateReleaseList('snapshot', latest)
     if not (msg_from is None or msg_to is None):
       subject = 'Incoming processing logs, ' + time.asctime()
       lu.MailLog(host, msg_from, msg_to, subject)
+  mu.WriteMetrics('enter_incoming', start)
 
 
 if __name__ == '__main__':
   if len(sys.argv) >= 2:
-    main(os.path.abspath(sys.argv[1]))
+    lu.RunProfiled(main, os.path.abspath(sys.argv[1]))
   else:
-    main(os.getcwd())
+    lu.RunProfiled(main, os.getcwd())
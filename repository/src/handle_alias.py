@@ -1,4 +1,4 @@
-#!/usr/bin/python2.4
+#!/usr/bin/python
 #
 # Copyright 2006 Google Inc.
 #
@@ -40,13 +40,13 @@ def _DoRefresh(_arg, dbs):
 def _DoUpdate((alias, release), dbs):
   alias_db = dbs['aliases']
   release_db = dbs['releases']
-  au.UpdateAlias(alias_db, release_db, alias, release)
+  au.UpdateAlias(alias_db, dbs['alias_log'], release_db, alias, release)
   au.RefreshAlias(alias_db)
 
 
 def _DoShowLog(alias, dbs):
   alias_db = dbs['aliases']
-  au.ShowAliasHistory(alias_db, alias)
+  au.ShowAliasHistory(alias_db, dbs['alias_log'], alias)
 
 
 def main():
@@ -64,16 +64,17 @@ def main():
       sys.exit()
     alias = sys.argv[2]
     release = sys.argv[3]
-    bu.RunWithDB(['aliases', 'releases'], _DoUpdate, (alias, release))
+    bu.RunWithDB(['aliases', 'alias_log', 'releases'], _DoUpdate,
+                 (alias, release))
   elif (sys.argv[1]) == 'log':
     if len(sys.argv) != 3:
       lg.error('update needs an argument: alias')
       sys.exit()
     alias = sys.argv[2]
-    bu.RunWithDB(['aliases'], _DoShowLog, alias)
+    bu.RunWithDB(['aliases', 'alias_log'], _DoShowLog, alias)
   else:
     lg.error(sys.argv[1] + ' is not a valid command')
 
 
 if __name__ == '__main__':
-  main()
+  lu.RunProfiled(main)
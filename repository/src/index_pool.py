@@ -1,4 +1,4 @@
-#!/usr/bin/python2.4
+#!/usr/bin/python
 #
 # Copyright 2006 Google Inc.
 #
@@ -9,7 +9,7 @@
 # This program is distributed in the hope that it will be useful, but
 # WITHOUT ANY WARRANTY; without even the implied warranty of
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
-5B# General Public License for more details.
+# General Public License for more details.
 #
 # You should have received a copy of the GNU General Public License
 # along with this program; if not, write to the Free Software
@@ -27,11 +27,14 @@ indexed, so the indexing operation is practically idempotent.
 __author__ = 'cklin@google.com (Chuan-Kai Lin)'
 
 import logging as lg
+import optparse
 import os
 import sys
+import time
 import bsddb_utils as bu
 import deb_utils as du
 import logging_utils as lu
+import metrics_utils as mu
 import os_utils as ou
 import package_utils as pu
 import release_utils as ru
@@ -66,10 +69,11 @@ def IndexPool((src_names, pkg_names), dbs):
 
     lg.info('Indexing ' + name)
     pool_pkg[src] = str(os.stat(name).st_size)
-    lines = ou.RunWithFileInput(pu.StripSignature, name)
+    lines = ou.RunWithFileBuffer(pu.StripSignature, name)
     attr_dict = pu.ParseAttributes(lines)
     nv = pu.GetSourceID(attr_dict)
     src_info[nv] = du.BuildSrcInfoText(name, attr_dict)
+    lu.CountEvent('source packages indexed')
     _new_package = True
 
   def IndexBinary(name):
@@ -98,6 +102,8 @@ def IndexPool((src_names, pkg_names), dbs):
     nva = pu.GetPackageID(attr_dict)
     pkg_info[nva] = du.BuildDebInfoText(name, attr_dict)
     pkg_deps[nva] = du.BuildDependencyString(name, attr_dict)
+    ru.UpdateLatestPackage(pkg_latest, nva)
+    lu.CountEvent('binary packages indexed')
     _new_package = True
 
     # We do not enter the debian-installer packages into file_pkg
@@ -112,34 +118,176 @@ def IndexPool((src_names, pkg_names), dbs):
   pkg_deps = dbs['pkg_deps']
   file_pkg = dbs['file_pkg']
   pool_pkg = dbs['pool_pkg']
+  pkg_latest = dbs['pkg_latest']
 
+  ru.BuildLatestPackages(pkg_latest, pkg_info)
   for name in src_names:
     IndexSource(name)
   for name in pkg_names:
     IndexBinary(name)
-  return ru.SelectLatestPackages(pkg_info)
+  return ru.ListLatestPackages(pkg_latest, pkg_info)
 
 
-def _TraversePool():
-  """Compile lists of package files in the pool hierarchy
+def _IsPackageFile(name):
+  """Test if a file name has a package file extension
   """
 
-  def DoTraverse(_arg, dir, names):
-    for name in names:
-      if name.endswith('.dsc'):
-        src_names.append(os.path.join(dir, name))
-      elif name.endswith('.deb') or name.endswith('.udeb'):
-        pkg_names.append(os.path.join(dir, name))
+  for suffix in ['.dsc', '.deb', '.udeb']:
+    if name.endswith(suffix):
+      return True
+  return False
+
+
+def _ClassifyPackageFiles(names):
+  """Split a list of pathnames into source and binary package files
+  """
 
   src_names = []
   pkg_names = []
-  os.path.walk('pool', DoTraverse, None)
+  for name in names:
+    if name.endswith('.dsc'):
+      src_names.append(name)
+    elif _IsPackageFile(name):
+      pkg_names.append(name)
   return src_names, pkg_names
 
 
-def main(repo_dir):
+# A directory modified less than this many seconds before the scan may
+# still be changing within the granularity of its mtime, so we do not
+# record it in the scan manifest.
+
+_SETTLE_TIME = 2
+
+
+def _TraversePool(pool_scan):
+  """Compile lists of package files in the pool hierarchy
+
+  This function walks through the pool/ hierarchy and lists package
+  files in directories that have changed since the last scan.  The
+  pool_scan table records, for each directory, its mtime, the number
+  of package files in it, and its subdirectories.  An unchanged
+  directory contributes no files and is not listed again; only its
+  recorded subdirectories are visited.  Since package files in the
+  pool are never modified or removed, this skips all files that have
+  already been indexed.  The function returns the package file lists
+  and the manifest updates, which the caller should write to pool_scan
+  only after the new files have been indexed.
+  """
+
+  names = []
+  updates = {}
+  skipped_dirs = 0
+  skipped_files = 0
+  now = time.time()
+  pending = ['pool']
+
+  while pending:
+    dir = pending.pop()
+    try:
+      mtime = os.stat(dir).st_mtime
+    except OSError:
+      continue
+
+    if dir in pool_scan:
+      [old_mtime, count, subdirs] = pool_scan[dir].split('\n')
+      if old_mtime == repr(mtime):
+        skipped_dirs = skipped_dirs+1
+        skipped_files = skipped_files+int(count)
+        for subdir in subdirs.split(', '):
+          if subdir:
+            pending.append(os.path.join(dir, subdir))
+        continue
+
+    subdirs = []
+    count = 0
+    for name in sorted(os.listdir(dir)):
+      path = os.path.join(dir, name)
+      if os.path.isdir(path):
+        subdirs.append(name)
+        pending.append(path)
+      elif _IsPackageFile(name):
+        names.append(path)
+        count = count+1
+
+    if now-mtime > _SETTLE_TIME:
+      updates[dir] = '\n'.join([repr(mtime), str(count),
+                                ', '.join(subdirs)])
+
+  if skipped_dirs:
+    lg.info('Skipped ' + str(skipped_files) + ' package files in ' +
+            str(skipped_dirs) + ' unchanged pool directories')
+  return _ClassifyPackageFiles(names), updates
+
+
+def _ReadFileList(name):
+  """Read a list of package files to index ('-' for standard input)
+
+  This function reads pathnames, one per line, and returns them as
+  paths relative to the repository directory.  Pathnames that are
+  outside the pool/ hierarchy or that do not name an existing file are
+  ignored with a warning.
+  """
+
+  def DoRead(lines):
+    paths = []
+    for line in lines:
+      line = line.strip()
+      if not line:  continue
+      path = os.path.normpath(os.path.join(repo_dir, line))
+      if not path.startswith(pool_dir + os.sep):
+        lg.warning('File ' + line + ' is not in the pool')
+        continue
+      if not os.path.isfile(path):
+        lg.warning('File ' + line + ' does not exist')
+        continue
+      paths.append(path[len(repo_dir)+1:])
+    return paths
+
+  repo_dir = os.getcwd()
+  pool_dir = os.path.join(repo_dir, 'pool')
+  return ou.RunWithFileInput(DoRead, name)
+
+
+def _DoIndex(file_list, dbs):
+  """Index new package files found in the pool or in file_list
+  """
+
+  if file_list is None:
+    names, updates = _TraversePool(dbs['pool_scan'])
+  else:
+    names, updates = _ClassifyPackageFiles(file_list), {}
+  packages = IndexPool(names, dbs)
+  for dir in updates:
+    dbs['pool_scan'][dir] = updates[dir]
+  return packages
+
+
+def _ParseCommandLine():
+  """Parse command line options and arguments
+  """
+
+  usage = 'usage: %prog [options] [REPOSITORY]'
+  version = 'Debmarshall 0.0'
+  parser = optparse.OptionParser(usage=usage, version=version)
+
+  parser.add_option('-f', '--files',
+                    dest='files', metavar='FILE',
+                    help='index only package files listed in FILE ' +
+                    '(- for standard input) instead of scanning the pool')
+
+  options, proper = parser.parse_args()
+  if len(proper) > 1:
+    lg.error('Only one repository directory should be given')
+    sys.exit()
+  if proper:
+    return options, os.path.abspath(proper[0])
+  return options, os.getcwd()
+
+
+def main(repo_dir, list_name=None):
   global _new_package
 
+  start = time.time()
   current_cwd = os.getcwd()
   lu.SetLogConsole()
   try:
@@ -148,10 +296,17 @@ def main(repo_dir):
       lg.error('Repository is not in tracking mode')
       sys.exit()
     try:
-      names = _TraversePool()
-      packages = bu.RunWithDB(None, IndexPool, names)
+      file_list = None
+      if list_name is not None:
+        if list_name != '-':
+          list_name = os.path.join(current_cwd, list_name)
+        file_list = _ReadFileList(list_name)
+        if file_list is None:
+          sys.exit()
+      packages = bu.RunWithDB(None, _DoIndex, file_list)
       if _new_package:
         ru.GenerateReleaseList('snapshot', packages)
+      mu.WriteMetrics('index_pool', start)
     except KeyboardInterrupt:
       lg.info('Received keyboard interrupt, terminating...')
   finally:
@@ -159,7 +314,5 @@ def main(repo_dir):
 
 
 if __name__ == '__main__':
-  if len(sys.argv) == 2:
-    main(sys.argv[1])
-  else:
-    main(os.getcwd())
+  options, repo_dir = _ParseCommandLine()
+  lu.RunProfiled(main, repo_dir, options.files)
@@ -1,4 +1,4 @@
-#!/usr/bin/python2.4
+#!/usr/bin/python
 #
 # Copyright 2006 Google Inc.
 #
@@ -21,22 +21,45 @@
 
 The logging_utils module contains utility functions for logging and
 error reporting.  The messages can go either to the standard error or
-to an email message sent to a specified recipient.
+to an email message sent to a specified recipient.  The module also
+keeps a timing report of nested phases (spans) and event counters,
+which is written next to releases and included in mailed logs.
 """
 
 __author__ = 'cklin@google.com (Chuan-Kai Lin)'
 
 import logging
 import logging.handlers as handlers
+import os
 import socket
 import cStringIO
 import email.MIMEText as mime
 import smtplib
+import time
+
+try:
+  import cProfile as profile
+except ImportError:
+  import profile
 
 
 _hdlr = None
 _sio = None
 
+# The timing report: _span_stack holds the names of the spans being
+# timed (outermost first), _span_totals maps each '/'-separated span
+# path to its [count, total seconds], and _counters maps event names
+# to their counts.
+
+_span_stack = []
+_span_totals = {}
+_counters = {}
+
+# If this environment variable is set, RunProfiled() runs the command
+# under the profiler and writes the statistics to the file it names.
+
+_PROFILE_ENV = 'DEBMARSHAL_PROFILE'
+
 
 def _ResetLog(root):
   global _hdlr
@@ -106,6 +129,8 @@ def MailLog(host, msg_from, msg_to, msg_subj):
     host = 'localhost'
 
   contents = _sio.getvalue()
+  if _span_totals or _counters:
+    contents = contents + '\nTiming report:\n' + FormatReport()
   msg = mime.MIMEText(contents)
   msg['Subject'] = msg_subj
   msg['From'] = msg_from
@@ -122,3 +147,204 @@ def MailLog(host, msg_from, msg_to, msg_subj):
   except smtplib.SMTPException, mesg:
     SetLogConsole()
     logging.error('SMTP error to ' + host + ' ' + str(mesg))
+
+
+def RunWithSpan(name, func, *args):
+  """Run a function as a named phase in the timing report
+
+  This function calls func(*args) and adds the elapsed time to the
+  span named by the names of all enclosing spans and the given name,
+  so that repeated phases (e.g., one per index file) are aggregated
+  and nested phases show up under their parents.
+  """
+
+  _span_stack.append(name)
+  path = '/'.join(_span_stack)
+  start = time.time()
+  try:
+    return func(*args)
+  finally:
+    entry = _span_totals.setdefault(path, [0, 0.0])
+    entry[0] = entry[0]+1
+    entry[1] = entry[1] + time.time()-start
+    _span_stack.pop()
+
+
+def CountEvent(name, amount=1):
+  """Add to a named counter in the timing report
+  """
+
+  _counters[name] = _counters.get(name, 0) + amount
+
+
+def GetCounters():
+  """Return a copy of the counters in the timing report
+  """
+
+  return dict(_counters)
+
+
+def ResetReport():
+  """Start a new timing report outside of any span
+
+  A forked worker process calls this function first, so that it does
+  not report the spans and counters inherited from its parent.
+  """
+
+  global _span_totals
+  global _counters
+
+  _span_stack[:] = []
+  _span_totals = {}
+  _counters = {}
+
+
+def GetReport():
+  """Return the timing report and start a new one
+
+  The return value can be passed to MergeReport() in another process
+  (e.g., the parent of a worker process).
+  """
+
+  global _span_totals
+  global _counters
+
+  report = _span_totals, _counters
+  _span_totals = {}
+  _counters = {}
+  return report
+
+
+def MergeReport(report):
+  """Merge a timing report from GetReport() into the current one
+
+  The spans in the merged report are placed under the spans that are
+  currently being timed.
+  """
+
+  totals, counters = report
+  prefix = '/'.join(_span_stack)
+  for path in totals:
+    if prefix:
+      full_path = prefix + '/' + path
+    else:
+      full_path = path
+    entry = _span_totals.setdefault(full_path, [0, 0.0])
+    entry[0] = entry[0] + totals[path][0]
+    entry[1] = entry[1] + totals[path][1]
+  for name in counters:
+    CountEvent(name, counters[name])
+
+
+def _FormatJSON(value, indent=''):
+  """Format a value made of dicts, lists, strings, and numbers as JSON
+  """
+
+  inner = indent + '  '
+  if isinstance(value, dict):
+    if not value:
+      return '{}'
+    items = [inner + _FormatJSON(str(key)) + ': ' +
+             _FormatJSON(value[key], inner) for key in sorted(value.keys())]
+    return '{\n' + ',\n'.join(items) + '\n' + indent + '}'
+  if isinstance(value, list):
+    if not value:
+      return '[]'
+    items = [inner + _FormatJSON(item, inner) for item in value]
+    return '[\n' + ',\n'.join(items) + '\n' + indent + ']'
+  if isinstance(value, (int, long, float)):
+    return repr(value)
+  escaped = str(value).replace('\\', '\\\\').replace('"', '\\"')
+  return '"' + escaped.replace('\n', '\\n') + '"'
+
+
+def FormatReport():
+  """Format the timing report as a JSON document
+
+  The spans are listed in path order, so nested spans follow their
+  parents, each with its count and total seconds.
+  """
+
+  spans = []
+  for path in sorted(_span_totals.keys()):
+    count, seconds = _span_totals[path]
+    spans.append({ 'span': path,
+                   'count': count,
+                   'seconds': round(seconds, 4) })
+  return _FormatJSON({ 'spans': spans, 'counters': _counters }) + '\n'
+
+
+def WriteReport(name):
+  """Write the timing report as a JSON file
+  """
+
+  temp = name + '.' + str(os.getpid())
+  output = open(temp, 'w')
+  try:
+    output.write(FormatReport())
+  finally:
+    output.close()
+  os.rename(temp, name)
+
+
+class _RecordHandler(logging.Handler):
+  """Logging handler that keeps (level, message) pairs in a list
+  """
+
+  def __init__(self):
+    logging.Handler.__init__(self)
+    self.records = []
+
+  def emit(self, record):
+    self.records.append((record.levelno, record.getMessage()))
+
+
+def RunWithLogCapture(func, *args):
+  """Invoke a function and capture its log messages
+
+  This function temporarily replaces the logging output with a list of
+  (level, message) pairs and returns the result of func(*args) along
+  with the list.  A worker process uses it to send its log messages to
+  the parent, which passes them to ReplayLog() so that the messages of
+  different workers do not interleave.
+  """
+
+  root = logging.getLogger()
+  saved = root.handlers[:]
+  for hdlr in saved:
+    root.removeHandler(hdlr)
+  capture = _RecordHandler()
+  root.addHandler(capture)
+  try:
+    return func(*args), capture.records
+  finally:
+    root.removeHandler(capture)
+    for hdlr in saved:
+      root.addHandler(hdlr)
+
+
+def ReplayLog(records):
+  """Log the messages captured by RunWithLogCapture()
+  """
+
+  for level, message in records:
+    logging.log(level, message)
+
+
+def RunProfiled(func, *args):
+  """Run a function under the profiler if requested
+
+  If the DEBMARSHAL_PROFILE environment variable is set, this function
+  runs func(*args) under cProfile (or profile, before Python 2.5) and
+  writes the statistics to the file named by the variable, which can
+  be examined with the pstats module.  Otherwise it just calls func.
+  """
+
+  name = os.environ.get(_PROFILE_ENV)
+  if not name:
+    return func(*args)
+  profiler = profile.Profile()
+  try:
+    return profiler.runcall(func, *args)
+  finally:
+    profiler.dump_stats(name)
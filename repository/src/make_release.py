@@ -1,4 +1,4 @@
-#!/usr/bin/python2.4
+#!/usr/bin/python
 #
 # Copyright 2006 Google Inc.
 #
@@ -31,10 +31,12 @@ import logging as lg
 import optparse
 import os
 import sys
+import time
 import alias_utils as au
 import bsddb_utils as bu
 import deb_utils as du
 import logging_utils as lu
+import metrics_utils as mu
 import os_utils as ou
 import release_utils as ru
 import setting_utils as su
@@ -49,7 +51,7 @@ def _ParseCommandLine():
   well-formed in accordance with the semantics of the script.
   """
 
-  usage = 'usage: %prog [options] [diff RELEASE | commit]'
+  usage = 'usage: %prog [options] [diff RELEASE | commit | plan [NVA...]]'
   version = 'Debmarshall 0.0'
   parser = optparse.OptionParser(usage=usage, version=version)
 
@@ -100,6 +102,8 @@ def _ParseCommandLine():
       if len(proper) != 1:
         lg.error('verify command requires no arguments')
         sys.exit()
+    elif proper[0] == 'plan':
+      pass
     else:
         lg.error(proper[0] + ' is not a legal command')
         sys.exit()
@@ -107,12 +111,60 @@ def _ParseCommandLine():
   return options, proper
 
 
+def _SplitUnderlying(track, packages):
+  """Combine a release with the underlying releases of its track
+
+  This function fetches the underlying releases named in the
+  Underlying setting of the track and imports their dependency tables.
+  It returns the packages in the release and the packages in the
+  underlying releases, keeping only the latest version of each package
+  across all of them.
+  """
+
+  underlying = []
+  bases = su.GetSetting(track, 'Underlying')
+  if not bases:
+    return packages, underlying
+
+  # Build the underlying package list and import underlying dependency
+  # databases when necessary
+
+  for base in bases.split(', '):
+    base_list = base.split(' ', 1)
+    if len(base_list) != 2:
+      lg.error('malformed underlying release ' + base)
+      continue
+    base_url = base_list[0]
+    base_rel = base_list[1]
+    base_packages = bu.FetchUnderlyingRelease(base_url, base_rel)
+    bu.ImportUnderlyingTables(base_url, base_packages)
+    underlying.extend(base_packages)
+
+  # Select only the latest packages in either packages (release to be
+  # verified) or underlying (underlying releases)
+
+  combined = ru.SelectLatestPackages(packages + underlying)
+  combined = dict.fromkeys(combined)
+  for pkg in packages:
+    if pkg in combined:
+      combined[pkg] = True
+  packages = []
+  underlying = []
+  for pkg in combined:
+    if combined[pkg]:
+      packages.append(pkg)
+    else:
+      underlying.append(pkg)
+  return packages, underlying
+
+
 def main():
+  start = time.time()
   lu.SetLogConsole()
   options, proper = _ParseCommandLine()
 
   def DoSnapshot(_arg, dbs):
-    return ru.SelectLatestPackages(dbs['pkg_info'])
+    return ru.ListLatestPackages(dbs['pkg_latest'], dbs['pkg_info'])
 
   def DoRetrieve(release, dbs):
     releases = dbs['releases']
@@ -134,13 +186,14 @@ def main():
 
   if options.track:
     su.ConfirmTrack(options.track)
+  track = options.track
 
   packages = []
 
   # Add latest packages from the Berkeley DB tables.
 
   if options.snapshot:
-    packages.extend(bu.RunWithDB(['pkg_info'], DoSnapshot))
+    packages.extend(bu.RunWithDB(['pkg_info', 'pkg_latest'], DoSnapshot))
 
   # Add packages in Packages files in a dists/ subtree.
 
@@ -170,7 +223,8 @@ def main():
   ver_dict = ru.CutOffVersions(ver_dict, packages)
   if options.track:
     name = os.path.join('config', options.track + '.spec')
-    ver_dict = ru.FilterVersionWithFile(ver_dict, name)
+    ver_dict = lu.RunWithSpan('FilterVersionWithFile',
+                              ru.FilterVersionWithFile, ver_dict, name)
 
   # Convert results of version selection back to an nva list.
 
@@ -214,47 +268,49 @@ def main():
     # Perform release consistency checking.
 
     if proper[0] == 'verify':
-      underlying = []
-      bases = su.GetSetting(options.track, 'Underlying')
-      if bases:
-
-        # Build the underlying package list and import underlying
-        # dependency databases when necessary
-
-        for base in bases.split(', '):
-          base_list = base.split(' ', 1)
-          if len(base_list) != 2:
-            lg.error('malformed underlying release ' + base)
-            continue
-          base_url = base_list[0]
-          base_rel = base_list[1]
-          base_packages = bu.FetchUnderlyingRelease(base_url, base_rel)
-          bu.ImportUnderlyingTables(base_url, base_packages)
-          underlying.extend(base_packages)
-
-        # Select only the latest packages in either packages (release
-        # to be verified) or underlying (underlying releases)
-
-        combined = ru.SelectLatestPackages(packages + underlying)
-        combined = dict.fromkeys(combined)
-        for pkg in packages:
-          if pkg in combined:
-            combined[pkg] = True
-        packages = []
-        underlying = []
-        for pkg in combined:
-          if combined[pkg]:
-            packages.append(pkg)
-          else:
-            underlying.append(pkg)
-
+      packages, underlying = _SplitUnderlying(options.track, packages)
+      failures = lu.GetCounters().get('verification failures', 0)
       arch_dict = ru.GroupByArch(packages)
       underlying_dict = ru.GroupByArch(underlying)
-      for arch in arch_dict:
-        lg.info('Checking dependency for architecture ' + arch)
-        underlying_dict.setdefault(arch, [])
-        vu.CheckDependency(arch_dict[arch], underlying_dict[arch])
+      lu.RunWithSpan('CheckDependencies', vu.CheckDependencies,
+                     arch_dict, underlying_dict)
       bu.RunWithDB(['pkg_deps', 'src_info'], DoVerify, packages)
+      failures = lu.GetCounters().get('verification failures', 0) - failures
+      mu.SetMetric('verification_failures', failures,
+                   {'track': options.track or ''})
+
+    # Export install plans: the plan for the packages given as
+    # arguments installed together (one package per line), or the
+    # plan of every installable package in the release (one line per
+    # architecture and package, followed by its plan).
+
+    if proper[0] == 'plan':
+      targets = proper[1:]
+      packages, underlying = _SplitUnderlying(options.track, packages)
+      arch_dict = ru.GroupByArch(packages)
+      underlying_dict = ru.GroupByArch(underlying)
+      if targets:
+        arch_list = [nva.split('_')[-1] for nva in targets]
+        arch_list = [arch for arch in arch_list if arch != 'all']
+        arch_list = arch_list or sorted(arch_dict.keys())[:1]
+        if len(dict.fromkeys(arch_list)) != 1:
+          lg.error('plan packages must be of one architecture')
+          sys.exit()
+        arch = arch_list[0]
+        plan = vu.GetInstallPlans(arch_dict.get(arch, []),
+                                  underlying_dict.get(arch, []), targets)
+        if plan is None:
+          lg.error('Cannot find an install plan for ' + ' '.join(targets))
+          sys.exit(1)
+        for nva in plan:
+          print nva
+      else:
+        for arch in sorted(arch_dict.keys()):
+          plan_dict = vu.GetInstallPlans(arch_dict[arch],
+                                         underlying_dict.get(arch, []))
+          for nva in sorted(plan_dict.keys()):
+            if plan_dict[nva] is not None:
+              print arch, nva + ':', ' '.join(plan_dict[nva])
 
   # Default action: only list the binary packages in the release.
 
@@ -262,10 +318,12 @@ def main():
     for nva in packages:
       print nva
 
+  mu.WriteMetrics('make_release', start, track)
+
 
 if __name__ == '__main__':
   try:
-    main()
+    lu.RunProfiled(main)
   except KeyError:
     lg.error('Table indexing key error, terminating')
   except KeyboardInterrupt:
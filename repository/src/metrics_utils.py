@@ -0,0 +1,196 @@
+#!/usr/bin/python
+#
+# Copyright 2006 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""Operational metrics export functions
+
+The metrics_utils module contains utility functions for recording
+operational metrics of repository commands (uploads processed, queue
+backlog, packages indexed, release generation time, verification
+failures, and table sizes) and writing them as a Prometheus text file
+for the node exporter textfile collector after each run.
+"""
+
+__author__ = 'cklin@google.com (Chuan-Kai Lin)'
+
+import logging as lg
+import os
+import time
+import bsddb_utils as bu
+import logging_utils as lu
+import setting_utils as su
+
+
+# These are the metrics that debmarshal exports, with their types and
+# help texts.  All values describe the last run of a command, and every
+# sample carries a command label (and a track label for commands run on
+# a track) because each command writes its own file for each track (the
+# textfile collector rejects series repeated across files).
+
+_METRICS = {
+  'run_timestamp_seconds':
+    ('gauge', 'Time when the command finished'),
+  'run_duration_seconds':
+    ('gauge', 'Duration of the command run'),
+  'uploads':
+    ('gauge', 'Uploads processed in the run, by result'),
+  'upload_duration_seconds':
+    ('summary', 'Time spent processing each upload'),
+  'incoming_backlog':
+    ('gauge', 'Uploads left in the incoming directory after the run'),
+  'packages_indexed':
+    ('gauge', 'Package files indexed in the run, by type'),
+  'release_generation_seconds':
+    ('gauge', 'Time spent generating the release, by track'),
+  'verification_failures':
+    ('gauge', 'Dependency verification failures, by track'),
+  'table_bytes':
+    ('gauge', 'Size of each Berkeley DB table file') }
+
+_PREFIX = 'debmarshal_'
+
+# The recorded samples: _samples maps each metric name to a dictionary
+# from the sorted (label, value) tuple of a sample to its value.
+
+_samples = {}
+
+
+def _GetLabelKey(labels):
+  """Convert a label dictionary into a sample key
+  """
+
+  if not labels:
+    return ()
+  items = labels.items()
+  items.sort()
+  return tuple(items)
+
+
+def SetMetric(name, value, labels=None):
+  """Set the value of a metric sample
+  """
+
+  _samples.setdefault(name, {})[_GetLabelKey(labels)] = value
+
+
+def AddMetric(name, amount, labels=None):
+  """Add an amount to the value of a metric sample
+  """
+
+  samples = _samples.setdefault(name, {})
+  key = _GetLabelKey(labels)
+  samples[key] = samples.get(key, 0) + amount
+
+
+def ObserveMetric(name, value, labels=None):
+  """Add an observation to a summary metric (its _sum and _count)
+  """
+
+  AddMetric(name + '_sum', value, labels)
+  AddMetric(name + '_count', 1, labels)
+
+
+def _FormatSample(name, key, value):
+  """Format a sample line in the Prometheus text format
+  """
+
+  line = _PREFIX + name
+  if key:
+    pairs = []
+    for label, label_value in key:
+      escaped = str(label_value).replace('\\', '\\\\').replace('"', '\\"')
+      pairs.append(label + '="' + escaped + '"')
+    line = line + '{' + ','.join(pairs) + '}'
+  if isinstance(value, float):
+    return line + ' ' + repr(round(value, 6)) + '\n'
+  return line + ' ' + str(value) + '\n'
+
+
+def _FormatMetrics(extra):
+  """Format all recorded samples in the Prometheus text format
+
+  The labels in the extra dictionary are added to every sample.
+  """
+
+  lines = []
+  for name in sorted(_METRICS.keys()):
+    metric_type, help_text = _METRICS[name]
+    names = [name]
+    if metric_type == 'summary':
+      names = [name + '_sum', name + '_count']
+    if not [n for n in names if n in _samples]:
+      continue
+    lines.append('# HELP ' + _PREFIX + name + ' ' + help_text + '\n')
+    lines.append('# TYPE ' + _PREFIX + name + ' ' + metric_type + '\n')
+    for sample_name in names:
+      samples = _samples.get(sample_name, {})
+      for key in sorted(samples.keys()):
+        labels = dict(key)
+        labels.update(extra)
+        lines.append(_FormatSample(sample_name, _GetLabelKey(labels),
+                                   samples[key]))
+  return ''.join(lines)
+
+
+def WriteMetrics(command, start, track=None):
+  """Write the metrics of a command run for the node exporter
+
+  If the MetricsDir setting names a directory (the one read by the
+  node exporter textfile collector), this function adds the run
+  timestamp, run duration (from the start time), packages indexed
+  (from the logging_utils counters), and table sizes to the recorded
+  metrics, and it atomically replaces debmarshal_<command>.prom in
+  that directory with them.  Otherwise it does nothing.  If the
+  command ran on a track, the file is debmarshal_<command>_<track>.prom
+  instead (and every sample has a track label), so that the metrics of
+  each track are kept until the command runs on that track again.
+  """
+
+  metrics_dir = su.GetSetting(None, 'MetricsDir')
+  if metrics_dir is None:
+    return
+
+  now = time.time()
+  SetMetric('run_timestamp_seconds', int(now))
+  SetMetric('run_duration_seconds', now - start)
+  counters = lu.GetCounters()
+  for kind in ['binary', 'source']:
+    count = counters.get(kind + ' packages indexed')
+    if count is not None:
+      SetMetric('packages_indexed', count, {'type': kind})
+  table_files = bu.GetTableFiles()
+  for table in table_files:
+    if os.path.exists(table_files[table]):
+      SetMetric('table_bytes', os.path.getsize(table_files[table]),
+                {'table': table})
+
+  extra = {'command': command}
+  base = _PREFIX + command
+  if track:
+    extra['track'] = track
+    base = base + '_' + track
+  name = os.path.join(metrics_dir, base + '.prom')
+  temp = name + '.' + str(os.getpid())
+  try:
+    output = open(temp, 'w')
+    try:
+      output.write(_FormatMetrics(extra))
+    finally:
+      output.close()
+    os.rename(temp, name)
+  except EnvironmentError, mesg:
+    lg.error('Cannot write metrics to ' + name + ': ' + str(mesg))
@@ -0,0 +1,149 @@
+#!/usr/bin/python
+#
+# Copyright 2006 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""Interned package identifier functions
+
+The nva_utils module contains utility functions for representing
+binary packages (name_version_arch strings) as small integers.  Each
+package string, and each package name, version, and architecture
+string, is interned once and mapped to an integer ID; the name,
+version, and architecture IDs of each package are kept in integer
+arrays indexed by package ID.  Code that groups, sorts, or compares
+many packages works on these IDs instead of splitting the strings
+again and again.
+"""
+
+__author__ = 'cklin@google.com (Chuan-Kai Lin)'
+
+import array
+
+
+# The registry: for each kind of string (package, name, version, and
+# architecture), a list maps IDs to strings and a dictionary maps
+# strings to IDs.  The _pkg_* arrays map a package ID to the IDs of
+# its name, version, and architecture.
+
+_nvas = []
+_nva_ids = {}
+_names = []
+_name_ids = {}
+_versions = []
+_version_ids = {}
+_archs = []
+_arch_ids = {}
+
+_pkg_names = array.array('i')
+_pkg_versions = array.array('i')
+_pkg_archs = array.array('i')
+
+
+def _InternString(string, strings, ids):
+  """Map a string to its ID, assigning a new ID if necessary
+  """
+
+  string_id = ids.get(string)
+  if string_id is None:
+    string_id = len(strings)
+    strings.append(string)
+    ids[string] = string_id
+  return string_id
+
+
+def GetNameId(name):
+  return _InternString(name, _names, _name_ids)
+
+
+def GetVersionId(version):
+  return _InternString(version, _versions, _version_ids)
+
+
+def GetArchId(arch):
+  return _InternString(arch, _archs, _arch_ids)
+
+
+def GetName(name_id):
+  return _names[name_id]
+
+
+def GetVersion(version_id):
+  return _versions[version_id]
+
+
+def GetArch(arch_id):
+  return _archs[arch_id]
+
+
+def GetVersionCount():
+  """Return the number of version IDs assigned so far
+  """
+
+  return len(_versions)
+
+
+def Intern(nva):
+  """Map a name_version_arch string to its package ID
+  """
+
+  pkg_id = _nva_ids.get(nva)
+  if pkg_id is None:
+    [n, v, a] = nva.split('_')
+    pkg_id = len(_nvas)
+    _nvas.append(nva)
+    _nva_ids[nva] = pkg_id
+    _pkg_names.append(GetNameId(n))
+    _pkg_versions.append(GetVersionId(v))
+    _pkg_archs.append(GetArchId(a))
+  return pkg_id
+
+
+def InternList(nva_list):
+  """Map a list of name_version_arch strings to an array of package IDs
+  """
+
+  pkg_ids = map(_nva_ids.get, nva_list)
+  if None in pkg_ids:
+    pkg_ids = [Intern(nva) for nva in nva_list]
+  return array.array('i', pkg_ids)
+
+
+def GetNva(pkg_id):
+  return _nvas[pkg_id]
+
+
+def GetNvaList(pkg_ids):
+  """Map a sequence of package IDs back to name_version_arch strings
+  """
+
+  return [_nvas[pkg_id] for pkg_id in pkg_ids]
+
+
+def Split(pkg_id):
+  """Return the (name ID, version ID, arch ID) triple of a package
+  """
+
+  return _pkg_names[pkg_id], _pkg_versions[pkg_id], _pkg_archs[pkg_id]
+
+
+def GetTables():
+  """Return the name, version, and arch ID arrays indexed by package ID
+
+  The arrays grow as packages are interned, so callers should not keep
+  references to them (or views of them) across calls to Intern().
+  """
+
+  return _pkg_names, _pkg_versions, _pkg_archs
@@ -1,4 +1,4 @@
-#!/usr/bin/python2.4
+#!/usr/bin/python
 #
 # Copyright 2006 Google Inc.
 #
@@ -26,13 +26,20 @@ supply additional input to existing functions.
 
 __author__ = 'cklin@google.com (Chuan-Kai Lin)'
 
-import fileinput
 import logging as lg
+import mmap
 import os
+import select
+import signal
 import subprocess as sp
 import shutil
+import struct
+import sys
 import tarfile
 import tempfile
+import time
+import zlib
+import logging_utils as lu
 
 
 def IgnoreOSError(func, param):
@@ -45,6 +52,20 @@ def IgnoreOSError(func, param):
     pass
 
 
+def MakeDirs(name):
+  """Create a directory and its parents unless it already exists
+
+  Unlike os.makedirs, this function does not fail if another process
+  creates the directory at the same time.
+  """
+
+  try:
+    os.makedirs(name, 0755)
+  except OSError:
+    if not os.path.isdir(name):
+      raise
+
+
 def RunInTempDir(func):
   """Run the given function in a secure temporary directory
   """
@@ -59,6 +80,19 @@ def RunInTempDir(func):
     shutil.rmtree(temp_dir, True)
 
 
+def RunInDir(path, func):
+  """Run the given function in a directory (created if necessary)
+  """
+
+  current_dir = os.getcwd()
+  MakeDirs(path)
+  try:
+    os.chdir(path)
+    return func()
+  finally:
+    os.chdir(current_dir)
+
+
 def RunWithTempFile(func):
   """Run the given function in a secure temporary file
   """
@@ -72,18 +106,94 @@ def RunWithTempFile(func):
     IgnoreOSError(os.remove, name)
 
 
-def RunWithFileInput(func, name):
-  """Run the given function with the contents of a file
+def ReplaceSymlink(target, name):
+  """Atomically create or replace a symbolic link
+
+  This function creates the new symbolic link under a temporary name
+  and renames it over name, so that name always exists and points to
+  either the old or the new target.
   """
 
-  finput = fileinput.input(name)
-  try:
+  temp = name + '.' + str(os.getpid())
+  IgnoreOSError(os.remove, temp)
+  os.symlink(target, temp)
+  os.rename(temp, name)
+
+
+def SplitLines(buffer):
+  """Iterate over the lines (including newlines) in a buffer
+
+  The buffer can be a string or an mmap object (see RunWithFileBuffer).
+  Each line is found with the find method of the buffer, so an mmap
+  object is scanned without first copying it into a string.
+  """
+
+  start = 0
+  end = len(buffer)
+  while start < end:
+    stop = buffer.find('\n', start)
+    if stop < 0:
+      stop = end
+    else:
+      stop = stop+1
+    yield buffer[start:stop]
+    start = stop
+
+
+def RunWithFileBuffer(func, name):
+  """Run the given function with a buffer of the contents of a file
+
+  The file is memory-mapped read-only, and the function receives the
+  mmap object, which supports string-like slicing, find(), and regular
+  expression matching.  An empty file is passed as an empty string,
+  and the name '-' refers to the standard input (read into a string).
+  If the file cannot be opened or mapped, or if the function raises
+  IOError while reading it, this function logs an error and returns
+  None.
+  """
+
+  def DoRun(buffer):
     try:
-      return func(finput)
+      return func(buffer)
     except IOError, mesg:
       lg.error(str(mesg))
+      return None
+
+  if name == '-':
+    return DoRun(sys.stdin.read())
+  try:
+    fin = open(name, 'rb')
+  except IOError, mesg:
+    lg.error(str(mesg))
+    return None
+  try:
+    try:
+      size = os.fstat(fin.fileno()).st_size
+      if size == 0:
+        return DoRun('')
+      buffer = mmap.mmap(fin.fileno(), size, access=mmap.ACCESS_READ)
+    except EnvironmentError, mesg:
+      lg.error('Cannot read ' + name + ': ' + str(mesg))
+      return None
+    try:
+      return DoRun(buffer)
+    finally:
+      buffer.close()
   finally:
-    finput.close()
+    fin.close()
+
+
+def RunWithFileInput(func, name):
+  """Run the given function with the lines of a file
+
+  The function receives an iterator over the lines of the file (see
+  RunWithFileBuffer and SplitLines).
+  """
+
+  def DoSplit(buffer):
+    return func(SplitLines(buffer))
+
+  return RunWithFileBuffer(DoSplit, name)
 
 
 def RunWithTarInput(func, name):
@@ -112,37 +222,202 @@ def RunWithTarInput(func, name):
     tar.close()
 
 
-def SpawnProgram(args):
+# This is the gzip header written by gzip -9 -n: deflate, no flags, no
+# file name, a zero timestamp, maximum compression, and Unix as the OS.
+
+_GZIP_HEADER = '\037\213\010\000\000\000\000\000\002\003'
+
+
+def GzipString(string):
+  """Compress a string in the gzip format
+
+  This function produces the same format as gzip -9 -n: it does not
+  include a file name or timestamp in the header, so that compressing
+  the same string always gives the same cryptographic hash values.
+  """
+
+  compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+  body = compressor.compress(string) + compressor.flush()
+  trailer = struct.pack('<LL', zlib.crc32(string) & 0xffffffffL,
+                        len(string) & 0xffffffffL)
+  return _GZIP_HEADER + body + trailer
+
+
+class GzipWriter:
+  """Write a gzip file incrementally in the GzipString() format
+
+  The file has the same header as the output of GzipString(), so that
+  writing the same contents always gives the same bytes.  Call write()
+  with the uncompressed data and close() when done.
+  """
+
+  def __init__(self, name):
+    self.output = open(name, 'wb')
+    self.output.write(_GZIP_HEADER)
+    self.compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+    self.crc = zlib.crc32('')
+    self.size = 0
+
+  def write(self, data):
+    self.output.write(self.compressor.compress(data))
+    self.crc = zlib.crc32(data, self.crc)
+    self.size = self.size + len(data)
+
+  def close(self):
+    self.output.write(self.compressor.flush())
+    self.output.write(struct.pack('<LL', self.crc & 0xffffffffL,
+                                  self.size & 0xffffffffL))
+    self.output.close()
+
+
+def _ReadChildOutput(fd, pending, output):
+  """Read available output from a child pipe and log complete lines
+
+  The pending list holds the partial last line read so far from the
+  pipe.  If output is a list, lines are appended to it instead of being
+  logged.  The function returns False when the pipe reaches EOF.
+  """
+
+  data = os.read(fd, 65536)
+  if data:
+    pending.append(data)
+    if '\n' not in data:
+      return True
+    lines = ''.join(pending).split('\n')
+    pending[:] = [lines.pop()]
+  else:
+    lines = [''.join(pending)]
+    pending[:] = []
+    if not lines[0]:
+      return False
+  for line in lines:
+    if output is None:
+      lg.info(line)
+    else:
+      output.append(line + '\n')
+  return bool(data)
+
+
+def SpawnPrograms(arg_lists, timeout=None, capture=False, limit=None):
+  """Run external programs in parallel in separate processes
+
+  This function runs one child process for each argument list (whose
+  0th element is the program to run), with at most limit children (or
+  all of them, if limit is None) running at the same time; the next
+  program starts as soon as a running child exits.  It drains the
+  stdout and stderr pipes of the running children concurrently with
+  select(), so that no child can block on a full pipe, and it sends
+  their output to the logger (at INFO level) line by line as it
+  arrives.  If capture is true, the stdout output is collected instead
+  of logged.  Children that are still running timeout seconds after
+  they started are killed.
+
+  The return value is the list of exit codes of the programs (negative
+  if killed by a signal), or the list of (exit code, stdout output)
+  pairs if capture is true.  If a program cannot be started, the
+  children already running are killed and the OSError is raised.  The
+  external program invocations do not go through the shell, so we are
+  safe against command injection attacks.
+  """
+
+  def DoFinish(index):
+    """Close the pipes of a child, wait for it, and record its result
+    """
+
+    child, captured, deadline, fds = running.pop(index)
+    for fd in fds:
+      streams.pop(fd, None)
+    child.stdout.close()
+    child.stderr.close()
+    retval = child.wait()
+    if capture:
+      results[index] = retval, ''.join(captured)
+    else:
+      results[index] = retval
+
+  def DoKill(index):
+    IgnoreOSError(lambda pid: os.kill(pid, signal.SIGKILL),
+                  running[index][0].pid)
+    DoFinish(index)
+
+  results = [None] * len(arg_lists)
+  running = {}
+  streams = {}
+  started = 0
+  lu.CountEvent('subprocesses spawned', len(arg_lists))
+  try:
+    while started < len(arg_lists) or running:
+      while (started < len(arg_lists) and
+             (limit is None or len(running) < limit)):
+        child = sp.Popen(arg_lists[started], stdout=sp.PIPE,
+                         stderr=sp.PIPE)
+        captured = []
+        deadline = None
+        if timeout is not None:
+          deadline = time.time() + timeout
+        fds = [child.stdout.fileno(), child.stderr.fileno()]
+        running[started] = child, captured, deadline, fds
+        if capture:
+          streams[fds[0]] = (started, [], captured)
+        else:
+          streams[fds[0]] = (started, [], None)
+        streams[fds[1]] = (started, [], None)
+        started = started+1
+
+      wait = None
+      if timeout is not None:
+        now = time.time()
+        for index in running.keys():
+          if running[index][2] <= now:
+            lg.error('Program ' + arg_lists[index][0] + ' timed out')
+            DoKill(index)
+        deadlines = [running[index][2] for index in running]
+        if deadlines:
+          wait = max(min(deadlines) - now, 0)
+      if not running:
+        continue
+
+      ready = select.select(streams.keys(), [], [], wait)[0]
+      for fd in ready:
+        index, pending, output = streams[fd]
+        if not _ReadChildOutput(fd, pending, output):
+          del streams[fd]
+          if not [f for f in running[index][3] if f in streams]:
+            DoFinish(index)
+  finally:
+    for index in running.keys():
+      DoKill(index)
+  return results
+
+
+def SpawnProgram(args, timeout=None, capture=False):
   """Run an external program in a separate process
 
-  This function takes an argument list (whose 0th element is the
-  program to run), runs the program with the supplied arguments,
-  redirect stdout and stderr to the logger (at INFO level), and
-  returns the exit code of the program run.  The external program
-  invocation does not go through the shell, so we are safe against
-  command injection attacks.
+  This function runs a single program with SpawnPrograms() and returns
+  its exit code (or the exit code and the stdout output if capture is
+  true).
   """
 
-  child = sp.Popen(args, stdout=sp.PIPE, stderr=sp.STDOUT)
-  retval = child.wait()
-  for line in child.stdout:
-    lg.info(line.rstrip('\n'))
-  return retval
+  return SpawnPrograms([args], timeout, capture)[0]
 
 
-def CopyDeleteFiles(dir_from, dir_to, file_list):
+def CopyDeleteFiles(dir_from, dir_to, file_list, copy_func=None):
   """Move a list of files from one directory to another
 
   This function implements rename(2)-like functionality with a
   slightly more convenient interface.  It copies each file and then
   remove the original, so that the rename works across filesystems,
   and that a process holding an open file descriptor on the original
-  cannot change the renamed copy.
+  cannot change the renamed copy.  If copy_func is given, it is called
+  with the source and destination file objects to do the copying (for
+  example, to compute hash values on the way), and the results are
+  returned in a dictionary indexed by file name.
   """
 
   if not os.path.exists(dir_to):
     os.makedirs(dir_to, 0755)
 
+  results = {}
   path_from = ''
   try:
     for name in file_list:
@@ -151,8 +426,27 @@ def CopyDeleteFiles(dir_from, dir_to, file_list):
       if name.find('/') >= 0:
         lg.error('File name ' + name + ' contains / character')
         raise ValueError
-      shutil.copyfile(path_from, path_to)
+      if copy_func is None:
+        shutil.copyfile(path_from, path_to)
+      else:
+        results[name] = _CopyWithFunction(copy_func, path_from, path_to)
       IgnoreOSError(os.remove, path_from)
   except IOError:
     lg.error('Cannot move file ' + path_from)
     raise
+  return results
+
+
+def _CopyWithFunction(copy_func, path_from, path_to):
+  """Copy a file by calling copy_func on the opened file objects
+  """
+
+  fsrc = open(path_from, 'rb')
+  try:
+    fdst = open(path_to, 'wb')
+    try:
+      return copy_func(fsrc, fdst)
+    finally:
+      fdst.close()
+  finally:
+    fsrc.close()
@@ -1,4 +1,4 @@
-#!/usr/bin/python2.4
+#!/usr/bin/python
 #
 # Copyright 2006 Google Inc.
 #
@@ -28,6 +28,7 @@ __author__ = 'cklin@google.com (Chuan-Kai Lin)'
 import logging as lg
 import os
 import re
+import os_utils as ou
 import setting_utils as su
 
 
@@ -38,7 +39,9 @@ def StripSignature(lines):
   the signed message without verifying the signature.  If the input
   text does not contain a signature, the function returns the original
   input unchanged.  If the input text contains malformed signature,
-  the function returns None.
+  the function returns None.  The input can be a sequence of lines or
+  a buffer (see ou.RunWithFileBuffer); an unsigned buffer is detected
+  with a single search and split into lines directly.
   """
 
   header = '-----BEGIN PGP SIGNED MESSAGE-----'
@@ -47,6 +50,12 @@ def StripSignature(lines):
   begin_armor = '-----BEGIN PGP SIGNATURE-----'
   end_armor = '-----END PGP SIGNATURE-----'
 
+  if hasattr(lines, 'find'):
+    if lines.find(header) < 0:
+      lg.warning('Input text does not contain OpenPGP signature')
+      return lines[:].splitlines()
+    lines = ou.SplitLines(lines)
+
   stage = 1
   result = []
   original = []
@@ -112,9 +121,13 @@ def ParseAttributes(lines):
   The deb package format and release workflow relies heavily on text
   files that define attributes in colon-separated lines (Policy 5.1).
   This function parses the contents of these files and stores the
-  results in a dictionary.
+  results in a dictionary.  The input can be a sequence of lines or a
+  buffer (see ou.RunWithFileBuffer).
   """
 
+  if hasattr(lines, 'find'):
+    lines = ou.SplitLines(lines)
+
   attr_re = re.compile(r'(\w|-)+: \S+')
   key_re = re.compile(r'(\w|-)+:\s*\Z')
   attr_dict = {}
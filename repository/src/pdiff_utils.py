@@ -0,0 +1,164 @@
+#!/usr/bin/python
+#
+# Copyright 2006 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""Package index diff (pdiff) generation functions
+
+The pdiff_utils module contains utility functions for generating the
+ed-style Packages.diff/ and Sources.diff/ patches between releases in
+the same track, which allow apt to update its package lists without
+downloading the whole index file again.
+"""
+
+__author__ = 'cklin@google.com (Chuan-Kai Lin)'
+
+import os
+import crypto_utils as cu
+import os_utils as ou
+import publish_utils as pb
+
+
+_HASH_ALGOS = [('sha1', 'SHA1'), ('sha256', 'SHA256')]
+
+
+def _BuildIndexText(info_dict, keys):
+  """Build the contents of a Packages/Sources file
+  """
+
+  return ''.join([info_dict[key] + '\n\n' for key in keys])
+
+
+def _BuildEdScript(info_dict, old_keys, new_keys):
+  """Build an ed script that turns one index file into another
+
+  Both index files consist of info_dict entries in the order given by
+  the key lists, which are sorted.  Instead of diffing the text, this
+  function merges the two key lists in one linear pass: keys only in
+  old_keys are deleted, keys only in new_keys are inserted, and each
+  run of deletions and insertions between common keys becomes one
+  hunk.  The hunks are emitted from the bottom up, as diff -e does, so
+  that the line numbers of each hunk refer to the original file.
+  """
+
+  line_count = {}
+
+  def CountLines(key):
+    if key not in line_count:
+      line_count[key] = info_dict[key].count('\n') + 2
+    return line_count[key]
+
+  hunks = []
+  line = 1
+  i = 0
+  j = 0
+  while i < len(old_keys) or j < len(new_keys):
+    if (i < len(old_keys) and j < len(new_keys) and
+        old_keys[i] == new_keys[j]):
+      line = line + CountLines(old_keys[i])
+      i = i+1
+      j = j+1
+      continue
+
+    # Collect a run of deletions and insertions that ends at the next
+    # common key (or at the end of both lists).
+
+    start = line
+    inserted = []
+    while i < len(old_keys) or j < len(new_keys):
+      if (i < len(old_keys) and j < len(new_keys) and
+          old_keys[i] == new_keys[j]):
+        break
+      if j >= len(new_keys) or (i < len(old_keys) and
+                                old_keys[i] < new_keys[j]):
+        line = line + CountLines(old_keys[i])
+        i = i+1
+      else:
+        inserted.append(new_keys[j])
+        j = j+1
+    hunks.append((start, line-1, inserted))
+
+  script = []
+  hunks.reverse()
+  for start, end, inserted in hunks:
+    if end < start:
+      script.append(str(start-1) + 'a\n')
+    elif end == start:
+      script.append(str(start) + (inserted and 'c\n' or 'd\n'))
+    else:
+      script.append(str(start) + ',' + str(end) +
+                    (inserted and 'c\n' or 'd\n'))
+    if inserted:
+      script.append(_BuildIndexText(info_dict, inserted))
+      script.append('.\n')
+  return ''.join(script)
+
+
+def WriteIndexDiffs(name, info_dict, keys, version, history):
+  """Write the pdiff directory and Index file of an index file
+
+  This function writes the name.diff/ directory for the index file
+  given by name, which lists the info_dict entries of keys.  The
+  history argument is a list of (version, keys) pairs for the same
+  index in previous releases of the track, oldest first, and version
+  is the current release.  Each patch turns one release's index into
+  the next one's and is named by the release it produces; releases
+  whose index did not change are collapsed.  The return value is the
+  list of pb.PublishString() reports of the files written.
+  """
+
+  diff_dir = name + '.diff'
+  chain = []
+  for old_version, old_keys in history + [(version, keys)]:
+    if chain and chain[-1][1] == old_keys:
+      chain[-1] = (old_version, old_keys)
+    else:
+      chain.append((old_version, old_keys))
+  if len(chain) < 2:
+    return []
+
+  algos = [algo for algo, _field in _HASH_ALGOS]
+  current = cu.HashString(_BuildIndexText(info_dict, keys), algos)
+  entries = []
+  reports = []
+  for index in range(len(chain)-1):
+    old_keys = chain[index][1]
+    patch_name = chain[index+1][0]
+    old = cu.HashString(_BuildIndexText(info_dict, old_keys), algos)
+    script = _BuildEdScript(info_dict, old_keys, chain[index+1][1])
+    patch = cu.HashString(script, algos)
+    patch_file = os.path.join(diff_dir, patch_name + '.gz')
+    report = pb.PublishString(patch_file, ou.GzipString(script))
+    reports.append(report)
+    entries.append((patch_name, old, patch, report[1:]))
+
+  lines = []
+  for algo, field in _HASH_ALGOS:
+    lines.append(field + '-Current: ' + current[1][algo] + ' ' +
+                 str(current[0]) + '\n')
+    for section, position in [('History', 1), ('Patches', 2),
+                              ('Download', 3)]:
+      lines.append(field + '-' + section + ':\n')
+      for entry in entries:
+        size, digests = entry[position]
+        suffix = ''
+        if section == 'Download':
+          suffix = '.gz'
+        lines.append(' ' + digests[algo] + ' ' + str(size).rjust(8) +
+                     ' ' + entry[0] + suffix + '\n')
+  index_file = os.path.join(diff_dir, 'Index')
+  reports.append(pb.PublishString(index_file, ''.join(lines)))
+  return reports
@@ -0,0 +1,190 @@
+#!/usr/bin/python
+#
+# Copyright 2006 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""Atomic file publishing functions for the dists/ hierarchy
+
+The publish_utils module contains utility functions for placing index
+files into the dists/ hierarchy in the Acquire-By-Hash layout.  Each
+file is stored once in a content-addressed store, linked into the
+by-hash/SHA256/ directory next to it, and switched into place under
+its own name with an atomic rename, so that clients never observe a
+partially written file.
+"""
+
+__author__ = 'cklin@google.com (Chuan-Kai Lin)'
+
+import os
+import shutil
+import time
+import crypto_utils as cu
+import logging_utils as lu
+import os_utils as ou
+
+
+# All published files are hard links to files in this directory, which
+# are named by their SHA256 hash values.  Files with identical contents
+# (for example, an unchanged Packages file in consecutive releases) are
+# therefore stored only once.
+
+_STORE_DIR = os.path.join('dists', '.by-hash')
+
+
+# A stored file that no published file links to any more is removed
+# only after it has been in the store for this many seconds, so that a
+# file stored by a concurrent publisher is not removed before it is
+# linked into place.
+
+_STORE_GRACE = 3600
+
+
+# These are the hash values computed for each published file, which
+# cover all the checksum sections of top-level Release files.
+
+_DIGEST_ALGOS = ['md5', 'sha1', 'sha256', 'sha512']
+
+
+def _LinkReplace(source, name):
+  """Atomically make name refer to the contents of source
+
+  This function hard-links source to a temporary name (or copies it
+  if it cannot be linked) and renames the result over name.  If name
+  is already a link to source, it does nothing.
+  """
+
+  if os.path.exists(name) and os.path.samefile(source, name):
+    return
+  temp = name + '.' + str(os.getpid())
+  ou.IgnoreOSError(os.remove, temp)
+  try:
+    os.link(source, temp)
+  except OSError:
+    shutil.copyfile(source, temp)
+  os.rename(temp, name)
+
+
+def _PublishStored(name, digest, store):
+  """Publish a file in the store under name and in by-hash/
+
+  The store argument is a function that writes the file contents to
+  the pathname given as its argument; it is called only if the store
+  does not have a file with the given SHA256 hash value yet.
+  """
+
+  stored = os.path.join(_STORE_DIR, digest)
+  if not os.path.exists(stored):
+    if not os.path.isdir(_STORE_DIR):
+      ou.MakeDirs(_STORE_DIR)
+    temp = stored + '.' + str(os.getpid())
+    store(temp)
+    os.rename(temp, stored)
+
+  by_hash = os.path.join(os.path.dirname(name), 'by-hash', 'SHA256')
+  if not os.path.isdir(by_hash):
+    ou.MakeDirs(by_hash)
+  _LinkReplace(stored, os.path.join(by_hash, digest))
+  _LinkReplace(stored, name)
+
+
+def PublishString(name, string):
+  """Publish a string as the contents of a file in dists/
+
+  This function returns a (name, size, digests) report of the published
+  file, where digests maps hash algorithm names to hash values as in
+  cu.HashString().  The reports are used to assemble the top-level
+  Release file without reading the published files again.
+  """
+
+  def DoStore(temp):
+    f = open(temp, 'wb')
+    try:
+      f.write(string)
+    finally:
+      f.close()
+
+  size, digests = lu.RunWithSpan('hash', cu.HashString, string,
+                                 _DIGEST_ALGOS)
+  _PublishStored(name, digests['sha256'], DoStore)
+  return name, size, digests
+
+
+def PublishFile(name, source):
+  """Publish an existing file under a name in dists/
+
+  This function returns a (name, size, digests) report of the published
+  file in the same form as PublishString().
+  """
+
+  def DoStore(temp):
+    try:
+      os.link(source, temp)
+    except OSError:
+      shutil.copyfile(source, temp)
+
+  size, digests = lu.RunWithSpan('hash', cu.HashFile, source,
+                                 _DIGEST_ALGOS)
+  _PublishStored(name, digests['sha256'], DoStore)
+  return name, size, digests
+
+
+def ReadReleaseDigests(name):
+  """Read the SHA256 hash values listed in a top-level Release file
+
+  The return value is a dictionary whose keys are the hash values (it
+  is empty if the Release file does not exist).
+  """
+
+  digests = {}
+  if not os.path.exists(name):
+    return digests
+  section = None
+  for line in open(name):
+    if not line.startswith(' '):
+      section = line.split(':', 1)[0]
+    elif section == 'SHA256':
+      digests[line.split()[0]] = None
+  return digests
+
+
+def CollectGarbage(release_dir, keep):
+  """Remove by-hash entries and stored files that are no longer used
+
+  This function removes the entries in the by-hash/SHA256/ directories
+  under release_dir whose hash values are not keys of keep, and then
+  removes the files in the store that no published file links to (the
+  store holds their only link).  The caller keeps the hash values
+  listed in the current and the previous Release file of the release,
+  so that clients still reading the previous Release find its files.
+  """
+
+  for dir, _dirs, names in os.walk(release_dir):
+    if dir.split(os.sep)[-2:] != ['by-hash', 'SHA256']:  continue
+    for name in names:
+      if name not in keep:
+        ou.IgnoreOSError(os.remove, os.path.join(dir, name))
+
+  if not os.path.isdir(_STORE_DIR):
+    return
+  cutoff = time.time() - _STORE_GRACE
+  for name in os.listdir(_STORE_DIR):
+    stored = os.path.join(_STORE_DIR, name)
+    try:
+      info = os.stat(stored)
+    except OSError:
+      continue
+    if info.st_nlink == 1 and info.st_mtime < cutoff:
+      ou.IgnoreOSError(os.remove, stored)
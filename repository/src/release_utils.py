@@ -1,4 +1,4 @@
-#!/usr/bin/python2.4
+#!/usr/bin/python
 #
 # Copyright 2006 Google Inc.
 #
@@ -29,21 +29,116 @@ __author__ = 'cklin@google.com (Chuan-Kai Lin)'
 import logging as lg
 import os
 import re
-import shutil
 import sys
 import time
 import alias_utils as au
 import bsddb_utils as bu
+import contents_utils as co
 import crypto_utils as cu
 import deb_utils as du
+import logging_utils as lu
+import metrics_utils as mu
+import nva_utils as nu
 import os_utils as ou
+import pdiff_utils as pd
+import publish_utils as pb
 import setting_utils as su
 
+try:
+  import multiprocessing
+except ImportError:
+  multiprocessing = None
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+
+# Package lists with at least this many entries are grouped with NumPy
+# (if it is available); shorter ones are faster with plain loops.
+
+_BATCH_THRESHOLD = 5000
+
+
+def _UseBatch(nva_list):
+  """Check whether a package list should take the NumPy batch path
+  """
+
+  return (numpy is not None and isinstance(nva_list, list) and
+          len(nva_list) >= _BATCH_THRESHOLD)
+
+
+def _GroupPositions(codes):
+  """Group the positions of a code array by code (NumPy batch path)
+
+  This function returns a dictionary that maps each code in the array
+  to the array of positions where it occurs, in ascending order.
+  """
+
+  codes = numpy.asarray(codes)
+  order = numpy.argsort(codes, kind='mergesort')
+  sorted_codes = codes[order]
+  bounds = numpy.flatnonzero(sorted_codes[1:] != sorted_codes[:-1]) + 1
+  starts = [0] + bounds.tolist()
+  ends = bounds.tolist() + [len(codes)]
+  groups = {}
+  for start, end in zip(starts, ends):
+    groups[int(sorted_codes[start])] = order[start:end]
+  return groups
+
+
+def _GetColumns(nva_list):
+  """Encode a package list as NumPy arrays of IDs (NumPy batch path)
+
+  This function returns the package, name, version, and arch ID arrays
+  of the packages in nva_list (see nva_utils).
+  """
+
+  pkg_ids = numpy.frombuffer(nu.InternList(nva_list), dtype=numpy.intc)
+  columns = [pkg_ids]
+  for table in nu.GetTables():
+    columns.append(numpy.frombuffer(table, dtype=numpy.intc)[pkg_ids])
+  return columns
+
+
+def _GetVersionRanks(version_ids):
+  """Rank version IDs in version order (NumPy batch path)
+
+  Equal versions (e.g., 1.0 and 1.00) get the same rank.
+  """
+
+  unique_ids = numpy.unique(version_ids)
+  keyed = [(GetVersionKey(nu.GetVersion(version_id)), version_id)
+           for version_id in unique_ids.tolist()]
+  keyed.sort()
+  ranks = numpy.zeros(int(unique_ids.max())+1, dtype=numpy.intc)
+  rank = 0
+  previous = None
+  for key, version_id in keyed:
+    if key != previous:
+      rank = rank + 1
+      previous = key
+    ranks[version_id] = rank
+  return ranks[version_ids]
+
 
 def GroupByComponent(nva_list, dep_dict):
   """Categorize a list packages by their component
   """
 
+  if _UseBatch(nva_list):
+    comp_ids = {}
+    codes = [comp_ids.setdefault(dep_dict[nva]['Component'][0],
+                                 len(comp_ids))
+             for nva in nva_list]
+    nvas = numpy.array(nva_list, dtype=object)
+    comp_dict = {}
+    groups = _GroupPositions(codes)
+    for comp in comp_ids:
+      comp_dict[comp] = nvas[groups[comp_ids[comp]]].tolist()
+    return comp_dict
+
   comp_dict = {}
   for nva in nva_list:
     comp = dep_dict[nva]['Component'][0]
@@ -61,23 +156,39 @@ def GroupByArch(nva_list):
   Binary-dependent packages are handled in the obvious manner, and
   binary-independent ones go into all architectures listed in the
   Architectures attribute in the repository configuration file.
+  Long lists are grouped with NumPy (see _GroupPositions).
   """
 
   arch_dict = {}
-  for nva in nva_list:
-    arch = nva.split('_')[2]
-    if arch not in arch_dict:
-      arch_dict[arch] = []
-    arch_dict[arch].append(nva)
+  if _UseBatch(nva_list):
+    arch_ids = _GetColumns(nva_list)[3]
+    nvas = numpy.array(nva_list, dtype=object)
+    groups = _GroupPositions(arch_ids)
+    for arch_id in groups:
+      arch_dict[nu.GetArch(arch_id)] = nvas[groups[arch_id]].tolist()
+  else:
+    id_dict = {}
+    for pkg_id in nu.InternList(nva_list):
+      arch_id = nu.Split(pkg_id)[2]
+      if arch_id not in id_dict:
+        id_dict[arch_id] = []
+      id_dict[arch_id].append(pkg_id)
+    for arch_id in id_dict:
+      arch_dict[nu.GetArch(arch_id)] = nu.GetNvaList(id_dict[arch_id])
+
+  # Sort the binary-independent packages once; merging them into an
+  # architecture list that is sorted on its own is then a linear-time
+  # sort of two runs.
 
   archs = su.GetSetting(None, 'Architectures').split(', ')
   if 'all' in arch_dict:
-    all = arch_dict['all']
+    all = sorted(arch_dict['all'])
     del arch_dict['all']
     for arch in archs:
-      arch_dict.setdefault(arch, [])
-      arch_dict[arch].extend(all)
-      arch_dict[arch].sort()
+      arch_list = sorted(arch_dict.get(arch, []))
+      arch_list.extend(all)
+      arch_list.sort()
+      arch_dict[arch] = arch_list
   return arch_dict
 
 
@@ -100,9 +211,13 @@ def CollectSources(nva_list, pkg_deps, src_info):
   return sorted(src_dict.keys())
 
 
-# The following five version-comparison functions are implemented in
+# The following version-comparison functions are implemented in
 # accordance with Debian Policy 3.7.2, Section 5.6.12, except for
 # tilda (sorted less than everything), which is not yet official.
+# Instead of comparing two versions part by part, they map each
+# version to a sort key (a nested tuple) that Python compares in the
+# same order, so that sorting and selecting versions needs no
+# comparison function.
 
 def _SplitSubVersion(string):
   """Extract initial digit and non-digit parts in a version string
@@ -143,78 +258,170 @@ def _SplitVersion(string):
   return epoch, string[colon+1:uscore], debv
 
 
-def _CompareString(str1, str2):
-  """Compare two strings in Debian lexical order
+def _GetStringKey(string):
+  """Compute the sort key of a non-digit version part
+
+  In Debian lexical order, tilde sorts before the end of the string,
+  which sorts before letters, which sort before all other characters.
+  The key is a tuple of character codes that follow this order, and
+  it ends with the code for the end of the string, so that a string
+  compares correctly with a longer string that it is a prefix of.
   """
 
-  bound = max(len(str1), len(str2))
-  str1 = str1.ljust(bound)
-  str2 = str2.ljust(bound)
-  index = 0
-  while index<bound:
-    c1 = str1[index]
-    c2 = str2[index]
-    if c1 == '~' and c2 != '~':  return -1
-    if c2 == '~' and c1 != '~':  return 1
-    if c1 == ' ' and c2 != ' ':  return -1
-    if c2 == ' ' and c1 != ' ':  return 1
-    a1 = c1.isalpha()
-    a2 = c2.isalpha()
-    if a1 and not a2:  return -1
-    if a2 and not a1:  return 1
-    c = cmp(c1, c2)
-    if c:  return c
-    index = index+1
-  return 0
+  codes = []
+  for ch in string:
+    if ch == '~':
+      codes.append(0)
+    elif ch.isalpha():
+      codes.append(2 + ord(ch))
+    else:
+      codes.append(300 + ord(ch))
+  codes.append(1)
+  return tuple(codes)
+
+
+# The key of the (non-digit, digit) pair that an exhausted version part
+# behaves as in comparisons: an empty string and zero.
+
+_END_OF_PART = ((1,), 0)
+
 
+def _GetSubVersionKey(string):
+  """Compute the sort key of an epoch, upstream, or debian part
 
-def _CompareSubVersion(ver1, ver2):
-  """Compare a specific part of two version strings
+  The key is the tuple of (non-digit key, number) pairs of the part
+  followed by _END_OF_PART.  The first pair is always present (it is
+  _END_OF_PART itself for an empty part), and every later pair has a
+  non-empty non-digit string, so _END_OF_PART compares with a later
+  pair the same way as an exhausted part does.
   """
 
-  while ver1 != '' or ver2 != '':
-    s1, n1, ver1 = _SplitSubVersion(ver1)
-    s2, n2, ver2 = _SplitSubVersion(ver2)
-    c = _CompareString(s1, s2)
-    if c != 0:  return c
-    c = cmp(int(n1), int(n2))
-    if c != 0:  return c
-  return 0
+  pairs = []
+  while True:
+    s, n, string = _SplitSubVersion(string)
+    pairs.append((_GetStringKey(s), int(n)))
+    if string == '':  break
+  pairs.append(_END_OF_PART)
+  return tuple(pairs)
+
+
+# Sort keys of the versions interned in nva_utils, indexed by version
+# ID (None for versions whose keys have not been computed yet).
+
+_version_keys = []
+
+
+def GetVersionKey(version):
+  """Compute the sort key of a full version string (Policy 5.6.12)
+
+  Two versions compare (with cmp) the same way as their keys do.  The
+  keys are cached by the version ID in nva_utils.
+  """
+
+  version_id = nu.GetVersionId(version)
+  if version_id >= len(_version_keys):
+    _version_keys.extend([None] * (nu.GetVersionCount()-len(_version_keys)))
+  key = _version_keys[version_id]
+  if key is None:
+    e, u, d = _SplitVersion(version)
+    key = _GetSubVersionKey(e), _GetSubVersionKey(u), _GetSubVersionKey(d)
+    _version_keys[version_id] = key
+  return key
 
 
 def CompareVersion(ver1, ver2):
   """Compare two full version strings (Policy 5.6.12)
   """
 
-  e1, u1, d1 = _SplitVersion(ver1)
-  e2, u2, d2 = _SplitVersion(ver2)
-
-  c = _CompareSubVersion(e1, e2)
-  if c != 0:  return c
-  c = _CompareSubVersion(u1, u2)
-  if c != 0:  return c
-  return _CompareSubVersion(d1, d2)
+  return cmp(GetVersionKey(ver1), GetVersionKey(ver2))
 
 
 def SelectLatestPackages(nva_list):
   """Select the latest packages from the given list
+
+  Long lists take a NumPy batch path, which ranks the versions and
+  selects the latest package of each name and architecture with
+  vectorized sorting.
   """
 
-  ver_dict = {}
-  for nva in nva_list:
-    desc = nva.split('_')
-    na = desc[0], desc[2]
-    ver = desc[1]
-    if na in ver_dict:
-      current_ver = ver_dict[na]
-      if CompareVersion(ver, current_ver) <= 0:
+  if _UseBatch(nva_list):
+
+    # Sort the packages by (name, arch) group and by version rank in
+    # descending order (a stable sort keeps the first of equal
+    # versions), and take the first package in each group.
+
+    pkg_ids, name_ids, version_ids, arch_ids = _GetColumns(nva_list)
+    groups = (name_ids.astype(numpy.int64) * (int(arch_ids.max())+1) +
+              arch_ids)
+    ranks = _GetVersionRanks(version_ids)
+    max_rank = int(ranks.max())
+    order = numpy.argsort(groups * (max_rank+1) + (max_rank-ranks),
+                          kind='mergesort')
+    sorted_groups = groups[order]
+    first = numpy.ones(len(order), dtype=bool)
+    first[1:] = sorted_groups[1:] != sorted_groups[:-1]
+    return sorted(nu.GetNvaList(pkg_ids[order[first]].tolist()))
+
+  latest = {}
+  for pkg_id in nu.InternList(nva_list):
+    name_id, version_id, arch_id = nu.Split(pkg_id)
+    key = name_id, arch_id
+    if key in latest:
+      current_id = nu.Split(latest[key])[1]
+      if (GetVersionKey(nu.GetVersion(version_id)) <=
+          GetVersionKey(nu.GetVersion(current_id))):
         continue
-    ver_dict[na] = ver
+    latest[key] = pkg_id
+  return sorted(nu.GetNvaList(latest.values()))
+
+
+def UpdateLatestPackage(latest_db, nva):
+  """Record a newly indexed package in the pkg_latest table
+
+  The pkg_latest table maps a name_arch string to the highest version
+  of that package indexed so far, so that finding the latest packages
+  in the pool does not require scanning every version ever indexed.
+  This function updates the table in constant time per package.
+  """
+
+  [n, v, a] = nva.split('_')
+  key = n + '_' + a
+  if key in latest_db:
+    if GetVersionKey(v) <= GetVersionKey(latest_db[key]):
+      return
+  latest_db[key] = v
 
+
+def BuildLatestPackages(latest_db, pkg_info):
+  """Build the pkg_latest table if the repository predates it
+
+  If pkg_latest is empty but pkg_info is not (i.e., the repository was
+  created before the pkg_latest table existed), this function builds
+  the table from pkg_info.  It must run before any package is recorded
+  with UpdateLatestPackage(), which would otherwise leave a partial
+  table that is never rebuilt.
+  """
+
+  if not bu.FindKeyStartingWith('', latest_db):
+    if bu.FindKeyStartingWith('', pkg_info):
+      lg.info('Building the pkg_latest table from pkg_info')
+      for nva in SelectLatestPackages(pkg_info):
+        UpdateLatestPackage(latest_db, nva)
+
+
+def ListLatestPackages(latest_db, pkg_info):
+  """List the latest version of every package in the pool
+
+  This function returns the same result as SelectLatestPackages() on
+  the whole pkg_info table, but it reads the pkg_latest table instead
+  (building it first with BuildLatestPackages() if necessary).
+  """
+
+  BuildLatestPackages(latest_db, pkg_info)
   latest = []
-  for name, arch in ver_dict:
-    ver = ver_dict[(name, arch)]
-    latest.append('_'.join([name, ver, arch]))
+  for key in latest_db:
+    [n, a] = key.split('_')
+    latest.append('_'.join([n, latest_db[key], a]))
   return sorted(latest)
 
 
@@ -224,89 +431,201 @@ _RELEASE_KEYS = ['Archive', 'Version', 'Component', 'Origin',
                  'Label', 'Architecture', 'Description']
 
 
-def _WriteInfoFile(info_dict, keys, rel_dict, name):
+def _WriteInfoFile(info_dict, keys, rel_dict, name, history=None):
   """Write a Sources/Packages file with Release
 
   This function writes the Release file for a leaf dists/ directory
   and the corresponding package information file (Packages for
   binary-arch and Sources for source).  The keys argument is the list
   of packages for the information file (nva for binary-arch and nv for
-  source), and name is the name for the information file.
+  source), and name is the name for the information file.  If history
+  is given, the function also writes pdiffs against the previous
+  releases in it (see pd.WriteIndexDiffs).  The return value is the
+  list of pb.PublishString() reports of the files written, from which
+  the top-level Release file is assembled.
   """
 
   path, filename = os.path.split(name)
   if not os.path.exists(path):
-    os.makedirs(path, 0755)
+    ou.MakeDirs(path)
 
   # Write the Release file.
 
-  f = open(os.path.join(path, 'Release'), 'w')
+  release = ''
   for key in _RELEASE_KEYS:
     if rel_dict[key] is None:  continue
-    f.write(key + ': ')
-    f.write(rel_dict[key])
-    f.write('\n')
-  f.close()
+    release = release + key + ': ' + rel_dict[key] + '\n'
+  reports = [pb.PublishString(os.path.join(path, 'Release'), release)]
 
-  # Write the Packages/Sources file.
+  # Write the Packages/Sources file and a gzipped copy.  The files go
+  # into the by-hash layout (see publish_utils), so that clients that
+  # are reading the previous Release while we republish still find the
+  # files it refers to.
 
-  f = open(name, 'w')
-  for key in keys:
-    f.write(info_dict[key])
-    f.write('\n\n')
-  f.close()
+  text = ''.join([info_dict[key] + '\n\n' for key in keys])
+  reports.append(pb.PublishString(name, text))
+  reports.append(pb.PublishString(name + '.gz', ou.GzipString(text)))
 
-  # Make a gzipped copy.  The -n flag asks gzip not to include the
-  # file timestamp in the compressed result so that files generated
-  # from different runs will have the same cryptographic hash values.
+  if history is not None:
+    reports.extend(pd.WriteIndexDiffs(name, info_dict, keys,
+                                      rel_dict['Version'], history))
+  return reports
 
-  shutil.copy(name, name + '.copy')
-  ou.SpawnProgram(['/bin/gzip', '-9', '-n', '-f', name])
-  os.rename(name + '.copy', name)
+
+def _FetchEntries(table, key_lists):
+  """Read the table entries for the keys in a list of key lists
+  """
+
+  entries = {}
+  for keys in key_lists:
+    for key in keys:
+      if key not in entries:
+        entries[key] = table[key]
+  return entries
+
+
+# The arguments of _WriteInfoFile() for each index file being written
+# by _WriteInfoFiles().  Worker processes inherit this list when they
+# are forked, so the (large) package information entries do not have
+# to be sent to them.
+
+_jobs = None
+
+
+def _RunInfoFileJob(index):
+  """Run _WriteInfoFile() for an entry in _jobs
+  """
+
+  info_dict, keys, rel_dict, name, history = _jobs[index]
+  return lu.RunWithSpan('_WriteInfoFile', _WriteInfoFile,
+                        info_dict, keys, rel_dict, name, history)
+
+
+def _RunInfoFileWorker(index):
+  """Run _RunInfoFileJob() in a worker process
+
+  The worker returns its own timing report along with the result, so
+  that the parent can merge it into the report of the release.
+  """
+
+  lu.ResetReport()
+  result = _RunInfoFileJob(index)
+  return result, lu.GetReport()
+
+
+def GetWorkerCount():
+  """Get the number of worker processes for parallel work
+
+  The Workers setting in the repository configuration overrides the
+  default, which is the number of processors on the system.  Without
+  the multiprocessing module (before Python 2.6) there is only one.
+  """
+
+  if multiprocessing is None:
+    return 1
+  workers = su.GetSetting(None, 'Workers')
+  if workers is not None:
+    return max(int(workers), 1)
+  try:
+    return multiprocessing.cpu_count()
+  except NotImplementedError:
+    return 1
+
+
+def _WriteInfoFiles(jobs):
+  """Write a list of Sources/Packages files in parallel
+
+  Each job is a tuple of _WriteInfoFile() arguments.  The index files
+  of a release are independent of each other, and the work of writing
+  them (compression and hashing) is CPU-bound, so this function spreads
+  the jobs over a pool of worker processes.  It returns the results of
+  the jobs in order after all of them are done.
+  """
+
+  global _jobs
+
+  _jobs = jobs
+  try:
+    workers = min(GetWorkerCount(), len(jobs))
+    if workers < 2:
+      return [_RunInfoFileJob(index) for index in range(len(jobs))]
+    pool = multiprocessing.Pool(workers)
+    try:
+      results = []
+      for result, report in pool.map(_RunInfoFileWorker,
+                                     range(len(jobs))):
+        lu.MergeReport(report)
+        results.append(result)
+      pool.close()
+      return results
+    finally:
+      pool.terminate()
+      pool.join()
+  finally:
+    _jobs = None
 
 
 # These are the attribute keys in top-level Release files.
 
 _TOP_RELEASE_KEYS = ['Origin', 'Label', 'Suite', 'Version',
                      'Codename', 'Date', 'Architectures',
-                     'Components', 'Description']
+                     'Components', 'Acquire-By-Hash', 'Description']
+
+
+# These are the checksum sections of top-level Release files, along
+# with the hash algorithm that each of them uses.
+
+_TOP_RELEASE_SUMS = [('MD5Sum', 'md5'), ('SHA1', 'sha1'),
+                     ('SHA256', 'sha256'), ('SHA512', 'sha512')]
 
 
-def _WriteTopReleaseFile(rel_dict):
+def _WriteTopReleaseFile(rel_dict, reports):
   """Write release-top-level Release file
-  """
 
-  def DoFingerPrint(files, path, names):
-    for name in sorted(names):
-      pathname = os.path.join(path, name)
-      if not os.path.isfile(pathname):
-        continue
-      files.append(('/'.join(pathname.split('/')[3:]),
-                    str(os.path.getsize(pathname)),
-                    cu.GetMD5Hash(pathname),
-                    cu.GetSHA1Hash(pathname)))
+  The reports argument is the list of (name, size, digests) reports
+  of all the files published in the release directory (see
+  publish_utils), which supply the file checksums without reading any
+  file back from disk.  The Release file is written and signed under
+  a temporary name.  At the very end, after all the files it lists are
+  in place, the Release file is renamed into place, followed by its
+  detached signature (Release.gpg) and clear-signed copy (InRelease).
+  """
 
-  dist_files = []
   archive = rel_dict['Archive']
   version = rel_dict['Version']
   path = os.path.join('dists', archive, version)
-  os.path.walk(path, DoFingerPrint, dist_files)
+
+  dist_files = {}
+  for pathname, size, digests in reports:
+    relative = pathname[len(path)+1:]
+    dist_files[relative] = str(size), digests
+  relative_list = sorted(dist_files.keys())
 
   name = os.path.join(path, 'Release')
-  f = open(name, 'w')
+  temp = name + '.' + str(os.getpid())
+  f = open(temp, 'w')
   for key in _TOP_RELEASE_KEYS:
     if rel_dict[key] is None:  continue
     f.write(key + ': ')
     f.write(rel_dict[key])
     f.write('\n')
-  f.write('MD5Sum:\n')
-  for p, s, md5, sha1 in dist_files:
-    f.write(' '.join(['', md5, s.rjust(16), p]) + '\n')
-  f.write('SHA1:\n')
-  for p, s, md5, sha1 in dist_files:
-    f.write(' '.join(['', sha1, s.rjust(16), p]) + '\n')
+  for field, algo in _TOP_RELEASE_SUMS:
+    f.write(field + ':\n')
+    for relative in relative_list:
+      size, digests = dist_files[relative]
+      f.write(' '.join(['', digests[algo], size.rjust(16), relative]))
+      f.write('\n')
   f.close()
-  cu.MakeReleaseSignature(name)
+  signed = lu.RunWithSpan('MakeReleaseSignature', cu.MakeReleaseSignature,
+                          temp)
+  os.rename(temp, name)
+  signatures = [('.gpg', name + '.gpg'),
+                ('.inline', os.path.join(path, 'InRelease'))]
+  for suffix, signature in signatures:
+    if signed:
+      os.rename(temp + suffix, signature)
+    else:
+      ou.IgnoreOSError(os.remove, signature)
 
 
 def _LoadReleaseInfo(track, version):
@@ -328,6 +647,7 @@ def _LoadReleaseInfo(track, version):
   rel_dict['Origin'] = su.GetSetting(track, 'Origin')
   rel_dict['Label'] = su.GetSetting(track, 'Label')
   rel_dict['Description'] = su.GetSetting(track, 'Description')
+  rel_dict['Acquire-By-Hash'] = 'yes'
   return rel_dict
 
 
@@ -341,6 +661,7 @@ def _GenerateReleaseWithDB(track, version, packages, dbs):
   (version is None).
   """
 
+  start = time.time()
   pkg_info = dbs['pkg_info']
   src_info = dbs['src_info']
   pkg_deps = du.ParseDependencyTable(dbs['pkg_deps'])
@@ -361,7 +682,6 @@ def _GenerateReleaseWithDB(track, version, packages, dbs):
     packages, release = result
     new_release = False
     version = release.split('/')[1]
-    shutil.rmtree(os.path.join('dists', release), ignore_errors=True)
   elif version is None and packages is not None:
     version = str(_GetNextReleaseNumber(track, releases))
   else:
@@ -384,6 +704,33 @@ def _GenerateReleaseWithDB(track, version, packages, dbs):
   comp_dict = GroupByComponent(packages, pkg_deps)
   rel_dict = _LoadReleaseInfo(track, version)
 
+  # Collect the Packages indexes of the previous releases in the track
+  # if the track asks for pdiffs (the PDiffs setting is the number of
+  # previous releases to make diffs against).
+
+  pdiff_history = None
+  pdiff_count = su.GetSetting(track, 'PDiffs')
+  if pdiff_count is not None:
+    pdiff_history = []
+    count = int(pdiff_count)
+    prevs = _GetPreviousReleases(track, version, releases, count)
+    prevs.reverse()
+    for prev in prevs:
+      prev_packages = releases[track + '/' + prev].split(', ')
+      pdiff_history.append(
+        (prev, _GroupByIndex(prev_packages, pkg_deps, True)))
+
+  # Read the package information entries needed by the index files
+  # (including the previous releases for pdiffs) into memory, so that
+  # the index files can be written in parallel worker processes.
+
+  key_lists = [packages]
+  for prev, prev_dict in pdiff_history or []:
+    key_lists.extend(prev_dict.values())
+  pkg_entries = _FetchEntries(pkg_info, key_lists)
+  src_entries = {}
+  jobs = []
+
   for comp in comp_dict:
     rel_dict['Component'] = comp
     comp_dir = os.path.join('dists', track, version, comp)
@@ -394,14 +741,41 @@ def _GenerateReleaseWithDB(track, version, packages, dbs):
     for arch in arch_dict:
       rel_dict['Architecture'] = arch
       output = os.path.join(comp_dir, 'binary-'+arch, 'Packages')
-      _WriteInfoFile(pkg_info, arch_dict[arch], rel_dict, output)
+      history = None
+      if pdiff_history is not None:
+        history = []
+        for prev, prev_dict in pdiff_history:
+          if (comp, arch) in prev_dict:
+            history.append((prev, prev_dict[(comp, arch)]))
+      jobs.append((pkg_entries, arch_dict[arch], dict(rel_dict),
+                   output, history))
 
     # Write Release and Sources files for the source directory.
 
     rel_dict['Architecture'] = 'source'
     output = os.path.join(comp_dir, 'source', 'Sources')
     nvs = CollectSources(comp_dict[comp], pkg_deps, src_info)
-    _WriteInfoFile(src_info, nvs, rel_dict, output)
+    src_entries.update(_FetchEntries(src_info, [nvs]))
+    jobs.append((src_entries, nvs, dict(rel_dict), output, None))
+
+  reports = []
+  for job_reports in lu.RunWithSpan('_WriteInfoFiles', _WriteInfoFiles,
+                                    jobs):
+    reports.extend(job_reports)
+
+  # Write the Contents files for apt-file, reusing the ones of the
+  # previous release in the track where possible.
+
+  if su.GetSetting(track, 'Contents') != 'no':
+    previous = {}
+    for prev in _GetPreviousReleases(track, version, releases, 1):
+      prev_packages = releases[track + '/' + prev].split(', ')
+      previous = _GroupByIndex(prev_packages, pkg_deps)
+    reports.extend(
+      lu.RunWithSpan('WriteContentsFiles', co.WriteContentsFiles,
+                     os.path.join('dists', track, version),
+                     _GroupByIndex(packages, pkg_deps), previous,
+                     pkg_info, dbs['file_pkg']))
 
   # Write the top-level Release file.
 
@@ -412,14 +786,73 @@ def _GenerateReleaseWithDB(track, version, packages, dbs):
     if not comp.endswith('/debian-installer'):
       comp_list.append(comp)
   rel_dict['Components'] = ' '.join(sorted(comp_list))
-  _WriteTopReleaseFile(rel_dict)
+  release_dir = os.path.join('dists', track, version)
+  keep = pb.ReadReleaseDigests(os.path.join(release_dir, 'Release'))
+  lu.RunWithSpan('_WriteTopReleaseFile', _WriteTopReleaseFile,
+                 rel_dict, reports)
 
   # Update database tables to record the new release
 
   if new_release:
     releases[track+'/'+version] = ', '.join(packages)
-    au.UpdateAlias(aliases, releases, track+'/latest', version)
+    au.UpdateAlias(aliases, dbs['alias_log'], releases,
+                   track+'/latest', version)
     au.RefreshAlias(aliases)
+    if su.GetSetting(track, 'Contents') != 'no':
+      lu.RunWithSpan('_PruneContentsCache', _PruneContentsCache,
+                     releases, pkg_deps)
+
+  # Remove the by-hash files that neither this Release nor the one it
+  # replaced lists, and the stored files that nothing links to.
+
+  for _name, _size, digests in reports:
+    keep[digests['sha256']] = None
+  lu.RunWithSpan('CollectGarbage', pb.CollectGarbage, release_dir, keep)
+
+  # Keep the timing report of the release generation next to it (it
+  # is not listed in the Release file).
+
+  mu.SetMetric('release_generation_seconds', time.time()-start,
+               {'track': track})
+  lu.WriteReport(os.path.join('dists', track, version, 'timing.json'))
+
+
+def _GroupByIndex(nva_list, pkg_deps, installer=False):
+  """Categorize packages by (component, architecture) index
+
+  This function groups binary packages the way they are laid out in
+  the binary-arch index directories of a release, with
+  binary-independent packages in every architecture.  The
+  debian-installer subcomponents are left out unless the installer
+  flag is set.
+  """
+
+  index_dict = {}
+  comp_dict = GroupByComponent(nva_list, pkg_deps)
+  for comp in comp_dict:
+    if comp.endswith('/debian-installer') and not installer:  continue
+    arch_dict = GroupByArch(comp_dict[comp])
+    for arch in arch_dict:
+      index_dict[(comp, arch)] = arch_dict[arch]
+  return index_dict
+
+
+def _PruneContentsCache(release_db, pkg_deps):
+  """Prune the Contents cache to the latest release of each track
+
+  A new release reuses or updates the cached Contents files of the
+  previous release in its track, so only the files of the latest
+  release of each track are kept.  Republishing an older release
+  regenerates its Contents files.
+  """
+
+  package_lists = []
+  for track in su.ListTracks():
+    if su.GetSetting(track, 'Contents') == 'no':  continue
+    for version in _GetPreviousReleases(track, sys.maxint, release_db, 1):
+      packages = release_db[track + '/' + version].split(', ')
+      package_lists.extend(_GroupByIndex(packages, pkg_deps).values())
+  co.PruneCache(package_lists)
 
 
 def GenerateReleaseVersion(track, version):
@@ -462,33 +895,64 @@ def _GetNextReleaseNumber(track, release_db):
   return version+1
 
 
+def _GetPreviousReleases(track, version, release_db, count):
+  """List the releases in a track that precede the given version
+
+  This function returns the version numbers (as strings) of up to
+  count releases in the track whose numbers are lower than version,
+  with the latest first.
+  """
+
+  versions = []
+  for key in release_db:
+    [t, v] = key.split('/', 1)
+    if t == track and int(v) < int(version):
+      versions.append(int(v))
+  versions.sort()
+  versions.reverse()
+  return [str(v) for v in versions[:count]]
+
+
+# These regular expressions match the blank lines that separate the
+# paragraphs of a Packages file and the fields that identify a package
+# in a paragraph.
+
+_PARAGRAPH_BREAK_RE = re.compile(r'\n[ \t]*\n')
+
+_PACKAGES_FIELD_RE = re.compile(r'^(Package|Version|Architecture): (.*?)\s*$',
+                                re.M)
+
+
 def GetUpstreamReleaseList(dist_dir):
   """Return the list of packages mentioned in Packages files
 
   This function walks through the given path, finds all Packages files
   in subdirectories, and compiles a list of all binary packages
-  mentioned in those Packages files.
+  mentioned in those Packages files.  A package is identified by the
+  Package, Version, and Architecture fields of its paragraph, in
+  whatever order they appear.
   """
 
-  def DoTraverse(_arg, dir, _names):
-    name = os.path.join(dir, 'Packages')
-    ou.RunWithFileInput(DoParse, name)
-
-  def DoParse(lines):
-    try:
-      name = ''
-      arch = ''
-      for line in lines:
-        line = line.rstrip('\n')
-        if line.startswith('Package: '):
-          name = line.split(' ', 1)[1]
-        if line.startswith('Architecture: '):
-          arch = line.split(' ', 1)[1]
-        if line.startswith('Version: '):
-          version = line.split(' ', 1)[1]
-          pkg_dict['_'.join([name, version, arch])] = None
-    except IOError:
-      pass
+  def DoTraverse(_arg, dir, names):
+    if 'Packages' in names:
+      ou.RunWithFileBuffer(DoParse, os.path.join(dir, 'Packages'))
+
+  def DoParse(buffer):
+    start = 0
+    for match in _PARAGRAPH_BREAK_RE.finditer(buffer):
+      AddPackage(buffer[start:match.start()+1])
+      start = match.end()
+    AddPackage(buffer[start:])
+
+  def AddPackage(paragraph):
+    fields = {}
+    for match in _PACKAGES_FIELD_RE.finditer(paragraph):
+      key, value = match.groups()
+      fields[key] = value
+    if len(fields) == 3:
+      nva = '_'.join([fields['Package'], fields['Version'],
+                      fields['Architecture']])
+      pkg_dict[nva] = None
 
   pkg_dict = {}
   if not os.path.isdir(dist_dir):
@@ -598,15 +1062,21 @@ def CollectPackageVersions(pkg_iter):
   versions are sorted in descending order (latest first).
   """
 
-  ver_dict = {}
+  id_dict = {}
   for nva in pkg_iter:
-    [n, v, a] = nva.split('_')
-    if (n, a) not in ver_dict:
-      ver_dict[(n, a)] = []
-    ver_dict[(n, a)].append(v)
-  for key in ver_dict:
-    ver_dict[key].sort(CompareVersion)
-    ver_dict[key].reverse()
+    name_id, version_id, arch_id = nu.Split(nu.Intern(nva))
+    key = name_id, arch_id
+    if key not in id_dict:
+      id_dict[key] = []
+    id_dict[key].append(version_id)
+
+  ver_dict = {}
+  for name_id, arch_id in id_dict:
+    versions = [nu.GetVersion(version_id)
+                for version_id in id_dict[(name_id, arch_id)]]
+    versions.sort(key=GetVersionKey)
+    versions.reverse()
+    ver_dict[(nu.GetName(name_id), nu.GetArch(arch_id))] = versions
   return ver_dict
 
 
@@ -619,18 +1089,20 @@ def FilterVersionWithFile(ver_dict, name):
   """
 
   def DoFilter(lines):
-    try:
-      stripped = []
-      for line in lines:
-        line = line.split('#')[0]
-        if line == '' or line.isspace():  continue
-        stripped.append(line.rstrip('\n'))
-      return _FilterVersionWithList(ver_dict, stripped)
-    except IOError:
-      lg.debug('Release spec file ' + name + ' does not exist')
-      return ver_dict
-
-  return ou.RunWithFileInput(DoFilter, name)
+    stripped = []
+    for line in lines:
+      line = line.split('#')[0]
+      if line == '' or line.isspace():  continue
+      stripped.append(line.rstrip('\n'))
+    return _FilterVersionWithList(ver_dict, stripped)
+
+  if not os.path.exists(name):
+    lg.debug('Release spec file ' + name + ' does not exist')
+    return ver_dict
+  filtered = ou.RunWithFileInput(DoFilter, name)
+  if filtered is None:
+    return ver_dict
+  return filtered
 
 
 def _FilterVersionWithList(ver_dict, relations):
@@ -679,18 +1151,19 @@ def CutOffVersions(ver_dict, nvas):
   """
 
   cut = {}
-  for nva in nvas:
-    [n, v, a] = nva.split('_')
-    key = n, a
+  for pkg_id in nu.InternList(nvas):
+    name_id, version_id, arch_id = nu.Split(pkg_id)
+    key = nu.GetName(name_id), nu.GetArch(arch_id)
     if key not in ver_dict:
-      lg.error('There are no packages like ' + nva)
+      lg.error('There are no packages like ' + nu.GetNva(pkg_id))
       continue
+    version_key = GetVersionKey(nu.GetVersion(version_id))
     while ver_dict[key] != []:
-      if CompareVersion(ver_dict[key][0], v) <= 0:
+      if GetVersionKey(ver_dict[key][0]) <= version_key:
         break
       ver_dict[key].pop(0)
     if ver_dict[key] == []:
-      lg.error('There are no versions below ' + nva)
+      lg.error('There are no versions below ' + nu.GetNva(pkg_id))
     else:
       cut[key] = ver_dict[key]
   return cut
@@ -0,0 +1,342 @@
+#!/usr/bin/python
+#
+# Copyright 2006 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""Script to serve a repository over HTTP
+
+The serve_repository.py script is a repository-administrator command
+that serves the dists/ and pool/ hierarchies of a repository over HTTP
+with a thread per connection.  It supports range requests and
+conditional requests (with ETag values derived from the SHA256 hash
+values of published dists/ files), and it marks pool files and by-hash
+files, which never change, as cacheable for a long time.
+"""
+
+__author__ = 'cklin@google.com (Chuan-Kai Lin)'
+
+import BaseHTTPServer
+import email.Utils as eu
+import logging as lg
+import optparse
+import os
+import SocketServer
+import stat
+import sys
+import urllib
+import urlparse
+import logging_utils as lu
+
+
+_CHUNK_SIZE = 1048576
+
+_SERVED_DIRS = ['dists', 'pool']
+
+# Cache-Control values for files that never change (pool files and
+# by-hash files) and for files that may be replaced (everything else
+# in dists/, including paths through alias symlinks).
+
+_IMMUTABLE_CACHE = 'public, max-age=31536000'
+_MUTABLE_CACHE = 'public, max-age=0, must-revalidate'
+
+_MIME_TYPES = { '.deb':  'application/vnd.debian.binary-package',
+                '.udeb': 'application/vnd.debian.binary-package',
+                '.gz':   'application/x-gzip',
+                '.gpg':  'application/pgp-signature' }
+
+
+# The digest cache maps the (device, inode, size, mtime) keys of files
+# to their SHA256 hash values (or None if they have none), so that the
+# by-hash directory of a file is scanned only the first time the file
+# is served.  Published files are never modified in place, so a key
+# always refers to the same contents.  The cache is simply cleared when
+# it grows beyond _DIGEST_CACHE_SIZE entries.
+
+_DIGEST_CACHE_SIZE = 100000
+
+_digest_cache = {}
+
+
+def _GetFileKey(info):
+  return info.st_dev, info.st_ino, info.st_size, info.st_mtime
+
+
+def _LookupStoreDigest(path, info):
+  """Find the SHA256 hash value of a published file
+
+  A file published in dists/ is a hard link to the file named by its
+  SHA256 hash value in the by-hash/SHA256/ directory next to it (see
+  publish_utils).  A by-hash path names its hash value directly; for
+  any other path, this function looks for the entry with the same
+  inode in that one directory (and caches all the entries it finds
+  there).  It returns None if there is none.
+  """
+
+  parts = path.split('/')
+  if len(parts) > 2 and parts[-3:-1] == ['by-hash', 'SHA256']:
+    return parts[-1]
+  key = _GetFileKey(info)
+  if key in _digest_cache:
+    return _digest_cache.get(key)
+
+  if len(_digest_cache) > _DIGEST_CACHE_SIZE:
+    _digest_cache.clear()
+  _digest_cache[key] = None
+  by_hash = os.path.join(os.path.dirname(path), 'by-hash', 'SHA256')
+  try:
+    names = os.listdir(by_hash)
+  except OSError:
+    return None
+  for name in names:
+    try:
+      link_info = os.stat(os.path.join(by_hash, name))
+    except OSError:
+      continue
+    _digest_cache[_GetFileKey(link_info)] = name
+  return _digest_cache.get(key)
+
+
+def _GetETag(path, info):
+  """Compute the entity tag of a file from its path and stat info
+  """
+
+  digest = _LookupStoreDigest(path, info)
+  if digest is not None:
+    return '"' + digest + '"'
+  return '"%x-%x-%x"' % (info.st_ino, info.st_size, int(info.st_mtime))
+
+
+def _ParseRange(header, size):
+  """Parse a Range header into a (first, last) byte position pair
+
+  This function handles only single byte ranges, which is what apt
+  uses to resume downloads.  It returns None if the request should be
+  answered with the full file (no range or an unsupported one), and
+  it returns False if the range cannot be satisfied.
+  """
+
+  if header is None or not header.startswith('bytes='):
+    return None
+  spec = header[6:].strip()
+  if ',' in spec or '-' not in spec:
+    return None
+  first, last = spec.split('-', 1)
+  try:
+    if first:
+      first = int(first)
+      if last:
+        last = min(int(last), size-1)
+      else:
+        last = size-1
+    else:
+      first = max(size-int(last), 0)
+      last = size-1
+  except ValueError:
+    return None
+  if first > last or first >= size:
+    return False
+  return first, last
+
+
+def _IsImmutable(path):
+  """Check whether a served path refers to a file that never changes
+  """
+
+  parts = path.split('/')
+  return parts[0] == 'pool' or 'by-hash' in parts
+
+
+def _CopyFile(fin, wfile, offset, count):
+  """Send part of a file to the client in chunks
+  """
+
+  fin.seek(offset)
+  while count > 0:
+    chunk = fin.read(min(count, _CHUNK_SIZE))
+    if not chunk:  break
+    wfile.write(chunk)
+    count = count - len(chunk)
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+
+class _RepositoryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """HTTP request handler for dists/ and pool/ files
+
+  The handler opens the requested file first and takes all header
+  information from the open file.  Since dists/ files and alias
+  symlinks are only ever replaced by atomic renames, each response
+  comes entirely from either the old or the new version of a file.
+  """
+
+  protocol_version = 'HTTP/1.1'
+  server_version = 'Debmarshal/0.0'
+
+  def do_GET(self):
+    self._Serve(True)
+
+  def do_HEAD(self):
+    self._Serve(False)
+
+  def log_message(self, format, *args):
+    lg.info(self.address_string() + ' ' + (format % args))
+
+  def _GetPath(self):
+    """Map the request path to a relative path in the repository
+
+    The path is normalized before its first component is checked, so
+    a request cannot reach outside dists/ and pool/ with '..'.
+    """
+
+    path = urllib.unquote(urlparse.urlparse(self.path)[2])
+    path = os.path.normpath(path.lstrip('/'))
+    if path.split('/')[0] not in _SERVED_DIRS:
+      return None
+    return path
+
+  def _IsNotModified(self, etag, mtime):
+    """Check the conditional request headers against the file
+    """
+
+    match = self.headers.getheader('If-None-Match')
+    if match is not None:
+      tags = [tag.strip() for tag in match.split(',')]
+      return etag in tags or '*' in tags
+    since = self.headers.getheader('If-Modified-Since')
+    if since is not None:
+      since = eu.parsedate_tz(since)
+      if since is not None:
+        return int(mtime) <= eu.mktime_tz(since)
+    return False
+
+  def _UseRange(self, etag, mtime):
+    """Check the If-Range header (if any) against the file
+    """
+
+    condition = self.headers.getheader('If-Range')
+    if condition is None:
+      return True
+    if condition.startswith('"'):
+      return condition == etag
+    date = eu.parsedate_tz(condition)
+    return date is not None and int(mtime) == eu.mktime_tz(date)
+
+  def _Serve(self, send_body):
+    path = self._GetPath()
+    if path is None:
+      self.send_error(404)
+      return
+    try:
+      fin = open(path, 'rb')
+    except IOError:
+      self.send_error(404)
+      return
+    try:
+      info = os.fstat(fin.fileno())
+      if not stat.S_ISREG(info.st_mode):
+        self.send_error(404)
+        return
+      size = info.st_size
+      etag = _GetETag(path, info)
+      mtime = info.st_mtime
+
+      def SendHeaders(code, length):
+        self.send_response(code)
+        self.send_header('Content-Length', str(length))
+        self.send_header('Last-Modified', eu.formatdate(mtime, usegmt=True))
+        self.send_header('ETag', etag)
+        self.send_header('Accept-Ranges', 'bytes')
+        if _IsImmutable(path):
+          self.send_header('Cache-Control', _IMMUTABLE_CACHE)
+        else:
+          self.send_header('Cache-Control', _MUTABLE_CACHE)
+
+      if self._IsNotModified(etag, mtime):
+        self.send_response(304)
+        self.send_header('ETag', etag)
+        self.end_headers()
+        return
+
+      byte_range = None
+      if self._UseRange(etag, mtime):
+        byte_range = _ParseRange(self.headers.getheader('Range'), size)
+      if byte_range is False:
+        self.send_response(416)
+        self.send_header('Content-Range', 'bytes */' + str(size))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return
+
+      if byte_range is None:
+        first, last = 0, size-1
+        SendHeaders(200, size)
+      else:
+        first, last = byte_range
+        SendHeaders(206, last-first+1)
+        self.send_header('Content-Range', 'bytes %d-%d/%d' %
+                         (first, last, size))
+      extension = os.path.splitext(path)[1]
+      self.send_header('Content-Type',
+                       _MIME_TYPES.get(extension, 'text/plain'))
+      self.end_headers()
+      if send_body:
+        _CopyFile(fin, self.wfile, first, last-first+1)
+    finally:
+      fin.close()
+
+
+def _ParseCommandLine():
+  """Parse command line options and arguments
+  """
+
+  usage = 'usage: %prog [options] [REPOSITORY]'
+  version = 'Debmarshall 0.0'
+  parser = optparse.OptionParser(usage=usage, version=version)
+
+  parser.add_option('-a', '--address',
+                    dest='address', metavar='ADDRESS', default='',
+                    help='listen on ADDRESS (default: all interfaces)')
+  parser.add_option('-p', '--port',
+                    dest='port', metavar='PORT', type='int', default=80,
+                    help='listen on PORT (default: 80)')
+
+  options, proper = parser.parse_args()
+  if len(proper) > 1:
+    lg.error('Only one repository directory should be given')
+    sys.exit()
+  if proper:
+    return options, os.path.abspath(proper[0])
+  return options, os.getcwd()
+
+
+def main(repo_dir, address, port):
+  lu.SetLogConsole()
+  os.chdir(repo_dir)
+  server = _ThreadingHTTPServer((address, port), _RepositoryHandler)
+  lg.info('Serving ' + repo_dir + ' on port ' + str(port))
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    lg.info('Received keyboard interrupt, terminating...')
+
+
+if __name__ == '__main__':
+  options, repo_dir = _ParseCommandLine()
+  main(repo_dir, options.address, options.port)
@@ -1,4 +1,4 @@
-#!/usr/bin/python2.4
+#!/usr/bin/python
 #
 # Copyright 2006 Google Inc.
 #
@@ -27,13 +27,20 @@ provide the same installed file.
 
 __author__ = 'cklin@google.com (Chuan-Kai Lin)'
 
+import heapq
 import logging as lg
-import signal
-import sys
 import bsddb_utils as bu
+import crypto_utils as cu
 import deb_utils as du
 import logging_utils as lu
+import nva_utils as nu
 import release_utils as ru
+import setting_utils as su
+
+try:
+  import multiprocessing
+except ImportError:
+  multiprocessing = None
 
 
 _package = None
@@ -42,6 +49,50 @@ _depi = None
 _essential = None
 _notified = None
 _relation_pkg = None
+_timed_out = False
+_step_budget = None
+
+# The default number of packages the dependency solver may try before
+# giving up on a problem (see the VerifySteps setting), and the kinds
+# of changes recorded in its undo trail.
+
+_DEFAULT_STEP_BUDGET = 200000
+
+_ADD_BASE = 0
+_SET_EXCLUDE = 1
+_POP_FRONT = 2
+_PUSH_FRONT = 3
+_PUSH_BACK = 4
+_ADVANCE = 5
+
+# The verdict cache: _verdicts is the verdicts table, _new_verdicts holds
+# the verdicts found in this run (see CheckDependencies),
+# _local_digest maps a package to the digest of its relations, and
+# _essential_cone maps the packages in the dependency cone of the
+# Essential packages to their digests.  Change _VERDICT_VERSION when
+# the outcome of _ComputeDependency() changes for the same input, so
+# that old verdicts are not used.
+
+_VERDICT_VERSION = '2'
+_verdicts = None
+_new_verdicts = None
+_local_digest = None
+_essential_cone = None
+
+# The shared state of CheckDependencies(), which forked worker processes
+# inherit: the parsed pkg_deps table, the pathnames provided by more
+# than one package, the (architecture, packages, underlying packages)
+# tuple of each shard, the portable packages skipped after the first
+# shard, and the part of the dependency graph common to every shard
+# (see _BuildSharedGraph).  _graphs maps the index of each shard
+# loaded in this process to its solver state.
+
+_pkg_deps = None
+_shared_files = None
+_shards = None
+_skipped = None
+_shared_graph = None
+_graphs = None
 
 
 # The following four functions implement common logging and error
@@ -63,6 +114,7 @@ def _Warning(text):
 def _Error(text):
   global _package, _silent
   if not _silent:
+    lu.CountEvent('verification failures')
     if _package:
       lg.info('Validating ' + _package + ' ...')
       _package = None
@@ -89,7 +141,7 @@ def _BuildDependencyGraph(pkg_list, pkg_deps):
   the pkg_list argument in a form readily usable for dependency and
   implicit conflict checking.  The entry for each package is a tuple
   with the following attributes: name_ver_arch, Depends (including
-  Pre-Depends), Conflicts, and Replaces.  The key to _depi is a
+  Pre-Depends), Conflicts, Replaces, and Pre-Depends.  The key to _depi is a
   virtual or actual package name, which maps to a list of
   corresponding package entries.
   """
@@ -98,7 +150,7 @@ def _BuildDependencyGraph(pkg_list, pkg_deps):
 
   pkgs_to_check = {}
   for nva in sorted(pkg_list):
-    [n, v, a] = nva.split('_')
+    n = nu.GetName(nu.Split(nu.Intern(nva))[0])
     di = pkg_deps[nva]
 
     # Ignore debian-installer packages.  Since they are not
@@ -112,8 +164,8 @@ def _BuildDependencyGraph(pkg_list, pkg_deps):
       _essential.append([nva])
 
     pkgs_to_check[nva] = None
-    dep = di['Depends']
-    dep.extend(di['Pre-Depends'])
+    pre = di['Pre-Depends']
+    dep = di['Depends'] + pre
     cfl = di['Conflicts']
     repl = di['Replaces']
 
@@ -123,27 +175,28 @@ def _BuildDependencyGraph(pkg_list, pkg_deps):
     for name in [n] + di['Provides']:
       if name not in _depi:
         _depi[name] = []
-      _depi[name].append((nva, dep, cfl, repl))
+      _depi[name].append((nva, dep, cfl, repl, pre))
   return pkgs_to_check
 
 
-def _BuildConflictList(file_pkg, pkg_dict):
+def _BuildConflictList(shared_files, pkg_dict):
   """Build a list of implicitly conflicting packages
 
   Two packages conflict implicitly if they both install a file to the
   same path but neither declares Conflicts or Replaces on the other.
   This function compiles a list of implicitly conflicting package
-  pairs in the release.
+  pairs in the release from the (pathname, package list) pairs of
+  _CollectSharedFiles().
   """
 
   cfl = {}
-  for f in file_pkg:
+  for f, pkgs in shared_files:
     mutual_ex = {}
 
     # Add packages in the release that contain the pathname f into the
     # mutual_ex dictionary.
 
-    for pkg in file_pkg[f].split(', '):
+    for pkg in pkgs:
       entry = _GetPackage(pkg)
       if entry is not None:
         mutual_ex[pkg] = entry
@@ -235,201 +288,784 @@ def _GetPackage(nva):
   return None
 
 
-def _DoComputeDependency(queue, base, exclude):
+def _GetLocalDigest(nva):
+  """Compute the digest of the relations of a package
+
+  The digest covers the package itself and its Depends (including
+  Pre-Depends) and Conflicts relations, along with the packages in the
+  release that satisfy each of the relations, and which of the
+  relations are Pre-Depends (for the install plan order).
+  """
+
+  if nva not in _local_digest:
+    entry = _GetPackage(nva)
+    parts = [nva]
+    if entry is not None:
+      for relation in entry[1]:
+        candidates = sorted(_SelectPackagesWithMemo(relation).keys())
+        parts.append('D ' + relation + ': ' + ', '.join(candidates))
+      for relation in entry[2]:
+        candidates = sorted(_SelectPackagesWithMemo(relation).keys())
+        parts.append('C ' + relation + ': ' + ', '.join(candidates))
+      for relation in entry[4]:
+        parts.append('P ' + relation)
+    _local_digest[nva] = '\n'.join(parts) + '\n\n'
+  return _local_digest[nva]
+
+
+def _CollectCone(roots, cone):
+  """Add the dependency cone of packages to a dictionary
+
+  The dependency cone of a list of packages is the set of packages
+  reachable from them through Depends relations.  The cone dictionary
+  maps each package in the cone to its digest, and packages that are
+  already in it are not explored again.
+  """
+
+  stack = list(roots)
+  while stack:
+    nva = stack.pop()
+    if nva in cone:  continue
+    cone[nva] = _GetLocalDigest(nva)
+    entry = _GetPackage(nva)
+    if entry is None:  continue
+    for relation in entry[1]:
+      stack.extend(_SelectPackagesWithMemo(relation).keys())
+  return cone
+
+
+def _GetConeFingerprint(pkgs):
+  """Compute the verdict cache key of a list of packages
+
+  The solver only ever looks at the packages in the dependency cone of
+  pkgs and of the Essential packages, and at their relations, so its
+  verdict on pkgs is determined by the digests of these packages.  The
+  fingerprint is the hash value of all these digests.
+  """
+
+  global _essential_cone
+
+  if _essential_cone is None:
+    roots = []
+    for alternatives in _essential:
+      roots.extend(alternatives)
+    _essential_cone = _CollectCone(roots, {})
+
+  cone = _CollectCone(pkgs, dict(_essential_cone))
+  h = cu.NewHash('sha1')
+  h.update(_VERDICT_VERSION + '\n')
+  for alternatives in _essential:
+    h.update(' | '.join(alternatives) + '\n')
+  h.update(', '.join(pkgs) + '\n\n')
+  for nva in sorted(cone.keys()):
+    h.update(cone[nva])
+  return h.hexdigest()
+
+
+def _DoComputeDependency(queue, budget):
   """Find a dependency solution for a set of packages
 
   This function determines a minimum set of packages that satisfies
   the transitive dependency relation of the given set of packages.
   The queue argument is the list of alternative packages that we wish
   to install (eg., [['foo_3_all'], ['bar_1_all', 'buz_1_all']] means
-  that we wish to install either foo and bar, or foo and buz), and the
-  base dictionary has the set of currently installed packages as its
-  keys.  The exclude dictionary has the set of packages that must not
-  be installed (eg., due to Conflicts).  The function returns None if
-  it cannot find any such solution.
+  that we wish to install either foo and bar, or foo and buz).  The
+  function returns None if it cannot find any such solution, or if it
+  has not found one after trying budget packages (in which case it
+  also sets _timed_out).
+
+  The search is a depth-first search over an explicit stack of choice
+  points.  The state consists of the queue, the base dictionary (the
+  set of currently installed packages as its keys), and the exclude
+  dictionary (the set of packages that must not be installed, eg., due
+  to Conflicts).  Instead of copying the state at every choice point,
+  the search records every change in an undo trail, and it reverts the
+  changes made since a choice point before trying its next
+  alternative.  The queue is kept as the front stack (with its first
+  entry at the end) followed by the entries of back from pos onwards.
   """
 
-  global _notified
+  global _timed_out
+
+  base = {}
+  exclude = {}
+  front = []
+  back = list(queue)
+  pos = 0
+  trail = []
+  choices = []
+  steps = 0
+
+  while True:
+
+    # Take the next entry from the queue.  If there is a package in it
+    # that is already in base, then a package we want has already
+    # been included, and we can continue working on the rest of the
+    # queue.  If there are no entries left in the queue, we are done
+    # tracing the dependency graph and the base is the answer.
+
+    head = None
+    while front or pos < len(back):
+      if front:
+        head = front.pop()
+        trail.append((_POP_FRONT, head))
+      else:
+        head = back[pos]
+        pos = pos + 1
+        trail.append((_ADVANCE,))
+      for pkg in head:
+        if pkg in base:
+          head = None
+          break
+      if head is not None:
+        break
+    if head is None:
+      return base.keys()
+
+    # Each choice point is a list of the packages in head, the index of
+    # the next package to try, and the trail length to revert to.
+
+    choices.append([head, 0, len(trail)])
+
+    # Try to add each package in head into base in turn, backtracking
+    # to the previous choice point when all packages in head fail.
+
+    while choices:
+      choice = choices[-1]
+      head, index, mark = choice
+      while len(trail) > mark:
+        change = trail.pop()
+        if change[0] == _ADD_BASE:
+          del base[change[1]]
+        elif change[0] == _SET_EXCLUDE:
+          if change[2] is None:
+            del exclude[change[1]]
+          else:
+            exclude[change[1]] = change[2]
+        elif change[0] == _POP_FRONT:
+          front.append(change[1])
+        elif change[0] == _PUSH_FRONT:
+          front.pop()
+        elif change[0] == _PUSH_BACK:
+          back.pop()
+        else:
+          pos = pos - 1
+
+      if index == len(head):
+        choices.pop()
+        continue
+      choice[1] = index + 1
+
+      steps = steps + 1
+      if steps > budget:
+        _Error('Cannot solve dependency within step budget')
+        _timed_out = True
+        return None
 
-  # If there are no packages in the queue, we are done tracing the
-  # dependency graph and the base is the answer.
+      # Skip with a warning message if some package in base conflicts
+      # with this one.
 
-  if queue == []:
-    return base.keys()
+      pkg = head[index]
+      if pkg in exclude:
+        _ReportConflict(exclude[pkg], pkg)
+        continue
 
-  # The head are the packages we want to try fit into base, and the
-  # packages in queue we will deal with later.
+      entry = _GetPackage(pkg)
 
-  head = queue[0]
-  tail = queue[1:]
+      # Skip if the package is not in the release (this situation
+      # should never happen).
+
+      if entry is None:
+        _Warning('Bug: package ' + pkg + ' does not exist')
+        continue
+
+      # Skip if this package conflicts with any package in base;
+      # otherwise add the Conflicts packages to exclude.  Note that
+      # following Policy 7.3, we do not check if the package Conflicts
+      # with itself.
+
+      proceed = True
+      for relation in entry[2]:
+        for conflicted in _SelectPackagesWithMemo(relation):
+          if conflicted in base:
+            _ReportConflict(pkg, conflicted)
+            proceed = False
+            break
+          trail.append((_SET_EXCLUDE, conflicted, exclude.get(conflicted)))
+          exclude[conflicted] = pkg
+        if not proceed:
+          break
+      if not proceed:
+        continue
 
-  # If there is a package in head that is already in base, then a
-  # package we want has already been included, and we can continue
-  # working on the tail of the queue.
+      # Add dependencies of this package into the queue.
 
-  for pkg in head:
-    if pkg in base:
-      return _DoComputeDependency(tail, base, exclude)
+      for relation in entry[1]:
+        depends = sorted(_SelectPackagesWithMemo(relation).keys())
 
-  # Try to add each package in head into base in turn and call
-  # _DoComputeDependency() recursively in a depth-first search.
+        # There are no packages in the release which satisfies the
+        # dependency, we know that there cannot be any solutions in
+        # this branch of the search tree and skip the remaining
+        # packages in head with a warning message.
 
-  for pkg in head:
+        if depends == []:
+          _ReportUnsatisfiableRelation(relation)
+          proceed = False
+          break
 
-    # Skip with a warning message if some package in base conflicts
-    # with this one.
+        # To speed up the search process, we insert dependencies with
+        # only one choice to the beginning of the queue, and all
+        # others at the tail.
 
-    if pkg in exclude:
-      _ReportConflict(exclude[pkg], pkg)
-      continue
+        if len(depends) == 1:
+          front.append(depends)
+          trail.append((_PUSH_FRONT,))
+        else:
+          back.append(depends)
+          trail.append((_PUSH_BACK,))
+      if not proceed:
+        choice[1] = len(head)
+        continue
 
-    entry = _GetPackage(pkg)
+      # Add this package to base and continue working on the queue.
 
-    # Skip if the package is not in the release (this situation should
-    # never happen).
+      base[pkg] = None
+      trail.append((_ADD_BASE, pkg))
+      break
 
-    if entry is None:
-      _Warning('Bug: package ' + pkg + ' does not exist')
-      continue
+    else:
+      return None
 
-    # Skip if this package conflicts with any package in base;
-    # otherwise add the Conflicts packages to new_exclude.  Note that
-    # following Policy 7.3, we do not check if the package Conflicts
-    # with itself.
 
-    proceed = True
-    new_exclude = dict(exclude)
-    for relation in entry[2]:
-      for conflicted in _SelectPackagesWithMemo(relation):
-        if conflicted in base:
-          _ReportConflict(pkg, conflicted)
-          proceed = False
-          break
-        new_exclude[conflicted] = pkg
-      if not proceed:
-        break
-    if not proceed:
-      continue
+def _ComputeDependency(queue):
+  """Wrapper function for _DoComputeDependency()
+
+  This function bounds the dependency solving procedure by a step
+  budget (see _LoadDependencyGraph) to avoid blocking on particularly
+  difficult cases.  Unlike a timer signal, the budget works in any
+  thread or worker process, and it cuts off a search at the same point
+  in every run.  This function also inserts the set of Essential
+  packages into the queue to catch any package that conflicts with
+  them.
+  """
 
-    # Add dependencies of this package into new_queue.
+  global _notified, _timed_out
 
-    new_queue = list(tail)
+  _notified = {}
+  _timed_out = False
+  return _DoComputeDependency(_essential + queue, _step_budget)
+
+
+def _OrderInstallPlan(solution):
+  """Order the packages of a dependency solution for installation
+
+  This function orders the packages so that each package comes after
+  the packages in the solution that satisfy its Pre-Depends and, where
+  the Depends relations do not form a cycle, after the packages that
+  satisfy its Depends.  A cycle is broken at the first package (in
+  name_ver_arch order) whose Pre-Depends packages are all in place.
+  """
+
+  members = dict.fromkeys(solution)
+  pre_depends = {}
+  pending = {}
+  users = {}
+
+  for nva in solution:
+    users.setdefault(nva, [])
+    pre_depends[nva] = {}
+    pending[nva] = {}
+    entry = _GetPackage(nva)
     for relation in entry[1]:
-      depends = sorted(_SelectPackagesWithMemo(relation).keys())
+      for dependency in _SelectPackagesWithMemo(relation):
+        if dependency in members and dependency != nva:
+          pending[nva][dependency] = None
+    for relation in entry[4]:
+      for dependency in _SelectPackagesWithMemo(relation):
+        if dependency in members and dependency != nva:
+          pre_depends[nva][dependency] = None
+    for dependency in pending[nva]:
+      users.setdefault(dependency, []).append(nva)
+
+  plan = []
+  ready = [nva for nva in solution if not pending[nva]]
+  heapq.heapify(ready)
+  while len(plan) < len(solution):
+    if ready:
+      nva = heapq.heappop(ready)
+    else:
+
+      # Every remaining package waits for another one, so there is a
+      # cycle.  Place the first package that does not wait for any of
+      # its Pre-Depends packages.
+
+      waiting = sorted([pkg for pkg in pending if pending[pkg]])
+      nva = None
+      for pkg in waiting:
+        for dependency in pre_depends[pkg]:
+          if dependency in pending[pkg]:
+            break
+        else:
+          nva = pkg
+          break
+      if nva is None:
+        nva = waiting[0]
+        _Warning('Pre-Depends loop involving ' + nva)
+      pending[nva] = {}
+
+    plan.append(nva)
+    del pending[nva]
+    for user in users[nva]:
+      if user in pending and nva in pending[user]:
+        del pending[user][nva]
+        if not pending[user]:
+          heapq.heappush(ready, user)
+  return plan
+
+
+def _CheckInstallable(pkgs):
+  """Check whether a list of packages can be installed together
+
+  This function looks up the verdict in the verdict cache before it
+  runs _ComputeDependency() on the packages, and it keeps every new
+  verdict that was not cut short by the step budget in _new_verdicts
+  (for the caller to record).  A cached negative verdict is recomputed
+  when messages are not silenced, so that the log still explains why
+  the packages cannot be installed.
+  """
+
+  key = _GetConeFingerprint(pkgs)
+  verdict = _new_verdicts.get(key)
+  if verdict is None and key in _verdicts:
+    verdict = _verdicts[key]
+  if verdict is not None:
+    lu.CountEvent('verdict cache hits')
+    if verdict == 'yes':
+      return True
+    if _silent:
+      return False
+
+  queue = [[pkg] for pkg in pkgs]
+  installable = _ComputeDependency(queue) is not None
+  if not _timed_out:
+    if installable:
+      _new_verdicts[key] = 'yes'
+    else:
+      _new_verdicts[key] = 'no'
+  return installable
+
+
+def _LoadDependencyGraph(pkg_list, underlying, pkg_deps, shared=None):
+  """Set up the solver state for the packages in a release
+
+  If shared is a graph from _BuildSharedGraph(), this function starts
+  from a copy of it and adds only the packages that are not in it.
+  The VerifySteps setting in the repository configuration overrides
+  the number of packages the solver may try for each problem before it
+  reports the problem as unsolvable (_DEFAULT_STEP_BUDGET).
+  """
 
-      # There are no packages in the release which satisfies the
-      # dependency, we know that there cannot be any solutions in this
-      # branch of the search tree and skip with a warning message.
+  global _depi, _essential, _relation_pkg
+  global _local_digest, _essential_cone, _step_budget
 
-      if depends == []:
-        _ReportUnsatisfiableRelation(relation)
-        return None
+  _depi = {}
+  _essential = []
+  pkgs_to_check = {}
+  if shared is not None:
+    depi, essential, shared_pkgs, shared_under, shared_list = shared
+    for name, entries in depi.iteritems():
+      _depi[name] = entries[:]
+    _essential.extend(essential)
+    pkgs_to_check.update(shared_pkgs)
+    underlying = [nva for nva in underlying if nva not in shared_under]
+    pkg_list = [nva for nva in pkg_list if nva not in shared_list]
+  _BuildDependencyGraph(underlying, pkg_deps)
+  pkgs_to_check.update(_BuildDependencyGraph(pkg_list, pkg_deps))
 
-      # To speed up the search process, we insert dependencies with
-      # only one choice to the beginning of the queue, and all others
-      # at the tail.
+  _relation_pkg = {}
+  _local_digest = {}
+  _essential_cone = None
+  _step_budget = int(su.GetSetting(None, 'VerifySteps') or
+                     _DEFAULT_STEP_BUDGET)
+  return pkgs_to_check
 
-      if len(depends) == 1:
-        new_queue.insert(0, depends)
-      else:
-        new_queue.append(depends)
 
-    # Add this package to the new_base dictionary.
+def _BuildSharedGraph():
+  """Build the part of the dependency graph common to every shard
 
-    new_base = dict(base)
-    new_base[pkg] = None
+  This function organizes the arch:all packages that are in the
+  packages (or the underlying packages) of every shard once, before
+  the shards are forked, and it returns the resulting _depi and
+  _essential state along with the packages to check and the packages
+  it covers.  The shards start from this graph (see _LoadShard) and
+  add only their architecture-specific packages.
+  """
 
-    # Continue working on the queue.
+  global _depi, _essential
 
-    result = _DoComputeDependency(new_queue, new_base, new_exclude)
-    if result is not None:
-      return result
+  shared_under = None
+  shared_list = None
+  if not _shards:
+    return ({}, [], {}, {}, {})
+  for arch, pkg_list, underlying in _shards:
+    under = {}
+    for nva in underlying:
+      if nva.endswith('_all'):
+        if shared_under is None or nva in shared_under:
+          under[nva] = None
+    shared_under = under
+    pkgs = {}
+    for nva in pkg_list:
+      if nva.endswith('_all'):
+        if shared_list is None or nva in shared_list:
+          pkgs[nva] = None
+    shared_list = pkgs
+
+  _depi = {}
+  _essential = []
+  _BuildDependencyGraph(shared_under.keys(), _pkg_deps)
+  pkgs_to_check = _BuildDependencyGraph(shared_list.keys(), _pkg_deps)
+  graph = (_depi, _essential, pkgs_to_check, shared_under, shared_list)
+  _depi = None
+  _essential = None
+  return graph
+
+
+def _LoadShard(index):
+  """Set up the solver state for one shard
+
+  The solver state is kept in _graphs, so that a process that runs
+  both _FindPortablePackages() and _CheckShard() on a shard builds its
+  dependency graph only once.
+  """
 
-  return None
+  global _depi, _essential, _relation_pkg, _local_digest, _essential_cone
 
+  if index in _graphs:
+    lu.CountEvent('shard graphs reused')
+    (_depi, _essential, pkgs_to_check,
+     _relation_pkg, _local_digest) = _graphs[index]
+    _essential_cone = None
+    return pkgs_to_check
 
-def _ComputeDependency(queue):
-  """Wrapper function for _DoComputeDependency()
+  arch, pkg_list, underlying = _shards[index]
+  pkgs_to_check = _LoadDependencyGraph(pkg_list, underlying, _pkg_deps,
+                                       _shared_graph)
+  _graphs[index] = (_depi, _essential, pkgs_to_check,
+                    _relation_pkg, _local_digest)
+  return pkgs_to_check
+
+
+def _CollectSharedFiles(file_pkg, pkg_dict):
+  """List the pathnames provided by more than one package
 
-  This function adds a 5-second timeout to the dependency solving
-  procedure to avoid blocking on particularly difficult cases.  On a
-  2.6GHz Xeon system, the dependency for nearly all packages are
-  solved in fractions of a second.  This function also inserts the set
-  of Essential packages into the queue to catch any package that
-  conflicts with them.
+  This function returns a list of (pathname, package list) pairs for
+  the pathnames that are provided by at least two packages in the
+  pkg_dict dictionary, which are the only ones that can give rise to
+  implicit conflicts.
   """
 
-  global _notified
+  shared_files = []
+  for f, value in bu.IterateTable(file_pkg):
+    pkgs = [pkg for pkg in value.split(', ') if pkg in pkg_dict]
+    if len(pkgs) > 1:
+      shared_files.append((f, pkgs))
+  return shared_files
+
+
+def _IsPortableMember(nva, essential_cone, essential_conflicts):
+  """Check if a package may be in the cone of a portable package
+  """
+
+  if not nva.endswith('_all'):
+    return False
+  if nva in essential_cone or nva in essential_conflicts:
+    return False
+  entry = _GetPackage(nva)
+  if entry is None:
+    return False
+  for relation in entry[2]:
+    for conflicted in _SelectPackagesWithMemo(relation):
+      if conflicted in essential_cone:
+        return False
+  return True
+
+
+def _FindPortablePackages(index):
+  """Find the arch:all packages with architecture-independent verdicts
+
+  An arch:all package has the same verdict on every architecture
+  (given that the Essential packages are installable) if every package
+  in its dependency cone is an arch:all package, and the cone neither
+  overlaps with nor conflicts with the dependency cone of the Essential
+  packages.  This function returns a dictionary that maps each such
+  package in the shard to the hash value of the digests in its cone.
+  """
+
+  pkgs_to_check = _LoadShard(index)
+
+  roots = []
+  for alternatives in _essential:
+    roots.extend(alternatives)
+  essential_cone = _CollectCone(roots, {})
+  essential_conflicts = {}
+  for nva in essential_cone:
+    entry = _GetPackage(nva)
+    if entry is None:  continue
+    for relation in entry[2]:
+      essential_conflicts.update(_SelectPackagesWithMemo(relation))
+
+  # A package is tainted if its cone is known to break the conditions
+  # above (because some package in the cone does).
+
+  tainted = {}
+  portable = {}
+  for pkg in sorted(pkgs_to_check.keys()):
+    if not pkg.endswith('_all'):  continue
+    cone = {}
+    stack = [pkg]
+    while stack:
+      nva = stack.pop()
+      if nva in cone:  continue
+      if nva in tainted or not _IsPortableMember(nva, essential_cone,
+                                                 essential_conflicts):
+        tainted[pkg] = None
+        break
+      cone[nva] = _GetLocalDigest(nva)
+      for relation in _GetPackage(nva)[1]:
+        stack.extend(_SelectPackagesWithMemo(relation).keys())
+    if pkg not in tainted:
+      h = cu.NewHash('sha1')
+      for nva in sorted(cone.keys()):
+        h.update(cone[nva])
+      portable[pkg] = h.hexdigest()
+  return portable
+
+
+def _CheckShard(index):
+  """Verify the dependency integrity of one architecture
+
+  This function checks the packages of the shard except the portable
+  packages (see _FindPortablePackages) in _skipped, whose verdicts
+  come from the first shard.  It returns the new verdicts.
+  """
 
-  def Handler(signum, frame):
-    _Error('Cannot solve dependency within time bound')
-    raise MemoryError
+  global _package, _silent, _verdicts, _new_verdicts
 
+  lg.info('Checking dependency for architecture ' + _shards[index][0])
+  pkgs_to_check = _LoadShard(index)
+  _silent = True
+  cfl = _BuildConflictList(_shared_files, pkgs_to_check)
+  skipped = {}
+  if index > 0:
+    skipped = _skipped
+
+  def DoCheck(_arg, dbs):
+    global _package, _silent, _verdicts
+
+    _verdicts = dbs['verdicts']
+    _silent = False
+
+    # Check that every individual package is installable.
+
+    for pkg in sorted(pkgs_to_check.keys()):
+      if pkg in skipped:  continue
+      _package = pkg
+      if _GetPackage(pkg) is None:
+        _Error('Package ' + pkg + ' does not exist')
+      elif not _CheckInstallable([pkg]):
+        _Error(pkg + ' is uninstallable')
+
+    # Check that packages providing the same pathnames contain
+    # metadata that prevents them from being installed at the same
+    # time.
+
+    _silent = True
+    for pkg_1, pkg_2 in sorted(cfl.keys()):
+      if pkg_1 in skipped and pkg_2 in skipped:  continue
+      if _CheckInstallable([pkg_1, pkg_2]):
+        lu.CountEvent('verification failures')
+        lg.error('Implicit conflict between ' + pkg_1 + ' and '
+                 + pkg_2 + ' on /' + cfl[(pkg_1, pkg_2)])
+    _verdicts = None
+
+  _new_verdicts = {}
+  bu.RunWithDB(['verdicts'], DoCheck)
+  return _new_verdicts
+
+
+def _RunShardWorker(job):
+  """Run a shard function in a worker process
+
+  The worker returns its log messages and its timing report along with
+  the result, so that the parent can log the messages of the shards in
+  order and merge the reports.
+  """
+
+  func, index = job
+  lu.ResetReport()
+  result, records = lu.RunWithLogCapture(func, index)
+  return result, records, lu.GetReport()
+
+
+def _RunShards(func):
+  """Run a function on every shard in parallel worker processes
+
+  The shards are described by the module-level variables, which the
+  forked worker processes inherit (and only read).  This function
+  returns the results of func(index) in shard order.
+  """
+
+  workers = min(ru.GetWorkerCount(), len(_shards))
+  if workers < 2:
+    return [func(index) for index in range(len(_shards))]
+  pool = multiprocessing.Pool(workers)
   try:
-    try:
-      _notified = {}
-      signal.signal(signal.SIGALRM, Handler)
-      signal.alarm(5)
-      return _DoComputeDependency(_essential + queue, {}, {})
-    except MemoryError:
-      return None
+    results = []
+    jobs = [(func, index) for index in range(len(_shards))]
+    for result, records, report in pool.map(_RunShardWorker, jobs):
+      lu.ReplayLog(records)
+      lu.MergeReport(report)
+      results.append(result)
+    pool.close()
+    return results
   finally:
-    signal.alarm(0)
+    pool.terminate()
+    pool.join()
 
 
-def CheckDependency(pkg_list, underlying=[]):
+def CheckDependencies(arch_dict, underlying_dict={}):
   """Verify dependency integrity of a release
+
+  The arch_dict dictionary maps each architecture to the packages of
+  the release on that architecture (see ru.GroupByArch), and the
+  underlying_dict dictionary does the same for the packages of the
+  underlying releases.  This function reads the dependency table and
+  the pathnames of possible implicit conflicts and builds the
+  dependency graph of the arch:all packages once, and it checks each
+  architecture (shard) in a separate worker process.  The arch:all
+  packages with architecture-independent verdicts are only checked on
+  the first architecture.
   """
 
-  global _package, _silent, _relation_pkg
+  global _pkg_deps, _shared_files, _shards, _skipped
+  global _shared_graph, _graphs
 
-  def Initialize(_arg, dbs):
-    global _depi, _essential
+  all_pkgs = {}
+  for arch in arch_dict:
+    all_pkgs.update(dict.fromkeys(arch_dict[arch]))
+    all_pkgs.update(dict.fromkeys(underlying_dict.get(arch, [])))
 
-    _depi = {}
-    _essential = []
+  def Initialize(_arg, dbs):
     pkg_deps = du.ParseDependencyTable(dbs['pkg_deps'])
-    _BuildDependencyGraph(underlying, pkg_deps)
-    pkgs_to_check = _BuildDependencyGraph(pkg_list, pkg_deps)
-    cfl = _BuildConflictList(dbs['file_pkg'], pkgs_to_check)
-    return cfl, pkgs_to_check
+    shared_files = _CollectSharedFiles(dbs['file_pkg'], all_pkgs)
+    return pkg_deps, shared_files
 
-  sys.setrecursionlimit(10000)
-  db_list = ['pkg_deps', 'file_pkg']
-  cfl, pkgs_to_check = bu.RunWithDB(db_list, Initialize)
+  db_list = ['pkg_deps', 'file_pkg', 'verdicts']
+  _pkg_deps, _shared_files = bu.RunWithDB(db_list, Initialize)
+  _shards = []
+  for arch in sorted(arch_dict.keys()):
+    _shards.append((arch, arch_dict[arch], underlying_dict.get(arch, [])))
 
-  _silent = False
-  _relation_pkg = {}
+  try:
+    _shared_graph = lu.RunWithSpan('_BuildSharedGraph', _BuildSharedGraph)
+    _graphs = {}
+
+    # Find the arch:all packages that are portable on every
+    # architecture with the same cone, and skip them after the first.
+
+    _skipped = {}
+    if len(_shards) > 1:
+      results = lu.RunWithSpan('_FindPortablePackages', _RunShards,
+                               _FindPortablePackages)
+      for pkg in results[0]:
+        for portable in results[1:]:
+          if portable.get(pkg) != results[0][pkg]:
+            break
+        else:
+          _skipped[pkg] = None
+      lu.CountEvent('portable verdicts shared', len(_skipped))
+
+    results = lu.RunWithSpan('_CheckShard', _RunShards, _CheckShard)
+
+    def DoRecord(_arg, dbs):
+      for new_verdicts in results:
+        for key in new_verdicts:
+          dbs['verdicts'][key] = new_verdicts[key]
+
+    bu.RunWithDB(['verdicts'], DoRecord)
+  finally:
+    _pkg_deps = None
+    _shared_files = None
+    _shards = None
+    _skipped = None
+    _shared_graph = None
+    _graphs = None
+
+
+def GetInstallPlans(pkg_list, underlying=[], targets=None):
+  """Compute install plans for packages in a release
+
+  An install plan is a dependency solution in installation order (see
+  _OrderInstallPlan).  If targets is None, this function returns a
+  dictionary that maps every package in pkg_list to its install plan,
+  or to None if the package is uninstallable.  Otherwise it returns
+  the install plan for the targets packages installed together (None
+  if there is no such plan).  The plans table keeps the plans under
+  their dependency cone fingerprints, so that plans are computed only
+  when their cones change (or, for targets without a plan, when the
+  log should explain why).
+  """
+
+  def DoPlan(pkgs, plans):
+    key = _GetConeFingerprint(pkgs)
+    if key in plans and (plans[key] or _silent):
+      lu.CountEvent('install plan cache hits')
+      plan = plans[key]
+      return plan and plan.split(', ') or None
+    solution = _ComputeDependency([[pkg] for pkg in pkgs])
+    if solution is None:
+      if not _timed_out:
+        plans[key] = ''
+      return None
+    plan = _OrderInstallPlan(solution)
+    plans[key] = ', '.join(plan)
+    return plan
 
-  # Check that every individual package is installable.
+  def DoPlanWithDB(_arg, dbs):
+    global _package, _silent
 
-  for pkg in sorted(pkgs_to_check.keys()):
-    _package = pkg
-    if _GetPackage(pkg) is None:
-      _Error('Package ' + pkg + ' does not exist')
-    elif _ComputeDependency([[pkg]]) is None:
-      _Error(pkg + ' is uninstallable')
+    pkg_deps = du.ParseDependencyTable(dbs['pkg_deps'])
+    pkgs_to_check = _LoadDependencyGraph(pkg_list, underlying, pkg_deps)
+    plans = dbs['plans']
 
-  # Check that packages providing the same pathnames contain metadata
-  # that prevents them from being installed at the same time.
+    if targets is not None:
+      _silent = False
+      _package = ', '.join(targets)
+      for pkg in targets:
+        if _GetPackage(pkg) is None:
+          _Error('Package ' + pkg + ' does not exist')
+          return None
+      return DoPlan(targets, plans)
 
-  _silent = True
-  for pkg_1, pkg_2 in sorted(cfl.keys()):
-    if _ComputeDependency([[pkg_1], [pkg_2]]) is not None:
-      lg.error('Implicit conflict between ' + pkg_1 + ' and '
-               + pkg_2 + ' on /' + cfl[(pkg_1, pkg_2)])
+    _silent = True
+    plan_dict = {}
+    for pkg in sorted(pkgs_to_check.keys()):
+      plan_dict[pkg] = DoPlan([pkg], plans)
+    return plan_dict
+
+  return bu.RunWithDB(['pkg_deps', 'plans'], DoPlanWithDB)
 
 
 def main():
   def CompileList(_arg, dbs):
-    latest = ru.SelectLatestPackages(dbs['pkg_info'])
+    latest = ru.ListLatestPackages(dbs['pkg_latest'], dbs['pkg_info'])
     return ru.GroupByArch(latest)
 
   lu.SetLogConsole()
-  arch_dict = bu.RunWithDB(['pkg_info'], CompileList, None)
-  for arch in arch_dict:
-    lg.info('Checking dependency for architecture ' + arch)
-    CheckDependency(arch_dict[arch])
+  db_list = ['pkg_info', 'pkg_latest']
+  arch_dict = bu.RunWithDB(db_list, CompileList, None)
+  CheckDependencies(arch_dict)
 
 
 if __name__ == '__main__':